@@ -1,7 +1,21 @@
 FF2_VID = 0x0a2d            # Vendor ID
 FF2_PID = 0x0015            # Product ID
 MAX_BULK_SIZE = 0xffc0
+READER_DEPTH = 8            # Filled buffers the background reader may queue
+INFLIGHT_TRANSFERS = 4      # Request/read pairs kept queued in libusb when prefetching
+RING_SLOTS = READER_DEPTH + INFLIGHT_TRANSFERS + 2   # Bulk buffers reused for reads
+READER_POLL = 0.1           # Seconds between stop checks in the reader thread
+DECODE_POOL_BYTES = 1<<26   # Shared memory holding bulk buffers for decode worker processes
 CHUNK_SIZE = 1<<15
+PLAN_MAX_LATENCY = 1.0      # Seconds until the first chunk of a planned sweep arrives
+PLAN_MAX_MEMORY = 1<<26     # Bytes of one chunk spectrum in transfer
+PLAN_TRANSFER_RATE = 30e6   # Starting guesses until a sweep has been measured
+PLAN_DECODE_RATE = 100e6
+PLAN_TRIGGER_RATE = 1e3     # Records per second
+PLAN_CHUNK_OVERHEAD = 2e-3  # Seconds of host turnaround per chunk
+PLAN_SMOOTHING = 0.5        # Weight of the newest measurement
+METRIC_HIST_MIN = 1e-6      # Upper edge (s) of the first latency histogram bucket
+METRIC_HIST_BUCKETS = 32    # Each bucket doubles the last; the final one is open-ended
 DITHER_LEN = 0.
 TRAC_LEN = 10e3
 OFFSET = -0.25
@@ -32,18 +46,47 @@ TIMER_RESET_MASK = 0x10
 PROTOCOL_SET_PTR = 0xa1fe
 PROTOCOL_BASE = 0xa200
 PROTOCOL_STEP = 0x0020
+PROTOCOL_B2_OFFSET = 0x0e   # b2 block follows b1 within a slot
+PROTOCOL_CACHE_SIZE = 256   # Distinct protocol encodings kept
+PROTOCOL_MERGE_GAP = 4      # Unchanged bytes worth rewriting to save a control transfer
 
 TRIGGER_PARAMETER = 0x06
 TRIGGER_POLARITY_MASK = 0x10
 TRIGGER_RISING_MASK = 0x02
 
+# Registers only the host writes; reads of these are served from a shadow copy
+SHADOWED_MEMORY = (MISC_CNTRL_PTR, PROTOCOL_SET_PTR)
+SHADOWED_PARAMETERS = (0x05, TRIGGER_PARAMETER, 0x07, 0x14, 0x15)
+
 OVERLOAD = 0x01
 UNDERLOAD = 0x02
 
+CODE_MASK = 0xFF000000          # Top byte of every code word
+CODE_TYPE_MASK = 0x00E00000
+CODE_TYPE_SHIFT = 21
 CODE_DATA_MASK = 0x001FFFFF
+TIME_LOW_BITS = 21          # TIME_LOW holds the low bits of the timestamp, TIME_HIGH the rest
+TIME_TICK = 1e-6            # Seconds per timestamp count since the last timer reset (assumed)
 
 import os
 FPGA_DIR = os.path.join(os.path.dirname(__file__), "FPGA")
+CAL_DIR = os.path.join(os.path.dirname(__file__), "background")   # Saved background calibrations
+# Per-user state kept outside the package tree, which may be read-only
+if os.name == "nt":
+    STATE_DIR = os.path.join(os.environ.get("LOCALAPPDATA") or os.path.expanduser("~"), "ff2_driver")
+else:
+    STATE_DIR = os.path.join(os.environ.get("XDG_STATE_HOME") or os.path.join(os.path.expanduser("~"), ".local", "state"), "ff2_driver")
+STATE_DIR = os.environ.get("FF2_STATE_DIR") or STATE_DIR
+CAL_CACHE_SIZE = 8          # Background calibrations kept in memory
+FPGA_HUNK_SIZE = 0x20       # Chip byte + 31 image bytes per upload hunk
+FPGA_ACK_BATCH = 16         # Commands written before their acks are collected
+
+# (chip, image) in upload order; the pipes chain takes three copies of pipes.rbf
+FPGA_IMAGES = [(0x4, "AcqControl.rbf"),
+               (0x6, "pipes.rbf"), (0x6, "pipes.rbf"), (0x6, "pipes.rbf"), (0x6, "pipes4P2.rbf"),
+               (0x8, "compressionfpga.rbf"),
+               (0xc, "00_AnalogFPGA.rbf"), (0xc, "TrigProcFPGA.rbf"),
+               (0xa, "fanout.bin")]
 
 STRANGE_DANCE = [0x23, 0x21, 0x20, -0x20, 0x22, 0x23, 0x22, 0x20, 0x21, 0x20,
                 0x22, 0x23, 0x22, 0x20, 0x21, 0x20, 0x20, 0x21, 0x20, 0x20, 
@@ -0,0 +1,135 @@
+import numpy as np
+
+INT64_MAX = int(np.iinfo(np.int64).max)
+INT64_MIN = int(np.iinfo(np.int64).min)
+
+class sweepAccumulator:
+    # Running sum of chunk spectra held in preallocated storage that is reused
+    # from one acquisition to the next. Integer sums track a bound on their
+    # range so they fail loudly instead of wrapping; the float64 path trades
+    # exactness for range and is also used once a fractional offset or scale
+    # is applied.
+
+    def __init__(self, length=0, dtype=np.int64):
+        self.dtype = np.dtype(dtype)
+        self.__store = {}
+        self.reset(length)
+
+    def __alloc(self, dtype, length):
+        a = self.__store.get(dtype)
+        if a is None or len(a) < length:
+            a = np.empty(length, dtype=dtype)
+            self.__store[dtype] = a
+        return a[:length]
+
+    def reset(self, length, dtype=None):
+        if dtype is not None: self.dtype = np.dtype(dtype)
+        self.length = length
+        self.buf = self.__alloc(self.dtype, length)
+        self.buf[:] = 0
+        self.count = 0
+        self.records = 0        # traces summed so far, kept by the caller
+        self.__hi = self.__lo = 0
+
+    def isFloat(self):
+        return self.buf.dtype.kind == 'f'
+
+    def toFloat(self):
+        if self.isFloat(): return
+        f = self.__alloc(np.dtype(np.float64), self.length)
+        f[:] = self.buf
+        self.buf = f
+
+    def __check(self, hi, lo):
+        # hi/lo bound the values about to be added
+        if self.isFloat(): return
+        h, l = self.__hi + hi, self.__lo + lo
+        if h > INT64_MAX or l < INT64_MIN:
+            # the running bound is conservative; tighten it before giving up
+            self.__hi, self.__lo = int(self.buf.max()), int(self.buf.min())
+            h, l = self.__hi + hi, self.__lo + lo
+            if h > INT64_MAX or l < INT64_MIN:
+                raise OverflowError(f"Sweep sum would leave int64 range after {self.count} chunks; accumulate in float64 instead")
+        self.__hi, self.__lo = h, l
+
+    def add(self, data):
+        n = len(data)
+        if n > self.length: raise IndexError(f"Chunk of {n} samples does not fit accumulator of {self.length}")
+        if n == 0: return
+        if data.dtype.kind == 'f': self.toFloat()
+        self.__check(int(data.max()), int(data.min()))
+        self.buf[:n] += data
+        self.count += 1
+
+    def addSticks(self, sticks):
+        # sticks (a STICK_DTYPE array) summed into the bins they fall in
+        if len(sticks) == 0: return
+        t = sticks["time"]
+        if int(t.max()) >= self.length: raise IndexError(f"Stick at {int(t.max())} outside accumulator of {self.length}")
+        v = sticks["value"]
+        self.__check(int(v.max()), 0)
+        np.add.at(self.buf, t, v)
+
+    def addOffset(self, v):
+        if not self.isFloat() and v != int(v): self.toFloat()
+        if not self.isFloat(): v = int(v)
+        self.__check(max(v, 0), min(v, 0))
+        self.buf += v
+
+    def scale(self, f):
+        if not self.isFloat() and f != int(f): self.toFloat()
+        if not self.isFloat():
+            f = int(f)
+            a, b = self.__hi * f, self.__lo * f
+            self.__hi, self.__lo = 0, 0
+            self.__check(max(a, b), min(a, b))
+        self.buf *= f
+
+    def subtract(self, values):
+        values = np.asarray(values)
+        if values.dtype.kind == 'f': self.toFloat()
+        n = len(values)
+        if not self.isFloat() and n: self.__check(-int(values.min()), -int(values.max()))
+        self.buf[:n] -= values
+
+class stickAccumulator:
+    # Sum of STICK mode spectra kept sparse: the sticks of each chunk are
+    # stored as they come and merged by time index only when asked for.
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.__parts = []
+        self.__merged = None
+        self.count = 0
+
+    def add(self, sticks):
+        if len(sticks) == 0: return
+        self.__parts.append(sticks)
+        self.__merged = None
+        self.count += 1
+
+    def sparse(self):
+        # (times, sums) with one entry per distinct time index, ascending
+        if self.__merged is None:
+            if not self.__parts:
+                self.__merged = (np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.int64))
+            else:
+                s = np.concatenate(self.__parts)
+                times, inverse = np.unique(s["time"], return_inverse=True)
+                sums = np.zeros(len(times), dtype=np.int64)
+                np.add.at(sums, inverse, s["value"])
+                self.__merged = (times, sums)
+        return self.__merged
+
+    def dense(self, length, out=None):
+        times, sums = self.sparse()
+        if out is None:
+            out = np.zeros(length, dtype=np.int64)
+        else:
+            out = out[:length]
+            out[:] = 0
+        keep = times < length
+        out[times[keep]] = sums[keep]
+        return out
@@ -0,0 +1,204 @@
+from FF2_parms import *
+from spectrum_decoder import spectrumDecoder
+from accumulator import sweepAccumulator
+from sim_device import simulatedFF2, encodeSpectrum
+from capture import captureReplay
+from fastflight2 import FastFlight2
+import numpy as np
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+
+# Driver benchmarks. Results are written as JSON so that runs on different
+# commits can be compared with --compare; every result carries the metric,
+# its unit and whether higher or lower is better.
+#
+#   python benchmark.py -o new.json --compare old.json
+
+DECODE_LENGTHS = (16, 256, 4096, 65536, 1500000)
+DECODE_BYTES = 1 << 24          # Stream size decoded per decode measurement
+DECODE_MAX_SPECTRA = 20000
+ACCUMULATE_LENGTHS = (4096, 65536, 1500000)
+E2E_LENGTH = 10000
+E2E_CHUNKS = (1024, 8192, CHUNK_SIZE)
+E2E_SWEEPS = (1000, CHUNK_SIZE, 4*CHUNK_SIZE)
+REGRESSION_TOLERANCE = 0.10     # Relative change reported as a regression
+
+def result(bench, params, value, unit, better="higher", **extra):
+    return dict(bench=bench, params=params, value=value, unit=unit, better=better, **extra)
+
+def bestOf(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def syntheticStream(length, bits, target=DECODE_BYTES, seed=0):
+    # (stream, spectra) of back-to-back spectra whose samples use the whole
+    # range of the requested encoding
+    rng = np.random.default_rng(seed)
+    top = 0xfeff if bits == 16 else 0xfeffff
+    one = len(encodeSpectrum(np.zeros(length, dtype=np.uint32), 0, bits=bits))
+    n = max(1, min(DECODE_MAX_SPECTRA, target // one))
+    samples = rng.integers(0, top, size=length, dtype=np.uint32)
+    parts = [encodeSpectrum(samples, i & CODE_DATA_MASK, bits=bits) for i in range(n)]
+    return b"".join(parts), n
+
+def pieces(stream, bufferSize=MAX_BULK_SIZE):
+    view = memoryview(stream)
+    return [view[i:i + bufferSize] for i in range(0, len(view), bufferSize)]
+
+def decodeBuffers(buffers, length):
+    # returns the number of spectra decoded
+    dec = spectrumDecoder()
+    for b in buffers: dec.feed(b)
+    n = 0
+    while dec.decode(length) is not None: n += 1
+    return n
+
+def benchDecode(length, bits, repeat=3, target=DECODE_BYTES):
+    stream, n = syntheticStream(length, bits, target)
+    got = []
+    t = bestOf(lambda: got.append(decodeBuffers(pieces(stream), length)), repeat)
+    return result("decode", dict(length=length, bits=bits), len(stream) / t / 1e6, "MB/s",
+                  spectra=n, decoded=got[-1], spectraPerSecond=n / t)
+
+def benchCapture(path, length, repeat=3):
+    # decodes a recorded capture with its original transfer boundaries
+    with captureReplay(path) as r:
+        got = []
+        t = bestOf(lambda: got.append(decodeBuffers(r.buffers(), length)), repeat)
+        return result("decode", dict(capture=os.path.basename(path), length=length), r.size / t / 1e6, "MB/s",
+                      decoded=got[-1], spectraPerSecond=got[-1] / t,
+                      realTime=r.duration() / t if r.duration() else None)
+
+def benchAccumulate(length, dtype, chunks=64):
+    acc = sweepAccumulator(length, dtype)
+    data = np.random.default_rng(0).integers(0, 0xfeffff, size=length, dtype=np.uint32)
+    def run():
+        acc.reset(length)
+        for _ in range(chunks): acc.add(data)
+    t = bestOf(run, 3)
+    return result("accumulate", dict(length=length, dtype=np.dtype(dtype).name),
+                  t / chunks * 1e3, "ms/chunk", better="lower")
+
+def simulatedDevice(**kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return FastFlight2(dev=simulatedFF2(seed=0, **kwargs))
+
+def benchSendProtocol(ff, calls=500):
+    # Host-side cost of sendProtocol; the simulated device answers instantly,
+    # so on hardware add the control-transfer latency per transfer counted.
+    p = ff.settings.replace(recordsPerSpectrum=1000)
+    q = p.replace(recordsPerSpectrum=2000)
+    out = []
+
+    def unchanged():
+        for _ in range(calls): ff.sendProtocol(p, 0)
+    def oneField():
+        for i in range(calls): ff.sendProtocol(q if i & 1 else p, 0)
+    def full():
+        for _ in range(calls):
+            ff.forgetProtocols()
+            ff.sendProtocol(p, 0)
+
+    for case, fn in (("unchanged", unchanged), ("recordsPerSpectrum", oneField), ("full", full)):
+        ff.forgetProtocols()
+        ff.sendProtocol(p, 0)
+        out.append(result("sendProtocol", dict(change=case), bestOf(fn, 3) / calls * 1e6,
+                          "us/call", better="lower"))
+    return out
+
+def benchEndToEnd(length, chunkSize, sweeps, **simArgs):
+    ff = simulatedDevice(**simArgs)
+    ff.setChunkSize(chunkSize)
+    sim = ff.dev
+    with contextlib.redirect_stdout(io.StringIO()):
+        ff.takeSweep(length, sweeps)
+        n0 = sim.spectrumNumber
+        t0 = time.perf_counter()
+        ff.takeSweep(length, sweeps)
+        t = time.perf_counter() - t0
+    n = sim.spectrumNumber - n0
+    return result("endToEnd", dict(length=length, chunkSize=chunkSize, sweeps=sweeps),
+                  n / t, "spectra/s", recordsPerSecond=sweeps / t, bytes=sim.bytesSent)
+
+def runAll(quick=False, captures=(), captureLength=None, log=print):
+    lengths = DECODE_LENGTHS[:-1] if quick else DECODE_LENGTHS
+    target = DECODE_BYTES >> 3 if quick else DECODE_BYTES
+    results = []
+    def add(r):
+        results.append(r)
+        log(f"{r['bench']:<13}{json.dumps(r['params']):<55}{r['value']:>12.3f} {r['unit']}")
+
+    for bits in (16, 24):
+        for length in lengths: add(benchDecode(length, bits, target=target))
+    for path in captures: add(benchCapture(path, captureLength))
+    for dtype in (np.int64, np.float64):
+        for length in ACCUMULATE_LENGTHS: add(benchAccumulate(length, dtype))
+    for r in benchSendProtocol(simulatedDevice()): add(r)
+    for chunk in E2E_CHUNKS:
+        for sweeps in (E2E_SWEEPS[:2] if quick else E2E_SWEEPS):
+            add(benchEndToEnd(E2E_LENGTH, chunk, sweeps))
+    return results
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return dict(time=datetime.datetime.now().isoformat(timespec="seconds"), commit=commit,
+                python=platform.python_version(), numpy=np.__version__,
+                machine=platform.machine(), processor=platform.processor())
+
+def resultKey(r):
+    return r["bench"], json.dumps(r["params"], sort_keys=True)
+
+def compare(base, new, tolerance=REGRESSION_TOLERANCE):
+    # Results of new that are worse than base by more than tolerance, as
+    # (result, baseValue, relativeChange)
+    old = {resultKey(r): r["value"] for r in base["results"]}
+    worse = []
+    for r in new["results"]:
+        v = old.get(resultKey(r))
+        if not v: continue
+        change = (r["value"] - v) / v
+        if (change < -tolerance) if r["better"] == "higher" else (change > tolerance):
+            worse.append((r, v, change))
+    return worse
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="FastFlight 2 driver benchmarks")
+    ap.add_argument("-o", "--output", default="ff2_benchmark.json")
+    ap.add_argument("--quick", action="store_true", help="smaller streams, skip the longest records")
+    ap.add_argument("--capture", action="append", default=[], metavar="PATH",
+                    help="also decode a recorded capture (see FastFlight2.startCapture)")
+    ap.add_argument("--length", type=int, help="record length in points of the captures")
+    ap.add_argument("--compare", metavar="BASE", help="report regressions against an earlier result file")
+    ap.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    args = ap.parse_args(argv)
+    if args.capture and args.length is None: ap.error("--capture needs --length")
+
+    out = dict(environment=environment(), results=runAll(args.quick, args.capture, args.length))
+    with open(args.output, "w") as f: json.dump(out, f, indent=1)
+    print(f"Wrote {len(out['results'])} results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f: base = json.load(f)
+        worse = compare(base, out, args.tolerance)
+        for r, v, change in worse:
+            print(f"REGRESSION {r['bench']} {json.dumps(r['params'])}: {v:.3f} -> {r['value']:.3f} {r['unit']} ({change:+.0%})")
+        if worse: return 1
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
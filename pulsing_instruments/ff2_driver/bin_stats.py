@@ -0,0 +1,58 @@
+import numpy as np
+
+class binStats:
+    # Running per-bin mean and variance of the per-record signal across chunk
+    # spectra (West's weighted form of Welford's update). Each chunk is the sum
+    # of `records` traces, so it enters as its mean per record with weight
+    # records; variance() is then the spread of a single record and stderr()
+    # that of the running mean. Needs two chunks before the spread is known.
+
+    def __init__(self, length=0):
+        self.reset(length)
+
+    def reset(self, length):
+        self.length = length
+        if getattr(self, "mean", None) is None or len(self.__store[0]) < length:
+            self.__store = [np.empty(length) for _ in range(4)]
+        self.mean, self.m2, self.__x, self.__d = (a[:length] for a in self.__store)
+        self.mean[:] = 0
+        self.m2[:] = 0
+        self.weight = 0
+        self.count = 0
+
+    def add(self, data, records):
+        # data is one chunk spectrum summed over records traces
+        if records <= 0: return
+        n = min(len(data), self.length)
+        x, d = self.__x[:n], self.__d[:n]
+        mean, m2 = self.mean[:n], self.m2[:n]
+        np.divide(data[:n], records, out=x)
+        self.weight += records
+        self.count += 1
+        np.subtract(x, mean, out=d)             # x - old mean
+        mean += d * (records / self.weight)
+        x -= mean                               # x - new mean
+        d *= x
+        d *= records
+        m2 += d
+
+    def variance(self):
+        # per-record variance of every bin
+        if self.count < 2: return np.full(self.length, np.inf)
+        return self.m2 / (self.count - 1)
+
+    def stderr(self):
+        if self.count < 2: return np.full(self.length, np.inf)
+        return np.sqrt(self.variance() / self.weight)
+
+    def snr(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.abs(self.mean) / self.stderr()
+
+def stderrBelow(limit, bins=slice(None)):
+    # stop criterion: the worst standard error over bins is at most limit
+    return lambda s: s.count >= 2 and float(np.max(s.stderr()[bins])) <= limit
+
+def snrAbove(limit, bins=slice(None)):
+    # stop criterion: the median SNR over bins is at least limit
+    return lambda s: s.count >= 2 and float(np.median(s.snr()[bins])) >= limit
@@ -0,0 +1,135 @@
+from FF2_parms import *
+import threading
+import queue
+
+SYNC_MARKER = b"\xff" * 8
+
+class spectrumCounter:
+    # Counts the spectra completed in a SPECTRA_IN stream from their sync
+    # markers and the word count in their headers, without decoding them.
+    # A corrupt header only makes the count lag.
+
+    def __init__(self):
+        self.count = 0
+        self.__skip = 0         # bytes of the current spectrum still to come
+        self.__tail = b""       # start of a marker or header cut by the buffer end
+
+    def add(self, buf):
+        data = self.__tail + bytes(buf)
+        self.__tail = b""
+        pos = 0
+        while True:
+            if self.__skip:
+                s = min(self.__skip, len(data) - pos)
+                self.__skip -= s
+                pos += s
+                if self.__skip: return
+                self.count += 1
+            m = data.find(SYNC_MARKER, pos)
+            if m < 0:
+                self.__tail = data[max(pos, len(data) - 7):]
+                return
+            h = m + 8
+            if len(data) - h < 9:
+                self.__tail = data[m:]
+                return
+            if data[h] == 0xff: h += 1
+            total = int.from_bytes(data[h + 4:h + 8], "little") & CODE_DATA_MASK
+            pos = h
+            # the words after the marker: header, body and SPECTRUM_END
+            if total > 2: self.__skip = 4*(total - 2)
+
+class bulkReader:
+    # Drains SPECTRA_IN on a dedicated thread so the device FIFO keeps emptying
+    # while the caller decodes and accumulates.
+    #
+    # read() performs one bulk transfer into the next slot of ring and returns
+    # a view of it (or None on timeout). At most depth filled buffers wait in
+    # the queue; when the consumer falls behind the thread first blocks on a
+    # free ring slot and then on the queue, so the device backs up rather than
+    # the host running out of memory. stop() always returns every queued slot
+    # to the ring. With limit the thread ends once that many spectra have been
+    # read in full (see spectrumCounter); after those buffers are consumed
+    # (exhausted()) the caller reads for itself.
+
+    def __init__(self, read, ring, depth=READER_DEPTH, limit=None):
+        if len(ring) < depth + 2: raise ValueError(f"Ring of {len(ring)} slots is too small for a reader queue of depth {depth}")
+        self.read = read
+        self.ring = ring
+        self.depth = depth
+        self.limit = limit
+        self.spectra = spectrumCounter() if limit is not None else None
+        self.queue = queue.Queue(maxsize=depth)
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__error = None
+
+        self.reads = 0              # transfers queued
+        self.highWater = 0          # times the queue was found full after a put
+        self.stalls = 0             # times the thread waited for a free slot
+        self.maxDepth = 0
+
+    def start(self):
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name="FF2 bulk reader", daemon=True)
+        self.__thread.start()
+
+    def running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def __run(self):
+        try:
+            while not self.__stop.is_set() and not self.__done():
+                if not self.ring.waitFree(0):
+                    self.stalls += 1
+                    if not self.ring.waitFree(READER_POLL): continue
+                buf = self.read()
+                if buf is None: continue
+                if self.spectra is not None: self.spectra.add(buf)
+                while True:
+                    try:
+                        self.queue.put(buf, timeout=READER_POLL)
+                        break
+                    except queue.Full:
+                        if self.__stop.is_set():
+                            self.ring.release(buf)
+                            return
+                self.reads += 1
+                n = self.queue.qsize()
+                if n > self.maxDepth: self.maxDepth = n
+                if n >= self.depth: self.highWater += 1
+        except Exception as e:
+            self.__error = e
+
+    def __done(self):
+        return self.limit is not None and self.spectra.count >= self.limit
+
+    def exhausted(self):
+        # every buffer up to the limit has been handed out
+        return self.__done() and not self.running() and self.queue.empty()
+
+    def get(self):
+        # next filled buffer, in transfer order
+        while True:
+            try:
+                return self.queue.get(timeout=READER_POLL)
+            except queue.Empty:
+                if self.__error is not None: raise self.__error
+                if not self.running(): raise RuntimeError("Bulk reader is not running")
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread is not None: self.__thread.join()
+        self.__thread = None
+        while True:
+            try:
+                buf = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.ring.release(buf)
+        if self.__error is not None: raise self.__error
+        return self.stats()
+
+    def stats(self):
+        return {"reads": self.reads, "highWater": self.highWater,
+                "stalls": self.stalls, "maxDepth": self.maxDepth}
@@ -0,0 +1,77 @@
+from FF2_parms import *
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import os
+import numpy as np
+
+@lru_cache(maxsize=PROTOCOL_CACHE_SIZE)
+def calibrationKey(b1, b2):
+    # b1/b2 of the protocol with recordsPerSpectrum fixed at 1 (see
+    # calibrationStore.key); anything else that changes the encoding, e.g.
+    # record length, TPP or offset, gives a new key
+    return hashlib.sha256(b1 + b2).hexdigest()[:32]
+
+class calibrationStore:
+    # Background spectra saved per protocol in dir as <key>.npy (float64,
+    # mean volts per record, relative to the offset). Entries are memory
+    # mapped on first use and the most recently used cacheSize stay open.
+
+    def __init__(self, directory=CAL_DIR, cacheSize=CAL_CACHE_SIZE):
+        self.dir = directory
+        self.cacheSize = cacheSize
+        self.__cache = OrderedDict()
+
+    def key(self, protocol):
+        # Chunking only changes recordsPerSpectrum, and the calibration is
+        # per record, so one entry serves every chunk size.
+        p = protocol.replace(recordsPerSpectrum=1)
+        return calibrationKey(p.b1, p.b2)
+
+    def path(self, key):
+        return os.path.join(self.dir, key + ".npy")
+
+    def __remember(self, key, cal):
+        self.__cache[key] = cal
+        self.__cache.move_to_end(key)
+        while len(self.__cache) > self.cacheSize: self.__cache.popitem(last=False)
+
+    def __contains__(self, protocol):
+        key = self.key(protocol)
+        return key in self.__cache or os.path.exists(self.path(key))
+
+    def load(self, protocol):
+        # the calibration for protocol, or None if none was saved
+        key = self.key(protocol)
+        cal = self.__cache.get(key)
+        if cal is not None:
+            self.__cache.move_to_end(key)
+            return cal
+        try:
+            cal = np.load(self.path(key), mmap_mode='r')
+        except FileNotFoundError:
+            return None
+        self.__remember(key, cal)
+        return cal
+
+    def save(self, protocol, cal):
+        key = self.key(protocol)
+        os.makedirs(self.dir, exist_ok=True)
+        tmp = self.path(key) + ".tmp"
+        with open(tmp, "wb") as f: np.save(f, np.asarray(cal, dtype=np.float64))
+        # a half written file must never be picked up by load()
+        self.__cache.pop(key, None)
+        os.replace(tmp, self.path(key))
+        return self.load(protocol)
+
+    def discard(self, protocol):
+        key = self.key(protocol)
+        self.__cache.pop(key, None)
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        # drops the in-memory copies only
+        self.__cache.clear()
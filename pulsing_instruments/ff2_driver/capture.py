@@ -0,0 +1,114 @@
+from FF2_parms import *
+from spectrum_decoder import spectrumDecoder
+import mmap
+import os
+import time
+import numpy as np
+
+# One index record per bulk buffer: where it starts in the capture, how long it
+# is and the wall-clock time it arrived
+CAPTURE_INDEX = np.dtype([("offset", "<u8"), ("length", "<u4"), ("time", "<f8")])
+CAPTURE_INDEX_BATCH = 1024      # Index records held before they are written out
+
+def indexPath(path):
+    return path + ".idx"
+
+class captureWriter:
+    # Appends raw SPECTRA_IN buffers to a capture file exactly as they were
+    # read, and their offsets and arrival times to a side index. Buffers are
+    # written straight from the ring slot; index records are batched.
+
+    def __init__(self, path):
+        self.path = path
+        self.__data = open(path, "ab")
+        self.__index = open(indexPath(path), "ab")
+        self.__pending = np.zeros(CAPTURE_INDEX_BATCH, dtype=CAPTURE_INDEX)
+        self.__n = 0
+        self.offset = self.__data.tell()
+        self.buffers = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, buf):
+        if buf is None or len(buf) == 0: return
+        self.__data.write(buf)
+        r = self.__pending[self.__n]
+        r["offset"], r["length"], r["time"] = self.offset, len(buf), time.time()
+        self.__n += 1
+        self.offset += len(buf)
+        self.buffers += 1
+        if self.__n == CAPTURE_INDEX_BATCH: self.flush()
+
+    def flush(self):
+        # index records only ever describe data that is already on disk
+        self.__data.flush()
+        self.__index.write(self.__pending[:self.__n].tobytes())
+        self.__index.flush()
+        self.__n = 0
+
+    def close(self):
+        if self.__data.closed: return
+        self.flush()
+        self.__data.close()
+        self.__index.close()
+
+class captureReplay:
+    # Memory-maps a capture and hands its buffers back with their original
+    # boundaries, without copying. Views returned by buffers() point into the
+    # map, so drop them (and reset any decoder fed with them) before close().
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.__file = open(path, "rb")
+        self.map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        try:
+            index = np.fromfile(indexPath(path), dtype=CAPTURE_INDEX)
+            # a capture cut short may have records past the end of the data
+            index = index[index["offset"] + index["length"] <= self.size]
+        except FileNotFoundError:
+            print(f"No index for capture \"{path}\"; replaying in {MAX_BULK_SIZE} byte pieces")
+            offsets = np.arange(0, self.size, MAX_BULK_SIZE, dtype=np.uint64)
+            index = np.zeros(len(offsets), dtype=CAPTURE_INDEX)
+            index["offset"] = offsets
+            index["length"] = np.minimum(MAX_BULK_SIZE, self.size - offsets)
+        self.index = index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def duration(self):
+        # seconds between the first and last recorded buffer
+        if len(self.index) < 2: return 0.
+        return float(self.index["time"][-1] - self.index["time"][0])
+
+    def buffers(self, start=0, stop=None):
+        view = memoryview(self.map) if self.map is not None else memoryview(b"")
+        try:
+            for off, n in zip(self.index["offset"][start:stop].tolist(), self.index["length"][start:stop].tolist()):
+                yield view[off:off + n]
+        finally:
+            view.release()
+
+    def spectra(self, length, decoder=None):
+        # Decodes the whole capture as fast as possible, yielding (index, data)
+        # per spectrum like getSpectrum does
+        dec = decoder if decoder is not None else spectrumDecoder()
+        for buf in self.buffers():
+            dec.feed(buf)
+            while (res := dec.decode(length)) is not None: yield res
+        dec.reset()
+
+    def close(self):
+        if self.map is not None: self.map.close()
+        self.__file.close()
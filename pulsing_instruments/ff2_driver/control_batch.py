@@ -0,0 +1,61 @@
+import usb.core
+
+MEMORY, PARAMETER = "memory", "parameter"
+
+class controlBatch:
+    # Queues setMemory/setParameter writes and submits them when the
+    # with-block ends, reporting failures once at the end instead of per write.
+    # A write identical to the one queued just before it is dropped, unless it
+    # is marked repeat=True because the hardware needs to see it twice.
+    #
+    # Only parameter writes are pipelined. Memory writes are vendor control
+    # transfers, which pyusb can only issue synchronously, so each one is
+    # still a full round trip; batching them does not make arming faster.
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.ops = []
+        self.failures = []
+        self.coalesced = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None: self.submit()
+        return False
+
+    def __queue(self, op, repeat):
+        if not repeat and self.ops and self.ops[-1] == op:
+            self.coalesced += 1
+            return
+        self.ops.append(op)
+
+    def setMemory(self, address, val, repeat=False):
+        self.__queue((MEMORY, address, val), repeat)
+
+    def setParameter(self, param, val, repeat=False):
+        self.__queue((PARAMETER, param, val), repeat)
+
+    def submit(self):
+        # runs of parameter writes go out through one ack batch; memory
+        # writes go one at a time
+        ops, self.ops = self.ops, []
+        i = 0
+        while i < len(ops):
+            j = i + 1
+            if ops[i][0] == PARAMETER:
+                while j < len(ops) and ops[j][0] == PARAMETER: j += 1
+            try:
+                if ops[i][0] == MEMORY:
+                    self.dev.writeMemory(ops[i][1], ops[i][2])
+                else:
+                    self.dev.writeParameters([(p, v) for _, p, v in ops[i:j]])
+            except usb.core.USBError as e:
+                self.failures.append((ops[i], e))
+            i = j
+
+        if self.failures:
+            (kind, target, val), e = self.failures[0]
+            print(f"{len(self.failures)} of {len(ops)} batched control writes failed; first was {kind} 0x{target:x} = 0x{val:02x}: {e}")
+        return not self.failures
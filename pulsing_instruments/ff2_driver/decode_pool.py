@@ -0,0 +1,353 @@
+from FF2_parms import *
+from spectrum_decoder import spectrumDecoder, codeType_t, codeTypeOf
+from accumulator import sweepAccumulator
+from metrics import driverMetrics, mergeCounters
+from multiprocessing import shared_memory
+from collections import deque
+import multiprocessing as mp
+import itertools
+import queue
+import os
+import re
+import time
+import numpy as np
+
+SYNC_MARKER = b"\xff" * 8
+SYNC_SEARCH = re.compile(re.escape(SYNC_MARKER))    # searches the shared block in place
+PROTOCOL_PEEK = 16          # Words after the header searched for the PROTOCOL code
+
+def poolWorker(inName, size, tasks, results):
+    # Decodes whole spectra out of the shared input slots and keeps a partial
+    # sum of them; only slot numbers and offsets travel through the queues.
+    shm = shared_memory.SharedMemory(name=inName)
+    mem = shm.buf
+    metrics = driverMetrics()
+    dec = spectrumDecoder(metrics)
+    acc = sweepAccumulator()
+    spectrum = np.empty(0, dtype=dec.dtype)
+    count = 0
+    decoded = (0, 0.)       # decoder bytes and seconds at the last reset
+    try:
+        while True:
+            msg = tasks.get()
+            if msg is None: break
+            try:
+                if msg[0] == "reset":
+                    _, length, dtype, spectrumType = msg
+                    acc.reset(length, dtype)
+                    metrics.reset()
+                    decoded = (dec.bytesDecoded, dec.decodeTime)
+                    if dec.dtype != np.dtype(spectrumType):
+                        dec.setDtype(spectrumType)
+                        spectrum = np.empty(0, dtype=dec.dtype)
+                    count = 0
+                elif msg[0] == "spectrum":
+                    _, tag, segments, length = msg
+                    for slot, a, b in segments: dec.feed(mem[slot*size + a:slot*size + b])
+                    if len(spectrum) < length: spectrum = np.empty(length, dtype=dec.dtype)
+                    res = dec.decode(length, spectrum)
+                    if res is not None:
+                        metrics.count("decode.spectra")
+                        acc.add(res[1])
+                        acc.addSticks(dec.sticks)
+                        count += 1
+                    results.put(("done", tag, None if res is None else res[0], dec.timestamp))
+                    dec.reset()
+                elif msg[0] == "flush":
+                    _, name, worker = msg
+                    out = shared_memory.SharedMemory(name=name)
+                    dst = np.ndarray(acc.length, dtype=acc.buf.dtype, buffer=out.buf)
+                    dst[:] = acc.buf
+                    del dst
+                    out.close()
+                    results.put(("flushed", worker, acc.buf.dtype.str, count, metrics.counters,
+                                 dec.bytesDecoded - decoded[0], dec.decodeTime - decoded[1]))
+            except Exception as e:
+                dec.reset()
+                results.put(("error", f"{type(e).__name__}: {e}"))
+    finally:
+        dec.reset()
+        del mem
+        shm.close()
+
+class decodePool:
+    # Decodes and pre-accumulates chunk spectra in worker processes. The main
+    # process copies each bulk buffer once into a slot of a shared memory
+    # block, finds spectrum boundaries from the sync marker and the length
+    # word of each header, and hands every whole spectrum to the least busy
+    # worker as a list of (slot, start, end). Workers return their partial
+    # sums through per-worker shared memory when the sweep is over.
+    #
+    # Device timing and the planner's rates are recorded as in the serial
+    # path; bin statistics need every chunk here and are not kept (see
+    # FastFlight2.takeSweep).
+
+    def __init__(self, workers=None, poolBytes=DECODE_POOL_BYTES, size=MAX_BULK_SIZE):
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.size = size
+        self.slots = max(4, poolBytes // size)
+        ctx = mp.get_context("spawn")
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slots*size)
+        self.mem = np.ndarray(self.slots*size, dtype=np.uint8, buffer=self.shm.buf)
+        self.results = ctx.Queue()
+        self.tasks = [ctx.Queue() for _ in range(self.workers)]
+        self.procs = [ctx.Process(target=poolWorker, args=(self.shm.name, size, q, self.results),
+                                  name=f"FF2 decoder {i}", daemon=True)
+                      for i, q in enumerate(self.tasks)]
+        for p in self.procs: p.start()
+        self.outs = [None] * self.workers
+        self.failed = 0
+        self.chunkTimes = []        # [(arrival time, records)] of the last sweep
+        self.decoded = (0, 0.)      # (bytes, seconds) the workers spent decoding it
+        self.__reset()
+
+    def __reset(self):
+        self.__free = deque(range(self.slots))
+        self.__refs = [0] * self.slots
+        self.__bufs = deque()       # [slot, filled] not yet split off, oldest first
+        self.__head = 0             # consumed bytes of __bufs[0]
+        self.__tasks = {}
+        self.__load = [0] * self.workers
+        self.__tags = itertools.count()
+
+    def __len__(self):
+        return self.workers
+
+    # Splitting the stream
+
+    def __buffered(self):
+        return sum(n for _, n in self.__bufs) - self.__head
+
+    def __peek(self, off, k):
+        # k bytes starting off bytes past the head, or None if not yet read
+        out = bytearray()
+        off += self.__head
+        for slot, n in self.__bufs:
+            if off < n:
+                take = min(n - off, k - len(out))
+                base = slot*self.size + off
+                out += self.mem[base:base + take].tobytes()
+                if len(out) == k: return bytes(out)
+                off = 0
+            else:
+                off -= n
+        return None
+
+    def __find(self):
+        # offset past the head of the next sync marker, or -1; each slot is
+        # searched in place and only the bytes around slot boundaries copied
+        pos, tail, off = 0, b"", self.__head
+        for slot, n in self.__bufs:
+            base = slot*self.size
+            if tail:
+                m = (tail + self.mem[base + off:base + min(n, off + 7)].tobytes()).find(SYNC_MARKER)
+                if m >= 0: return pos - len(tail) + m
+            m = SYNC_SEARCH.search(self.shm.buf, base + off, base + n)
+            if m: return pos + m.start() - base - off
+            tail = (tail + self.mem[max(base + off, base + n - 7):base + n].tobytes())[-7:]
+            pos += n - off
+            off = 0
+        return -1
+
+    def __consume(self, k, hold=False):
+        # Drops k bytes from the head; returns their (slot, start, end) spans
+        # and, with hold, keeps the slots referenced until the task is done.
+        spans = []
+        while k > 0:
+            slot, n = self.__bufs[0]
+            take = min(n - self.__head, k)
+            if hold:
+                spans.append((slot, self.__head, self.__head + take))
+                self.__refs[slot] += 1
+            self.__head += take
+            k -= take
+            if self.__head == n:
+                self.__bufs.popleft()
+                self.__head = 0
+                self.__unref(slot, 0)
+        return spans
+
+    def __unref(self, slot, n=1):
+        self.__refs[slot] -= n
+        if self.__refs[slot] == 0 and not any(s == slot for s, _ in self.__bufs): self.__free.append(slot)
+
+    def __nextSpectrum(self, length):
+        # (segments, slot) of the next whole spectrum, or None until enough of
+        # the stream has been read
+        while True:
+            have = self.__buffered()
+            if have < 8: return None
+            if self.__peek(0, 8) != SYNC_MARKER:
+                # lost sync; search the buffered bytes for the next marker
+                pos = self.__find()
+                if pos < 0:
+                    self.__consume(have - 7)
+                    return None
+                self.__consume(pos)
+                continue
+
+            head = self.__peek(8, 9)
+            if head is None: return None
+            ninth = 1 if head[0] == 0xff else 0
+            t, u = np.frombuffer(head[ninth:ninth + 8], dtype='<u4').tolist()
+            words = u & CODE_DATA_MASK
+            if (codeTypeOf(t) != codeType_t.SPECTRUM_BEGIN or codeTypeOf(u) != codeType_t.SPECTRUM_BEGIN
+                    or not 5 <= words <= 64 + length):
+                print(f"Corrupt spectrum header 0x{t:08x} 0x{u:08x}; resyncing")
+                self.__consume(1)
+                continue
+
+            total = 4*words + ninth
+            if have < total: return None
+            slot = -1
+            body = self.__peek(16 + ninth, 4*min(PROTOCOL_PEEK, words - 5))
+            for w in np.frombuffer(body, dtype='<u4').tolist():
+                if codeTypeOf(w) == codeType_t.PROTOCOL:
+                    slot = w & CODE_DATA_MASK
+                    break
+            return self.__consume(total, hold=True), slot
+
+    # Workers
+
+    def __handle(self, msg):
+        if msg[0] == "error": raise RuntimeError(f"Decode worker failed: {msg[1]}")
+        if msg[0] != "done": return None
+        _, tag, index, timestamp = msg
+        if tag not in self.__tasks: return None      # left over from an aborted sweep
+        worker, spans, records = self.__tasks.pop(tag)
+        self.__load[worker] -= 1
+        for slot, _, _ in spans: self.__unref(slot)
+        return index, records, tag, timestamp
+
+    def __collect(self, block):
+        # results of finished spectra as (index or None, records, tag, timestamp)
+        out = []
+        if block and not all(p.is_alive() for p in self.procs): raise RuntimeError("A decode worker exited")
+        try:
+            msg = self.results.get(timeout=READER_POLL) if block else self.results.get_nowait()
+            while True:
+                r = self.__handle(msg)
+                if r is not None: out.append(r)
+                msg = self.results.get_nowait()
+        except queue.Empty:
+            pass
+        return out
+
+    def __dispatch(self, segments, length, records):
+        w = min(range(self.workers), key=self.__load.__getitem__)
+        tag = next(self.__tags)
+        self.__tasks[tag] = (w, segments, records)
+        self.__load[w] += 1
+        self.tasks[w].put(("spectrum", tag, segments, length))
+
+    def __gather(self, length):
+        # partial sums of every worker, as arrays viewing their shared memory
+        need = max(8, length * 8)
+        for i in range(self.workers):
+            if self.outs[i] is None or self.outs[i].size < need:
+                if self.outs[i] is not None:
+                    self.outs[i].close()
+                    self.outs[i].unlink()
+                self.outs[i] = shared_memory.SharedMemory(create=True, size=need)
+            self.tasks[i].put(("flush", self.outs[i].name, i))
+        flushed = [None] * self.workers
+        counters = {}
+        self.decoded = (0, 0.)
+        while None in flushed:
+            msg = self.results.get(timeout=10.)
+            if msg[0] == "flushed":
+                flushed[msg[1]] = np.dtype(msg[2])
+                mergeCounters(counters, msg[4])
+                self.decoded = (self.decoded[0] + msg[5], self.decoded[1] + msg[6])
+            else:
+                self.__handle(msg)
+        dtype = np.dtype(np.float64) if any(d.kind == 'f' for d in flushed) else np.dtype(np.int64)
+        return [np.ndarray(length, dtype=d, buffer=o.buf) for d, o in zip(flushed, self.outs)], dtype, counters
+
+    def sweep(self, dev, length, sweeps, beforeArm=None):
+        # FastFlight2.takeSweep with decoding spread over the pool; returns
+        # (index, sums) in dev.acc like the serial path
+        self.__reset()
+        for q in self.tasks: q.put(("reset", length, dev.acc.dtype.str, dev.decoder.dtype.str))
+        final = dev.prepareSweep(sweeps)
+        if beforeArm is not None: beforeArm()
+        dev.startAquisition()
+
+        dev.timing.reset()
+        self.chunkTimes = []
+        stamps = []             # (tag, timestamp, records); workers finish out of order
+        taken = confirmed = 0
+        l1 = None
+        switched = -1
+        try:
+            while confirmed < sweeps:
+                wait = taken >= sweeps
+                if not wait:
+                    if switched != taken:
+                        switched = taken
+                        if dev.switchDue(taken, final, sweeps): dev.selectFinal()
+
+                    spec = self.__nextSpectrum(length)
+                    if spec is not None:
+                        segments, slot = spec
+                        records = dev.chunkRecords(slot, final, sweeps)
+                        self.__dispatch(segments, length, records)
+                        taken += records
+                        continue
+                    if self.__free:
+                        buf = dev.readNext()
+                        if buf is None: continue
+                        slot = self.__free.popleft()
+                        n = len(buf)
+                        self.mem[slot*self.size:slot*self.size + n] = np.frombuffer(buf, dtype=np.uint8)
+                        dev.db.release(buf)
+                        self.__bufs.append((slot, n))
+                        continue
+                    wait = True     # every slot is waiting to be decoded
+
+                for index, records, tag, timestamp in self.__collect(wait):
+                    if index is None:
+                        # the worker could not decode it; the device keeps going
+                        self.failed += 1
+                        dev.metrics.count("pool.failed")
+                        taken -= records
+                        continue
+                    confirmed += records
+                    stamps.append((tag, timestamp, records))
+                    self.chunkTimes.append((time.perf_counter(), records))
+                    if l1 is None:
+                        l1 = index
+                    elif index != l1:
+                        print(f"Trace length mismatch: {index} != {l1}")
+                        dev.metrics.count("sweep.lengthMismatch")
+        finally:
+            for _, timestamp, records in sorted(stamps): dev.timing.add(timestamp, records)
+            dev.recordTiming()
+            dev.stopAquisition()
+
+        parts, dtype, counters = self.__gather(length)
+        # the acquisition's metrics were snapshotted when it stopped; the
+        # workers' decoder counters belong with them
+        mergeCounters(dev.sweepMetrics["counters"], counters)
+        if confirmed != sweeps:
+            print(f"Accidentally took too many sweeps ({confirmed} > {sweeps})")
+            mergeCounters(dev.sweepMetrics["counters"], {"sweep.extraRecords": confirmed - sweeps})
+        dev.acc.reset(length, None)
+        if dtype.kind == 'f': dev.acc.toFloat()
+        for p in parts: dev.acc.add(p)
+        del parts
+        dev.setRecords(confirmed)
+        return l1, dev.applyCalibration(dev.acc.buf, length)
+
+    def close(self):
+        for q in self.tasks: q.put(None)
+        for p in self.procs: p.join(5)
+        for p in self.procs:
+            if p.is_alive(): p.terminate()
+        for o in self.outs:
+            if o is not None:
+                o.close()
+                o.unlink()
+        del self.mem
+        self.shm.close()
+        self.shm.unlink()
@@ -1,28 +1,182 @@
 from usb_interface import usbInterface
+from spectrum_decoder import spectrumDecoder, codeType_t, codeTypeOf
+from ring_buffer import ringBuffer
+from bulk_reader import bulkReader
+from transfer_engine import transferEngine
+from accumulator import sweepAccumulator, stickAccumulator
+from sparse import sparseAccumulator
+from control_batch import controlBatch
+from capture import captureWriter
+from decode_pool import decodePool
+from bin_stats import binStats
+from planner import acquisitionPlanner
+from metrics import driverMetrics
+from calibration_store import calibrationStore
+from timing import acquisitionTiming
+from interleave import interleavedSweep
+from slot_cache import protocolSlots
 from FF2_parms import *
 import usb.core
 import math
 from enum import IntEnum
 import errno
 import os
+import time
+import hashlib
 from warnings import warn
-
-def memcmp(a, b): return bytes(a) == bytes(b)
-def firstByte(a): return (a & 0xff000000)>>24
-def secondByte(a): return (a & 0x00ff0000)>>16
-def thirdByte(a): return (a & 0x0000ff00)>>8
-def fourthByte(a): return (a & 0x000000ff)
+from collections import namedtuple
+from functools import lru_cache
+import numpy as np
+
+# Time per point in ns for each Protocol.TPP code
+TPP_NS = {0x10: 0.25, 0x20: 0.5, 0x40: 1.0, 0x80: 2.0}
+
+@lru_cache(maxsize=PROTOCOL_CACHE_SIZE)
+def encodeProtocol(key):
+    # key is Protocol.key, already quantized; returns the (b1, b2) blocks
+    (recordLength, voltageOffset, timeOffset, recordsPerSpectrum, precisionEnhancer,
+     tpp, compression, ringingProtection, sensitivity, minimumThreshold,
+     backgroundInterval, adjacentBackground, correlatedSubtraction, minimumPeak,
+     maximumPeak, singleIonLength, singleIonStart) = key
+    b1 = bytearray(0x0d)  # 13 bytes
+    b2 = bytearray(0x12)  # 18 bytes
+    tp = TPP_NS[tpp]
+    points = int(round(recordLength / tp))
+
+    # Stuff b1
+    divider = int(0x10 * 0.5 / tp)
+    b1[0] = (points // divider) & 0xff
+    b1[1] = (points // (divider * 0x100)) & 0xff
+
+    toi = int(timeOffset / 16.0)
+    b1[3] = toi & 0xff
+    b1[4] = (toi // 0x100) & 0xff
+    b1[5] = recordsPerSpectrum & 0xff
+    b1[6] = (recordsPerSpectrum // 0x100) & 0xff
+
+    i = int(round(((voltageOffset + 0.25) / 0.5) * 65535.))
+    b1[8] = i & 0x00ff
+    b1[9] = (i & 0xff00) // 0x100
+
+    b1[0xb] = {0x10: 0, 0x20: 0x01, 0x40: 0x02, 0x80: 0x03}[tpp]
+    b1[0xc] = 1 if precisionEnhancer else 0
+
+    # Stuff b2
+    b2[0] = compression | tpp
+    b2[1] = ringingProtection * 0x10 | sensitivity
+    b2[2] = 0x0a
+    b2[3] = 0x00
+    b2[4] = 0x30
+    b2[5] = (backgroundInterval // 4) & 0xff
+    b2[6] = (adjacentBackground & 0x7f) | (0x80 if correlatedSubtraction else 0)
+
+    points = (points // 8) * 8 - 2
+
+    b2[7] = 0x64
+    b2[8] = 0x04
+    b2[9] = points & 0xff
+    b2[0xa] = (points // 0x100) & 0xff
+    b2[0xb] = (points // 0x10000) & 0x1f
+
+    # Peak detection for PEAK_ONLY and STICK. The layout of these four bytes
+    # is inferred, not from vendor captures, so FastFlight2 only sends such
+    # protocols to the simulator; LOSSLESS leaves them zero as the vendor
+    # software does.
+    if compression != 0x1:
+        b2[0x0c] = minimumThreshold & 0xff
+        b2[0x0d] = minimumPeak & 0xff
+        b2[0x0e] = (maximumPeak // 4) & 0xff
+        b2[0x0f] = (int(round(singleIonLength / tp)) // 4) & 0xff
+    b2[0x10] = recordsPerSpectrum & 0xff
+    b2[0x11] = (recordsPerSpectrum // 0x100) & 0xff
+    return bytes(b1), bytes(b2)
+
+@lru_cache(maxsize=None)
+def readFirmwareImage(fname):
+    with open(os.path.join(FPGA_DIR, fname), 'rb') as f:
+        return f.read()
+
+def firmwareHash():
+    # identifies the full set of images (and load order) __sendFirmware uploads
+    h = hashlib.sha256()
+    for chip, fname in FPGA_IMAGES:
+        data = readFirmwareImage(fname)
+        h.update(bytes([chip]) + fname.encode() + len(data).to_bytes(4, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+def changedRanges(old, new):
+    # [start, end) spans of bytes that differ, merged across gaps shorter than
+    # the cost of another control transfer
+    diff = [i for i in range(len(new)) if old is None or old[i] != new[i]]
+    spans = []
+    for i in diff:
+        if spans and i - spans[-1][1] < PROTOCOL_MERGE_GAP:
+            spans[-1][1] = i + 1
+        else:
+            spans.append([i, i + 1])
+    return spans
+
+@lru_cache(maxsize=PROTOCOL_CACHE_SIZE)
+def timeAxis(tpp, timeOffset, length):
+    # seconds of every point of a record (tpp and timeOffset in ns); shared
+    # between callers, so read-only
+    t = np.arange(length, dtype=np.float64)
+    t *= tpp * 1e-9
+    t += timeOffset * 1e-9
+    t.flags.writeable = False
+    return t
+
+# One decoded chunk spectrum; sweeps is the running record count for the
+# acquisition, sticks the peaks of a STICK mode chunk and timestamp the device
+# time (TIME_TICK counts since the timer reset) at which it was closed
+spectrumChunk = namedtuple("spectrumChunk", ["index", "data", "slot", "sweeps", "spectrumNumber", "sticks",
+                                             "timestamp"])
 
 class FastFlight2(usbInterface):
-    def __init__(self):
-        super().__init__(FF2_VID, FF2_PID)
+    def __init__(self, dev=None, serial=None):
+        # dev replaces the USB lookup, e.g. FastFlight2(dev=simulatedFF2());
+        # serial selects a unit when several are connected (see listSerials)
+        super().__init__(FF2_VID, FF2_PID, dev=dev, serial=serial)
         self.defaultTimeout = 500 # 500 ms
 
+        self.simulated = getattr(self.dev, "simulated", False)
         self.lastfile = -1
-        self.db = self.dataBuffer()
+        self.db = ringBuffer()
+        self.metrics = driverMetrics()
+        self.sweepMetrics = None                        # metrics.snapshot() taken as the last acquisition stopped
+        self.timing = acquisitionTiming()               # chunk timestamps of the last iterSpectra acquisition
+        self.timerReset = time.perf_counter()           # host time of the last resetTimer
+        self.decoder = spectrumDecoder(self.metrics)
+        self.chunkBuffer = np.empty(0, dtype=self.decoder.dtype)   # reused by takeSweep for every chunk
+        self.reader = None
+        self.readerStats = None
+        self.backgroundRead = False
+        self.readAheadLimit = None                      # spectra the reader may take in the next acquisition
+        self.engine = None
+        self.inflight = 0
+        self.capture = None
+        self.pool = None
+        self.acc = sweepAccumulator()
+        self.sticks = stickAccumulator()                # sparse sums of the last STICK mode sweep
+        self.sparseAcc = sparseAccumulator()            # takeSweep sums while decoding sparse
+        self.interleaved = None                         # last takeInterleaved run
+        self.chunkSize = CHUNK_SIZE                     # records per chunk spectrum in long sweeps
+        self.stats = binStats()
+        self.trackStats = False
+        self.planner = None
+        self.plan = None
+        self.bytesRead = 0
+        self.readTime = 0.
+        self.backgroundCal = []                         # explicit background (volts/record); overrides the store
+        self.calibrations = calibrationStore()
+        self.useCalibration = False                     # subtract the stored background for the current settings
+        self.armTime = 0.                               # seconds spent in the last startAquisition
         self.settings = self.Protocol()
         self.maxProtocol = 16
-        self.lastSent = [self.Protocol() for _ in range(self.maxProtocol)]
+        self.slots = protocolSlots(self.maxProtocol)    # Protocol held by each slot
+        self.sweepSlots = (0, 0)                        # chunk and remainder slots of the sweep prepared last
+        self.invalidateShadow()
 
         self.__init()
         self.setTraceLength(TRAC_LEN)
@@ -34,52 +188,48 @@ class FastFlight2(usbInterface):
         self.setTriggerRising(True)
         self.setRapidProtocolSelection(True)
 
-    def __sendFile(self, fname):
-        batch = firstbatch = rest = 0x20
-        hunk_count = 0
+    def __ackBatch(self, cmds):
+        # Writes every command before collecting their one-byte acks, so the
+        # device sees them back to back instead of one round trip each.
+        self.metrics.count("control.ackBatches")
+        for c in cmds: self.Write(CONTROL_OUT, c, 500)
+        acks = bytearray()
+        while len(acks) < len(cmds):
+            acks += bytes(self.Read(CONTROL_IN, len(cmds) - len(acks)))
+        return acks
 
-        buf = bytearray(rest)
+    def __sendFile(self, fname):
         n = os.path.join(FPGA_DIR, fname)
-        print(f"Sending file \"{n}\" to chip {self.lastfile:x}")
-
         try:
-            with open(n, 'rb') as f:
-                buf[0] = self.lastfile + 1
-                s = f.read(firstbatch - 1)
-                buf[1:len(s) + 1] = s
-                print(f"Writing hunk 0x{hunk_count:06x}\r", end="")
-                self.Write(CONTROL_OUT, buf[:len(s) + 1], 500)
-                ret = self.Read(CONTROL_IN, 1)
-                assert(ret[0] == 0)
-                if len(s) != firstbatch - 1: return
-
-                while True:
-                    s = f.read(rest - 1)
-                    if not s: break
-                    if hunk_count % 0x10 == 0:
-                        print(f"Writing hunk 0x{hunk_count:06x}\r", end="")
-                        hunk_count+=1
-
-                        buf[1:len(s)+1] = s
-                        self.dev.write(self.control_out, buf[:len(s)+1])
-                        ret = self.dev.read(self.control_in, 1)
-                        assert ret[0] == 0
-            
-            print(f"Writing hunk.......... Done ({hunk_count} hunks)")
-        
+            data = readFirmwareImage(fname)
         except IOError as e:
             if e.errno == errno.ENOENT:
                 raise IOError(f"Unable to open FPGA file \"{n}\": {os.strerror(e.errno)}")
             else:
                 raise
 
+        print(f"Sending file \"{n}\" to chip {self.lastfile:x}")
+        head = bytes([self.lastfile + 1])
+        step = FPGA_HUNK_SIZE - 1
+        hunks = [head + data[i:i + step] for i in range(0, len(data), step)] or [head]
+        self.metrics.count("control.firmwareHunks", len(hunks))
+        for i in range(0, len(hunks), FPGA_ACK_BATCH):
+            if i % 0x100 == 0: print(f"Writing hunk 0x{i:06x}\r", end="")
+            acks = self.__ackBatch(hunks[i:i + FPGA_ACK_BATCH])
+            bad = [k for k, a in enumerate(acks) if a != 0]
+            if bad: raise IOError(f"FPGA file \"{n}\" rejected at hunk 0x{i + bad[0]:06x} (ack 0x{acks[bad[0]]:02x})")
+        
+        print(f"Writing hunk.......... Done ({len(hunks)} hunks)")
+
     def __sendFirmware(self):
-        buf = bytearray(8)
-        right = bytearray([0x42, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff])
-        self.Control(usb.util.CTRL_TYPE_VENDOR | 
-                     usb.util.CTRL_RECIPIENT_DEVICE | 
-                     usb.util.CTRL_IN,
-                     0xa2, 0xfff0, 0, buf)
+        self.forgetProtocols()
+        self.lastfile = -1
+        right = bytes([0x42, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff])
+        self.metrics.count("control.firmware")
+        buf = bytes(self.Control(usb.util.CTRL_TYPE_VENDOR | 
+                                 usb.util.CTRL_RECIPIENT_DEVICE | 
+                                 usb.util.CTRL_IN,
+                                 0xa2, 0xfff0, 0, len(right)))
         if buf != right:
             print("Unexpected Response Sending Firmware\n")
             print("Expected: ")
@@ -87,47 +237,51 @@ class FastFlight2(usbInterface):
             print("Got: ")
             self.binaryDump(buf)
 
-        self.__setupFile(0x4)
-        self.__sendFile("AcqControl.rbf")
-        
-        self.__setupFile(0x6)
-        self.__sendFile("pipes.rbf")
-        self.__sendFile("pipes.rbf")
-        self.__sendFile("pipes.rbf")
-        self.__sendFile("pipes4P2.rbf")
-
-        self.__setupFile(0x8)
-        self.__sendFile("compressionfpga.rbf")
+        for chip, fname in FPGA_IMAGES:
+            self.__setupFile(chip)
+            self.__sendFile(fname)
 
-        self.__setupFile(0xc)
-        self.__sendFile("00_AnalogFPGA.rbf")
-        self.__sendFile("TrigProcFPGA.rbf")
+        self.metrics.count("control.firmware", 4)
+        acks = self.__ackBatch([bytes([0xe, v]) for v in (0xdf, 0xd7, 0x95, 0x00)])
+        assert not any(acks), f"Unexpected acks {acks.hex()} finishing firmware"
 
-        self.__setupFile(0xa)
-        self.__sendFile("fanout.bin")
+        self.__strangeDance()
 
-        buf = bytearray([0xe, 0xdf])
-        self.Write(CONTROL_OUT, buf)
-        ret = self.Read(CONTROL_IN, 1)
-        assert(ret == 0)
-        buf[1] = bytes(0xd7)
-        self.Write(CONTROL_OUT, buf)
-        ret = self.Read(CONTROL_IN, 1)
-        assert(ret == 0)
-        buf[1] = bytes(0x95)
-        self.Write(CONTROL_OUT, buf)
-        ret = self.Read(CONTROL_IN, 1)
-        assert(ret == 0)
-        buf[1] = bytes(0x00)
-        self.Write(CONTROL_OUT, buf)
-        ret = self.Read(CONTROL_IN, 1)
-        assert(ret == 0)
+    def firmwareStampPath(self):
+        try:
+            serial = self.getSerialNumber()
+        except (usb.core.USBError, ValueError):
+            serial = "unknown"
+        return os.path.join(STATE_DIR, f"loaded_{serial}.sha256")
+
+    def needsFirmware(self):
+        # A device that reports itself initialized is only reflashed when we
+        # know it was last loaded from a different set of images. Missing
+        # images or an unreadable stamp raise.
+        if not self.isInitialized(): return True
+        try:
+            with open(self.firmwareStampPath()) as f:
+                stamp = f.read().strip()
+        except FileNotFoundError:
+            # loaded by something that left no stamp (the vendor software,
+            # an older driver); keep it, as before stamps existed
+            return False
+        return stamp != firmwareHash()
 
-        self.__strangeDance()
+    def loadFirmware(self):
+        self.__sendFirmware()
+        self.invalidateShadow()
+        try:
+            os.makedirs(STATE_DIR, exist_ok=True)
+            with open(self.firmwareStampPath(), "w") as f:
+                f.write(firmwareHash() + "\n")
+        except OSError as e:
+            warn(f"Could not record loaded firmware hash: {e}")
 
     def __setupFile(self, chip):
         if chip == self.lastfile: return
         self.lastfile = chip
+        self.metrics.count("control.firmware")
         buf = bytes([chip])
         self.Write(CONTROL_OUT, buf)
         resp = self.Read(CONTROL_IN, 1)
@@ -136,60 +290,36 @@ class FastFlight2(usbInterface):
     def __init(self):
         self.dev.clear_halt(CONTROL_OUT)
         self.dev.clear_halt(CONTROL_IN)
-        if not self.isInitialized():
+        self.invalidateShadow()
+        if self.needsFirmware():
             warn("Device is not yet initialized. Sending firmware.\n")
-            self.__sendFirmware()
+            self.loadFirmware()
         self.stopAquisition()
         self.clearBuffer()
         self.resetTimer()
 
     def __strangeDance(self):
+        # Writes between verification points go out as one pipelined batch
+        writes = []
         for i, move in enumerate(STRANGE_DANCE):
             if move > 0:
-                self.setParameter(0x10, move)
-            else:
-                p = self.getParameter(0x10)
-                if (p != -move): warn("Dance mismatch on byte 0x%x; expected 0x%02x, got 0x%02x\n",i,-move,p)
-        self.setParameter(0x18, 0x06)
-        self.setParameter(0x19, 0x00)
-        self.setParameter(0x1a, 0x07)
-        self.setParameter(0x18, 0x24)
-        self.setParameter(0x19, 0x7d)
-        self.setParameter(0x1a, 0x00)
-        self.setParameter(0x18, 0x2c)
-        self.setParameter(0x19, 0x74)
-        self.setParameter(0x1a, 0x00)
-        self.setParameter(0x18, 0x9f)
-        self.setParameter(0x19, 0x9f)
-        self.setParameter(0x1a, 0x01)
+                writes.append((0x10, move))
+                continue
+            self.writeParameters(writes)
+            writes = []
+            p = self.getParameter(0x10, cached=False)
+            if (p != -move): warn(f"Dance mismatch on byte 0x{i:x}; expected 0x{-move:02x}, got {p}\n")
+        writes += [(0x18, 0x06), (0x19, 0x00), (0x1a, 0x07),
+                   (0x18, 0x24), (0x19, 0x7d), (0x1a, 0x00),
+                   (0x18, 0x2c), (0x19, 0x74), (0x1a, 0x00),
+                   (0x18, 0x9f), (0x19, 0x9f), (0x1a, 0x01)]
+        self.writeParameters(writes)
 
     class Protocol:
-        def __init__(self):
-            self.b1 = [0] * 0x0d                    # Bitfields for transmission
-            self.b2 = [0] * 0x12
-
-            self.recordLength = 1e7                 # Nanoseconds
-            self.voltageOffset = 0.0                # Volts
-            self.timeOffset = 16.0                  # Nanoseconds
-            self.recordsPerSpectrum = 256           # Traces
-
-            self.precisionEnhancer = True           # flag
-
-            self.tpp = self.TPP.INT_500ps
-
-            self.compression = self.Compression.LOSSLESS
-            self.ringingProtection = 2
-            self.sensitivity = self.Sensitivity.SENS_2x
-            self.minimumThreshold = 10
-            self.backgroundInterval = 200
-            self.adjacentBackground = 0x10
-            self.correlatedSubtraction = False
-            self.minimumPeak = 4
-            self.maximumPeak = 400
-
-            self.singleIonLength = 100              # Nanoseconds
-            self.singleIonStart = 100               # Nanoseconds
-            self.sent = False
+        # Immutable per-slot acquisition settings. Values are quantized to what
+        # the device can represent when the object is built; use replace() to
+        # derive a changed copy. The encoded b1/b2 blocks are computed once per
+        # distinct set of values (see encodeProtocol).
 
         class TPP(IntEnum):
             INT_250ps = 0x10
@@ -207,142 +337,191 @@ class FastFlight2(usbInterface):
             SENS_3x = 0x01
             SENS_4x = 0x02
 
-        def time_per_point(self):
-            if self.tpp == self.TPP.INT_250ps:
-                return 0.25
-            elif self.tpp == self.TPP.INT_500ps:
-                return 0.5
-            elif self.tpp == self.TPP.INT_1ns:
-                return 1.0
-            elif self.tpp == self.TPP.INT_2ns:
-                return 2.0
-            else:
-                raise ValueError(f"Undefined TPP 0x{self.tpp:02x}")
+        DEFAULTS = {
+            "recordLength": 1e7,                    # Nanoseconds
+            "voltageOffset": 0.0,                   # Volts
+            "timeOffset": 16.0,                     # Nanoseconds
+            "recordsPerSpectrum": 256,              # Traces
+            "precisionEnhancer": True,              # flag
+            "tpp": 0x20,                            # TPP.INT_500ps
+            "compression": 0x1,                     # Compression.LOSSLESS
+            "ringingProtection": 2,
+            "sensitivity": 0x0,                     # Sensitivity.SENS_2x
+            "minimumThreshold": 10,
+            "backgroundInterval": 200,
+            "adjacentBackground": 0x10,
+            "correlatedSubtraction": False,
+            "minimumPeak": 4,
+            "maximumPeak": 400,
+            "singleIonLength": 100,                 # Nanoseconds
+            "singleIonStart": 100,                  # Nanoseconds
+        }
+        FIELDS = tuple(DEFAULTS)
+
+        def __init__(self, **kwargs):
+            unknown = set(kwargs) - set(self.DEFAULTS)
+            if unknown: raise TypeError(f"Unknown protocol fields {sorted(unknown)}")
+            v = dict(self.DEFAULTS, **kwargs)
+            v["tpp"] = self.TPP(v["tpp"])
+            v["compression"] = self.Compression(v["compression"])
+            v["sensitivity"] = self.Sensitivity(v["sensitivity"])
+
+            tpp = TPP_NS[v["tpp"]]
+            points = int(round(v["recordLength"] / tpp))
+            points = max(16, min(1500000, points))
+            v["recordLength"] = points * tpp
 
-        def set_time_per_point(self, tpp):
+            toi = int(v["timeOffset"] / 16.0)
+            toi = max(1, min(0xffff, toi))
+            v["timeOffset"] = toi * 16
+
+            # This formula is a guess
+            i = int(round(((v["voltageOffset"] + 0.25) / 0.5) * 65535.))
+            i = max(0, min(0xffff, i))
+            v["voltageOffset"] = 0.5 * (i / 65535.0) - 0.25
+
+            # peak detection settings, one byte each on the device
+            v["minimumThreshold"] = max(0, min(0xff, int(v["minimumThreshold"])))
+            v["minimumPeak"] = max(0, min(0xff, int(v["minimumPeak"])))
+            v["maximumPeak"] = 4 * max(0, min(0xff, int(round(v["maximumPeak"] / 4))))
+            sil = max(0, min(0xff, int(round(v["singleIonLength"] / tpp / 4))))
+            v["singleIonLength"] = sil * 4 * tpp
+
+            for k in self.FIELDS: object.__setattr__(self, k, v[k])
+            object.__setattr__(self, "key", tuple(v[k] for k in self.FIELDS))
+
+        def __setattr__(self, name, value):
+            raise AttributeError("Protocol is immutable; use replace()")
+
+        def replace(self, **changes):
+            return type(self)(**dict(zip(self.FIELDS, self.key), **changes))
+
+        @classmethod
+        def tppFor(cls, tpp):
+            # nearest supported interval for a time per point in ns
             if tpp <= 0.251:
-                self.tpp = self.TPP.INT_250ps
+                return cls.TPP.INT_250ps
             elif tpp < 0.51:
-                self.tpp = self.TPP.INT_500ps
+                return cls.TPP.INT_500ps
             elif tpp < 1.01:
-                self.tpp = self.TPP.INT_1ns
+                return cls.TPP.INT_1ns
             else:
-                self.tpp = self.TPP.INT_2ns
-
-        def stuff(self):
-            self.b1 = bytearray(0x0d)  # 13 bytes
-            self.b2 = bytearray(0x12)  # 18 bytes
+                return cls.TPP.INT_2ns
 
-            points = int(round(self.recordLength / self.time_per_point()))
-            points = max(16, min(1500000, points))
-            self.recordLength = points * self.time_per_point()
-
-            # Stuff b1
-            divider = int(0x10 * 0.5 / self.time_per_point())
-            self.b1[0] = (points // divider) & 0xff
-            self.b1[1] = (points // (divider * 0x100)) & 0xff
+        def time_per_point(self):
+            return TPP_NS[self.tpp]
 
-            toi = int(self.timeOffset / 16.0)
-            toi = max(1, min(0xffff, toi))
-            self.timeOffset = toi * 16
+        @property
+        def b1(self): return encodeProtocol(self.key)[0]
 
-            self.b1[3] = toi & 0xff
-            self.b1[4] = (toi // 0x100) & 0xff
-            self.b1[5] = self.recordsPerSpectrum & 0xff
-            self.b1[6] = (self.recordsPerSpectrum // 0x100) & 0xff
-
-            # This formula is a guess
-            i = int(round(((self.voltageOffset + 0.25) / 0.5) * 65535.))
-            i = max(0, min(0xffff, i))
-            self.b1[8] = i & 0x00ff
-            self.b1[9] = (i & 0xff00) // 0x100
-            self.voltageOffset = 0.5 * (i / 65535.0) - 0.25
-
-            if self.tpp == self.TPP.INT_250ps:
-                self.b1[0xb] = 0
-            elif self.tpp == self.TPP.INT_500ps:
-                self.b1[0xb] = 0x01
-            elif self.tpp == self.TPP.INT_1ns:
-                self.b1[0xb] = 0x02
-            elif self.tpp == self.TPP.INT_2ns:
-                self.b1[0xb] = 0x03
-
-            self.b1[0xc] = 1 if self.precisionEnhancer else 0
-
-            # Stuff b2
-            self.b2[0] = self.compression | self.tpp
-            self.b2[1] = self.ringingProtection * 0x10 | self.sensitivity
-            self.b2[2] = 0x0a
-            self.b2[3] = 0x00
-            self.b2[4] = 0x30
-            self.b2[5] = (self.backgroundInterval // 4) & 0xff
-            self.b2[6] = (self.adjacentBackground & 0x7f) | (0x80 if self.correlatedSubtraction else 0)
-
-            points = (points // 8) * 8 - 2
-
-            self.b2[7] = 0x64
-            self.b2[8] = 0x04
-            self.b2[9] = points & 0xff
-            self.b2[0xa] = (points // 0x100) & 0xff
-            self.b2[0xb] = (points // 0x10000) & 0x1f
-
-            self.b2[0x0c] = 0x00
-            self.b2[0x0d] = 0x00
-            self.b2[0x0e] = 0x00
-            self.b2[0x0f] = 0x00
-            self.b2[0x10] = self.recordsPerSpectrum & 0xff
-            self.b2[0x11] = (self.recordsPerSpectrum // 0x100) & 0xff
+        @property
+        def b2(self): return encodeProtocol(self.key)[1]
 
         def __eq__(self, other):
-            if not isinstance(other, self):
+            if not isinstance(other, type(self)):
                 return NotImplemented
-            self.stuff()
-            other.stuff()
-            if memcmp(self.b1, other.b1) != 0:
-                return False
-            if memcmp(self.b2, other.b2) != 0:
-                return False
-            return True
-
-    class codeType_t(IntEnum):
-        DATA_16BIT = 0x00
-        DATA_24BIT = 0x01
-        DATA_STICK = 0x02
-        SPECTRUM_BEGIN = 0x03
-        SPECTRUM_END = 0x03
-        TIME_LOW = 0x04
-        TIME_HIGH = 0x05
-        PROTOCOL = 0x06
-        ION_COUNT = 0x07
-        SYNC = 0x07
-        NOT_CODE = 0xFF
-
-    class dataBuffer:
-        def __init__(self):
-            self.data = bytearray(MAX_BULK_SIZE)
-            self.index = 0
-            self.last_taken = 0
-            self.bytecount = 0
-            self.unget = -1
-
-        def reset(self):
-            self.bytecount = 0
+            return self.key == other.key
 
-    def getLastProtocol(self):
-        return self.__lastProtocol
+        def __hash__(self):
+            return hash(self.key)
 
-    def loadBackgroundCal(self):
-        pass
+        def __repr__(self):
+            return "Protocol(" + ", ".join(f"{k}={getattr(self, k)!r}" for k in self.FIELDS) + ")"
 
-    def applyCalibration(self, data, length):
-        if len(self.backgroundCal) == 0: return data
-        if length > len(self.backgroundCal): raise IndexError("Too many samples acquired for current background calibration")
+    codeType_t = codeType_t
 
+    def getLastProtocol(self):
+        return self.decoder.lastProtocol
+
+    def getDecodeRate(self):
+        # MB/s
+        return self.decoder.throughput()
+
+    def loadBackgroundCal(self, state=True):
+        # From now on every sweep subtracts the background saved for the
+        # settings it runs with, if there is one (see acquireBackground).
+        # Returns whether the current settings have one.
+        self.useCalibration = state
+        return state and self.calibrations.load(self.settings) is not None
+
+    def acquireBackground(self, length, sweeps):
+        # Sweeps with nothing but the background at the input and saves the
+        # result, as mean volts per record, for the current settings.
+        saved, use = self.backgroundCal, self.useCalibration
+        self.backgroundCal, self.useCalibration = [], False
+        try:
+            _, buf = self.takeSweep(length, sweeps)
+        finally:
+            self.backgroundCal, self.useCalibration = saved, use
+        if hasattr(buf, "toDense"): buf = buf.toDense()
         scale, offset, tscale = self.getScale()
-        print("Using background calibration")
-        for i in range(length): data[i] -= self.backgroundCal[i] / scale
+        return self.calibrations.save(self.settings, buf * scale)
+
+    def currentCalibration(self, protocol=None):
+        # protocol: another configuration than self.settings; only the store
+        # applies to it
+        if protocol is not None: return self.calibrations.load(protocol) if self.useCalibration else None
+        if len(self.backgroundCal): return self.backgroundCal
+        if self.useCalibration: return self.calibrations.load(self.settings)
+        return None
+
+    def applyCalibration(self, data, length, protocol=None, acc=None):
+        # protocol and acc calibrate the sums of a configuration other than
+        # self.settings held in acc (see interleave.interleavedSweep)
+        cal = self.currentCalibration(protocol)
+        if cal is None: return data
+        if length > len(cal): raise IndexError("Too many samples acquired for current background calibration")
+
+        acc = acc if acc is not None else self.acc
+        scale, offset, tscale = self.getScale(acc.records if protocol is not None else None)
+        cal = np.divide(cal[:length], scale, dtype=np.float64)
+        if data is acc.buf:
+            acc.subtract(cal)
+            return acc.buf
+        data = np.asarray(data, dtype=np.float64)
+        data[:length] -= cal
         return data
 
+    def setBinStats(self, state):
+        # when set, takeSweep also keeps per-bin mean/variance in self.stats
+        self.trackStats = state
+
+    def setSpectrumType(self, dtype):
+        # element type of decoded chunk spectra: np.uint16 (16-bit transfers
+        # only), np.uint32, np.int64 or np.float64
+        self.decoder.setDtype(dtype)
+        self.chunkBuffer = np.empty(0, dtype=self.decoder.dtype)
+
+    def getChunkBuffer(self, length):
+        # decode target shared by every chunk of a sweep; grown, never shrunk
+        if len(self.chunkBuffer) < length: self.chunkBuffer = np.empty(length, dtype=self.decoder.dtype)
+        return self.chunkBuffer
+
+    def toVolts(self, data, out=None):
+        # sums from the last sweep to mean volts per record, as float64
+        scale, offset, _ = self.getScale()
+        out = np.multiply(data, scale, out=out, dtype=np.float64)
+        out += offset
+        return out
+
+    def getTimeAxis(self, length=None, protocol=None):
+        # seconds of every point; cached per protocol and length
+        p = protocol if protocol is not None else self.settings
+        if length is None: length = int(p.recordLength // p.time_per_point())
+        return timeAxis(p.time_per_point(), p.timeOffset, length)
+
+    def setSparse(self, state):
+        # When set, chunk spectra are decoded as sparseSpectrum runs straight
+        # from the jump codes (worthwhile for PEAK_ONLY or mostly empty
+        # LOSSLESS records) and takeSweep returns their sparseSpectrum sum;
+        # call toDense() on it when needed. Background calibration is not
+        # applied to sparse sums.
+        self.decoder.setSparse(state)
+
+    def setAccumulatorType(self, dtype):
+        # np.int64 (exact, overflow checked) or np.float64
+        self.acc.reset(0, dtype)
+
     def setRapidProtocolSelection(self, state):
         c = self.getMemory(MISC_CNTRL_PTR)
         if state:
@@ -354,49 +533,103 @@ class FastFlight2(usbInterface):
     def getRapidProtocolSelection(self):
         return self.getMemory(MISC_CNTRL_PTR) & RAPID_PROTOCOL_MASK
 
-    def setParameter(self, param, val):
+    def invalidateShadow(self):
+        # Forget every cached register value; the next read of each goes to
+        # the device. Needed whenever the device may have changed them behind
+        # our back (reset, firmware load).
+        self.__shadowMem = {}
+        self.__shadowParm = {}
+
+    def writeParameter(self, param, val):
+        # setParameter without the error handling; raises usb.core.USBError
         cmd = bytes([SET_CMD, param, val])
+        self.metrics.count("control.setParameter")
         try:
             self.Write(CONTROL_OUT, cmd)
             response = self.Read(CONTROL_IN, 1)
+        except usb.core.USBError:
+            self.__shadowParm.pop(param, None)
+            raise
 
-            if response[0] not in [0,1]:
-                print(f"Never-before-seen response code 0x{response[0]:02x} setting parameter 0x{param:02x} to 0x{val:02x}")
-            
-            return response[0] == 1
+        if response[0] not in [0,1]:
+            print(f"Never-before-seen response code 0x{response[0]:02x} setting parameter 0x{param:02x} to 0x{val:02x}")
+        
+        if param in SHADOWED_PARAMETERS: self.__shadowParm[param] = val
+        return response[0] == 1
+
+    def writeParameters(self, writes):
+        # Pipelined writeParameter for a list of (param, val); every command is
+        # sent before the acks are read back. Raises usb.core.USBError.
+        for i in range(0, len(writes), FPGA_ACK_BATCH):
+            chunk = writes[i:i + FPGA_ACK_BATCH]
+            self.metrics.count("control.setParameter", len(chunk))
+            try:
+                acks = self.__ackBatch([bytes([SET_CMD, p, v]) for p, v in chunk])
+            except usb.core.USBError:
+                for p, v in chunk: self.__shadowParm.pop(p, None)
+                raise
+            for (p, v), a in zip(chunk, acks):
+                if a not in [0,1]:
+                    print(f"Never-before-seen response code 0x{a:02x} setting parameter 0x{p:02x} to 0x{v:02x}")
+                if p in SHADOWED_PARAMETERS: self.__shadowParm[p] = v
+
+    def setParameter(self, param, val):
+        try:
+            return self.writeParameter(param, val)
         except usb.core.USBError as e:
             print(f"USB Error: {str(e)}")
             return False
         
-    def getParameter(self, param):
+    def getParameter(self, param, cached=True):
+        if cached and param in self.__shadowParm: return self.__shadowParm[param]
         cmd = bytes([GET_CMD, param])
+        self.metrics.count("control.getParameter")
         try:
             self.Write(CONTROL_OUT, cmd)
             response = self.Read(CONTROL_IN, 1)
+            if param in SHADOWED_PARAMETERS: self.__shadowParm[param] = response[0]
             return response[0]
         except usb.core.USBError as e:
             print(f"USB Error: {str(e)}")
             return None
 
-    def setMemory(self, address, val):
+    def writeMemory(self, address, val):
+        # setMemory without the error handling; raises usb.core.USBError
+        self.metrics.count("control.setMemory")
         try:
             resp = self.Control(usb.util.CTRL_TYPE_VENDOR | 
                                usb.util.CTRL_RECIPIENT_DEVICE |
                                usb.util.CTRL_IN, MEMORY_SET_REQUEST,
                                address, 0, bytes([val]))
-            return resp == 1
+        except usb.core.USBError:
+            self.__shadowMem.pop(address, None)
+            raise
+        if address in SHADOWED_MEMORY: self.__shadowMem[address] = val
+        return resp == 1
+
+    def setMemory(self, address, val):
+        try:
+            return self.writeMemory(address, val)
         except usb.core.USBError as e:
             print(f"USB Error: {str(e)}")
             return False
 
-    def getMemory(self):
-        # gets the value at miscellaneous control pointer
+    def batch(self):
+        # with self.batch() as b: b.setMemory(...); b.setParameter(...)
+        return controlBatch(self)
+
+    def getMemory(self, address=MISC_CNTRL_PTR, cached=True):
+        # defaults to the miscellaneous control pointer
+        if cached and address in self.__shadowMem: return self.__shadowMem[address]
+        self.metrics.count("control.getMemory")
         try:
             buf = self.Control(usb.util.CTRL_TYPE_VENDOR | 
                                usb.util.CTRL_RECIPIENT_DEVICE |
                                usb.util.CTRL_IN, MEMORY_SET_REQUEST,
-                               MISC_CNTRL_PTR, 0, 1)
-            return buf[0] if buf else None
+                               address, 0, 1)
+            if not buf: return None
+            if address in SHADOWED_MEMORY: self.__shadowMem[address] = buf[0]
+            return buf[0]
         except usb.core.USBError as e:
             print(f"USB Error: {str(e)}")
             return None
@@ -414,21 +647,38 @@ class FastFlight2(usbInterface):
             print(f"USB Error: {e}")
             return False
             
+    def loadProtocol(self, p, keep=()):
+        # Returns the slot holding Protocol p, uploading it into the least
+        # recently used slot outside keep unless it is already resident.
+        slot, resident = self.slots.assign(p, keep)
+        self.metrics.count("protocol.hits" if resident else "protocol.misses")
+        if not resident: self.sendProtocol(p, slot)
+        return slot
+
     def sendProtocol(self, p, slot):
-        # p is a Protocol object
-        assert(slot >= 0 and slot <= self.maxProtocol)
-        if self.lastSent[slot].sent == True and self.lastSent[slot] == p: return
-        p.stuff()
-        self.lastSent[slot] = p
-        self.lastSent[slot].sent = True
-        self.Control(usb.util.CTRL_TYPE_VENDOR | 
-                     usb.util.CTRL_RECIPIENT_DEVICE | 
-                     usb.util.ENDPOINT_OUT, MEMORY_SET_REQUEST,
-                     PROTOCOL_BASE + slot*PROTOCOL_STEP, 0, p.b1)
-        self.Control(usb.util.CTRL_TYPE_VENDOR | 
-                     usb.util.CTRL_RECIPIENT_DEVICE | 
-                     usb.util.ENDPOINT_OUT, MEMORY_SET_REQUEST,
-                     PROTOCOL_BASE + slot*PROTOCOL_STEP + 0xe, 0, p.b2)
+        # p is a Protocol object. Only the byte ranges that differ from what
+        # was last written to this slot are transferred.
+        assert(slot >= 0 and slot < self.maxProtocol)
+        self.checkCompression(p.compression)
+        last = self.slots.contents[slot]
+        if last == p:
+            self.slots.store(p, slot)
+            return
+        base = PROTOCOL_BASE + slot*PROTOCOL_STEP
+        for off, old, new in ((0, last and last.b1, p.b1),
+                              (PROTOCOL_B2_OFFSET, last and last.b2, p.b2)):
+            for start, end in changedRanges(old, new):
+                self.metrics.count("control.protocolWrites")
+                self.metrics.count("control.protocolBytes", end - start)
+                self.Control(usb.util.CTRL_TYPE_VENDOR | 
+                             usb.util.CTRL_RECIPIENT_DEVICE | 
+                             usb.util.ENDPOINT_OUT, MEMORY_SET_REQUEST,
+                             base + off + start, 0, new[start:end])
+        self.slots.store(p, slot)
+
+    def forgetProtocols(self):
+        # slot contents are unknown again (reset, firmware load)
+        self.slots.forget()
 
     def setProtocol(self, slot):
         self.setMemory(PROTOCOL_SET_PTR, slot)
@@ -447,10 +697,10 @@ class FastFlight2(usbInterface):
     def setTriggerEnableHigh(self, high):
         c = self.getParameter(TRIGGER_PARAMETER)
         if high:
-            c |= TRIGGER_POLARITY_MASK
+            nc = c | TRIGGER_POLARITY_MASK
         else:
-            c &= ~TRIGGER_POLARITY_MASK
-        self.setParameter(TRIGGER_PARAMETER, c)
+            nc = c & ~TRIGGER_POLARITY_MASK
+        if nc != c: self.setParameter(TRIGGER_PARAMETER, nc)
 
     def getTriggerEnableHigh(self):
         return (self.getParameter(TRIGGER_PARAMETER) & TRIGGER_POLARITY_MASK) != 0
@@ -458,10 +708,10 @@ class FastFlight2(usbInterface):
     def setTriggerRising(self, high):
         c = self.getParameter(TRIGGER_PARAMETER)
         if high:
-            c |= TRIGGER_RISING_MASK
+            nc = c | TRIGGER_RISING_MASK
         else:
-            c &= ~TRIGGER_RISING_MASK
-        self.setParameter(TRIGGER_PARAMETER, c)
+            nc = c & ~TRIGGER_RISING_MASK
+        if nc != c: self.setParameter(TRIGGER_PARAMETER, nc)
 
     def isTriggerRising(self):
         return (self.getParameter(TRIGGER_PARAMETER) & TRIGGER_RISING_MASK) != 0
@@ -477,7 +727,7 @@ class FastFlight2(usbInterface):
         return self.__triggerThreshold
 
     def setTimePerPoint(self, tpp):
-        self.settings.set_time_per_point(tpp)
+        self.settings = self.settings.replace(tpp=self.Protocol.tppFor(tpp))
 
     def getTimePerPoint(self):
         return self.settings.time_per_point()
@@ -489,31 +739,56 @@ class FastFlight2(usbInterface):
     def getSensitivity(self):
         return 0.5
 
+    def setCompression(self, mode):
+        # Protocol.Compression: LOSSLESS, PEAK_ONLY (only samples around
+        # peaks, jump coded) or STICK (one (time, value) per peak)
+        self.checkCompression(mode)
+        self.settings = self.settings.replace(compression=mode)
+
+    def checkCompression(self, mode):
+        # The peak detection bytes of PEAK_ONLY and STICK are a guess (see
+        # encodeProtocol); until they are checked against the vendor software
+        # they are not written to a real device.
+        if mode != self.Protocol.Compression.LOSSLESS and not self.simulated:
+            raise NotImplementedError(f"{self.Protocol.Compression(mode).name} compression is not verified on hardware yet; only LOSSLESS is supported")
+
+    def getCompression(self):
+        return self.settings.compression
+
+    def setPeakDetection(self, **fields):
+        # any of minimumThreshold, minimumPeak, maximumPeak, singleIonLength
+        unknown = set(fields) - {"minimumThreshold", "minimumPeak", "maximumPeak", "singleIonLength"}
+        if unknown: raise TypeError(f"Not peak detection settings: {sorted(unknown)}")
+        self.settings = self.settings.replace(**fields)
+
     def setTraceLength(self, tl):
-        self.settings.recordLength = tl
-        self.settings.stuff()
+        self.settings = self.settings.replace(recordLength=tl)
         self.__rps = self.getLength()
 
     def getTraceLength(self):
         return self.settings.recordLength
 
     def setLength(self, l):
-        self.settings.recordLength = 1 * self.getTimePerPoint()
-        self.settings.stuff()
+        self.settings = self.settings.replace(recordLength=l * self.getTimePerPoint())
         self.__rps = self.getLength()
 
     def getLength(self):
         return self.settings.recordLength//self.getTimePerPoint()
 
     def setOffset(self, v):
-        self.settings.voltageOffset = v
-        self.settings.stuff()
+        self.settings = self.settings.replace(voltageOffset=v)
 
     def getOffset(self):
         return self.settings.voltageOffset
 
-    def getScale(self):
-        scale = 0.5/(256. * self.__rps)
+    def setRecords(self, n):
+        # records summed by the sweep just taken; getScale and toVolts use it
+        self.acc.records = n
+        self.__rps = n
+
+    def getScale(self, records=None):
+        # records defaults to those of the last sweep
+        scale = 0.5/(256. * (records or self.__rps))
         offset = self.settings.voltageOffset
         tscale = self.settings.time_per_point() * 1e-9
         return scale, offset, tscale
@@ -531,6 +806,12 @@ class FastFlight2(usbInterface):
         self.setMemory(MISC_CNTRL_PTR, m)
         m = m & ~TIMER_RESET_MASK
         self.setMemory(MISC_CNTRL_PTR, m)
+        self.timerReset = time.perf_counter()
+
+    def hostTime(self, timestamp):
+        # time.perf_counter() at which the device stamped timestamp; as good
+        # as the assumed TIME_TICK and the latency of the reset write
+        return self.timerReset + timestamp * TIME_TICK
 
     def clearBuffer(self):
         cmd2 = bytes([0x12])
@@ -539,42 +820,139 @@ class FastFlight2(usbInterface):
         res = self.Read(CONTROL_IN, 1)
         assert res[0] == 1, "Expected 1, got {}".format(res[0])
         self.setParameter(0x07, 0x00)
-        self.db.index = self.db.bytecount = self.db.last_taken = 0
-        self.db.unget = -1
+        self.decoder.reset()
+        self.db.reset()
+
+    def setChunkSize(self, n):
+        # protocol records are 16 bits wide
+        if not 0 < n <= 0xffff: raise ValueError(f"Chunk size {n} out of range")
+        self.chunkSize = n
+
+    def setDecodeWorkers(self, n):
+        # n > 0 decodes and accumulates takeSweep chunks in n worker processes
+        if self.pool is not None and len(self.pool) == n: return
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        if n > 0: self.pool = decodePool(n)
+
+    def setBackgroundRead(self, state):
+        # when set, startAquisition drains SPECTRA_IN on a reader thread
+        self.backgroundRead = state
+
+    def setInflightTransfers(self, n):
+        # n > 0 keeps n SPECTRA_IN requests and reads queued in libusb during
+        # acquisition instead of one blocking getData per chunk
+        self.inflight = n
+
+    def startEngine(self):
+        if self.engine is not None or self.inflight <= 0: return
+        self.engine = transferEngine(self, self.db, self.inflight, 1000)
+
+    def stopEngine(self):
+        if self.engine is None: return
+        try:
+            self.engine.close()
+        finally:
+            self.engine = None
+
+    def readBulk(self):
+        t0 = time.perf_counter()
+        buf = self.engine.next() if self.engine is not None else self.getData()
+        dt = time.perf_counter() - t0
+        self.readTime += dt
+        self.metrics.observe("read.latency", dt)
+        if buf is None:
+            # the engine raises on errors; getData counts its own
+            if self.engine is not None: self.metrics.count("read.timeouts")
+        else:
+            self.bytesRead += len(buf)
+            self.metrics.count("read.transfers")
+            self.metrics.count("read.bytes", len(buf))
+        if self.capture is not None: self.capture.write(buf)
+        return buf
+
+    def startCapture(self, path):
+        # appends every SPECTRA_IN buffer read from now on to a capture file
+        # (see capture.captureReplay to decode it again)
+        self.stopCapture()
+        self.capture = captureWriter(path)
+
+    def stopCapture(self):
+        if self.capture is None: return
+        try:
+            self.capture.close()
+        finally:
+            self.capture = None
+
+    def startReader(self, depth=READER_DEPTH, limit=None):
+        if self.reader is not None: return
+        self.reader = bulkReader(self.readBulk, self.db, depth, limit)
+        self.reader.start()
+
+    def stopReader(self):
+        if self.reader is None: return None
+        try:
+            self.readerStats = self.reader.stop()
+        finally:
+            self.reader = None
+        if self.readerStats["highWater"]:
+            print(f"Reader queue reached its high-water mark {self.readerStats['highWater']} times in {self.readerStats['reads']} transfers")
+        return self.readerStats
 
     def startAquisition(self):
+        t0 = time.perf_counter()
         self.clearBuffer()
-        self.setParameter(0x05, 0xd0)
-
-        self.setMemory(0xa1fc, 0x00)
-        self.setMemory(0xa1fc, 0x00)
-        self.setMemory(0xa1fc, 0x10)
-        self.setMemory(0xa1fc, 0x10)
-        self.setMemory(0xa1fc, 0x00)
-        self.setMemory(0xa1fc, 0x00)
-        self.setMemory(0xa1fc, 0x50)
-        self.setMemory(0xa1fb, 0x08)
-        self.setMemory(0xa1fb, 0x18)
-        self.setMemory(0xa1fe, 0x00)
-
         e = self.getMemory()
-        self.setMemory(MISC_CNTRL_PTR, e | UNKNOWN_START)
-        self.setMemory(MISC_CNTRL_PTR, e & ~UNKNOWN_START)
-        self.setMemory(MISC_CNTRL_PTR, e | RUN_MASK)
+        slot = self.getMemory(PROTOCOL_SET_PTR) or 0
+
+        # The vendor sequence writes several of these twice in a row; they are
+        # kept doubled until the hardware shows the second write is not needed.
+        with self.batch() as b:
+            b.setParameter(0x05, 0xd0)
+
+            b.setMemory(0xa1fc, 0x00)
+            b.setMemory(0xa1fc, 0x00, repeat=True)
+            b.setMemory(0xa1fc, 0x10)
+            b.setMemory(0xa1fc, 0x10, repeat=True)
+            b.setMemory(0xa1fc, 0x00)
+            b.setMemory(0xa1fc, 0x00, repeat=True)
+            b.setMemory(0xa1fc, 0x50)
+            b.setMemory(0xa1fb, 0x08)
+            b.setMemory(0xa1fb, 0x18)
+            b.setMemory(PROTOCOL_SET_PTR, slot)     # the vendor sequence writes 0; keep the slot selected for this run
+
+            b.setMemory(MISC_CNTRL_PTR, e | UNKNOWN_START)
+            b.setMemory(MISC_CNTRL_PTR, e & ~UNKNOWN_START)
+            b.setMemory(MISC_CNTRL_PTR, e | RUN_MASK)
+        self.armTime = time.perf_counter() - t0
+        if len(self.db) < READER_DEPTH + self.inflight + 2: self.db = ringBuffer(READER_DEPTH + self.inflight + 2)
+        self.startEngine()
+        limit, self.readAheadLimit = self.readAheadLimit, None
+        if self.backgroundRead: self.startReader(limit=limit)
 
     def stopAquisition(self):
+        stats = self.stopReader()
+        self.stopEngine()
         e = self.getMemory()
         self.setMemory(MISC_CNTRL_PTR, e & ~RUN_MASK)
+        if stats is not None:
+            self.metrics.count("reader.highWater", stats["highWater"])
+            self.metrics.count("reader.stalls", stats["stalls"])
+        self.sweepMetrics = self.metrics.snapshot(reset=True)
+
+    def getMetrics(self):
+        # counters and histograms recorded since the last acquisition stopped;
+        # sweepMetrics holds those of the last one
+        return self.metrics.snapshot()
 
     def getCodeType(self, word):
-        if (word & 0xff000000) != 0xff000000:
-            return self.codeType_t.NOT_CODE
-        word = (word & 0x00e00000) // 0x00200000
-        if word >= self.codeType_t.DATA_16BIT and word <= self.codeType_t.SYNC:
-            return self.codeType_t(word)
-        raise ValueError(f"Unknown code type 0x{word:x}")
-
-    def getData(self, buffer_size):
+        return codeTypeOf(word)
+
+    def getData(self, buffer_size=MAX_BULK_SIZE):
+        # Reads straight into the next ring slot and returns a view of it; the
+        # slot stays reserved until the decoder releases it.
+        if buffer_size > self.db.size: raise ValueError(f"Bulk read of {buffer_size} bytes exceeds ring slot size {self.db.size}")
         cmd = bytes([0xff, 0x03])
 
         off = 0
@@ -584,16 +962,21 @@ class FastFlight2(usbInterface):
                 if ret == len(cmd) - off: break
                 if ret == 0: break
                 print(f"Incomplete command write ({ret}/{len(cmd)}), continuing")
+                self.metrics.count("read.incompleteRequests")
                 off+=ret
             except usb.core.USBTimeoutError:
                 break
             except usb.core.USBError as e:
                 print(f"Error from Write: {e}")
+                self.metrics.count("read.requestErrors")
                 break
         
-        buffer = bytearray(buffer_size)
+        slot = self.db.acquire()
+        buffer = self.db.slots[slot]
         for retry in range(2):
-            if retry != 0: print(f"Retry {retry} on read")
+            if retry != 0:
+                print(f"Retry {retry} on read")
+                self.metrics.count("read.retries")
             try:
                 r = self.Read(SPECTRA_IN, buffer, 1000)
                 break
@@ -601,297 +984,304 @@ class FastFlight2(usbInterface):
                 continue
             except usb.core.USBError as e:
                 print(f"Error from bulkRead: {e}")
+                self.metrics.count("read.errors")
                 r = -1
                 break
         else:
             r = -errno.ETIMEDOUT
 
-        return bytes(buffer[:r]) if r > 0 else None
-
-    def get(self, target):
-        if self.db.unget != -1:
-            ret = self.db.unget
-            self.db.unget = -1
-            self.db.bytecount+=1
-            return ret
-        if self.db.index < self.db.last_taken:
-            self.db.bytecount+=1
-            ret = self.db.data[self.db.index]
-            self.db.index+=1
-            return ret
-        self.db.index = 0
-        self.db.last_taken = 0
-        if target < 0 or (target - self.db.bytecount > MAX_BULK_SIZE):
-            to_take = MAX_BULK_SIZE
-        else:
-            assert(self.db.bytecount < target)
-            to_take = target - self.db.bytecount
+        if r <= 0:
+            # errors were counted where they were caught
+            if r != -1: self.metrics.count("read.timeouts")
+            self.db.release(slot)
+            return None
+        return self.db.views[slot][:r]
 
+    def getSpectrum(self, length, out=None):
+        # out: see spectrumDecoder.decode
+        spent = self.decoder.decodeTime
         while True:
-            data = self.getData(to_take)
-            r = len(data)
-            self.db.data[self.db.last_taken:self.db.last_taken + r] = data
-            if r > 0:
-                self.db.last_taken+=r
-                self.db.bytecount+=1
-                ret = self.db.data[self.db.index]
-                self.db.index+=1
-                return ret
-
-    def unget(self, c):
-        self.db.unget = c
-        self.db.bytecount-=1
-
-    def getWord(self, target=-1):
-        i = self.get(target)
-        i |= self.get(target) * 0x100
-        i |= self.get(target) * 0x10000
-        i |= self.get(target) * 0x1000000
-        return i
-
-    def synchronize(self): # look for spectrum sync marker
-        cTarget = 8
-        c = 0
-        while True:
-            if self.get() == 0xff:
-                c+=1
-                if c == cTarget:
-                    c = self.get() # we may have been mislead by the final 0xff from an old command
-                    if c != 0xff:
-                        self.unget(c)
-                    return
-            else:
-                c = 0
-
-    def getSpectrum(self, length):
-        data = bytearray(length)
-        index = t = spectrumNumber = _index = spectrumLength = lastCodeType = 0
-        # goto resync
-        def resync(): # return here if we get an unexpected synchronize or get confused
-            nonlocal index, t, spectrumNumber, _index, spectrumLength, lastCodeType
-            index = 0
-            self.db.reset()
-            t = self.getWord()
-            if self.getCodeType(t) != self.codeType_t.SPECTRUM_BEGIN:
-                print(f"Corrupt spectrum on spectrum length; got 0x{t:08x}, codetype 0x{self.getCodeType(t):x}")
-                self.synchronize()
-                resync()
-            t&=CODE_DATA_MASK
-            spectrumNumber = t
-            _index = spectrumNumber
-
-            t = self.getWord()
-            if self.getCodeType(t) != self.codeType_t.SPECTRUM_BEGIN:
-                print(f"Corrupt spectrum on spectrum length; got 0x{t:08x}, codetype 0x{self.getCodeType(t):x}")
-                self.synchronize()
-                resync()
-
-            spectrumLength = t & CODE_DATA_MASK
-            lastCodeType = self.codeType_t.SPECTRUM_BEGIN
-
-        spectrumNumber = -1
-        self.synchronize()
-        resync()
-        while True:
-            t = self.getWord()
-            codeType = self.getCodeType(t)
-            match codeType:
-                case self.codeType_t.DATA_16BIT | self.codeType_t.DATA_24BIT:
-                    if index != (t & CODE_DATA_MASK):
-                        print(f"Found jump to {t & CODE_DATA_MASK} from {index}, code 0x{t:x}, codetype 0x{codeType:x}")
-                        index = t & CODE_DATA_MASK
-
-                        if index > length:
-                            print("Illegal jump; resyncing!")
-                            self.synchronize(); resync(); continue # goto retry
-
-                case self.codeType_t.NOT_CODE:
-                    if index + 4 > length:
-                        print(f"Too many data bytes; {index+4}>{length}. Retrying")
-                        self.synchronize(); resync(); continue # goto retry
-
-                    match lastCodeType:
-                        case self.codeType_t.DATA_16BIT:
-                            u = self.getWord()
-                            data[index] = (firstByte(t)<<8) | firstByte(u); index+=1
-                            data[index] = (secondByte(t)<<8) | secondByte(u); index+=1
-                            data[index] = (thirdByte(t)<<8) | thirdByte(u); index+=1
-                            data[index] = (fourthByte(t)<<8) | fourthByte(u); index+=1
-
-                        case self.codeType_t.DATA_24BIT:
-                            u = self.getWord()
-                            v = self.getWord()
-                            data[index] = firstByte(t)<<16 + firstByte(u)<<8 + firstByte(v); index+=1
-                            data[index] = secondByte(t)<<16 + secondByte(u)<<8 + secondByte(v); index+=1
-                            data[index] = thirdByte(t)<<16 + thirdByte(u)<<8 + thirdByte(v); index+=1
-                            data[index] = fourthByte(t)<<16 + fourthByte(u)<<8 + fourthByte(v); index+=1
-                        
-                        case _:
-                            print(f"Unknown data type following code 0x{lastCodeType:x}")
-
-                case self.codeType_t.SPECTRUM_END:
-                    l = t & CODE_DATA_MASK
-                    if l != spectrumLength:
-                        print(f"Byte count mismatch; retrying (0x{spectrumLength:06x} != 0x{l:06x})")
-                        self.synchronize(); resync(); continue # goto retry
-                    if l*4 != 8 + self.db.bytecount:
-                        print(f"Read {8 + self.db.bytecount} bytes, expected {l*4}. Retrying")
-                        self.synchronize(); resync(); continue # goto retry
-                    
-                    return index, data
-
-                case self.codeType_t.DATA_STICK:
-                    print(f"Stick data not supported; assuming comm error.")
-                    self.synchronize(); resync(); continue # goto retry
-
-                case self.codeType_t.TIME_LOW: pass
-                case self.codeType_t.TIME_HIGH: pass
-                
-                case self.codeType_t.PROTOCOL: self.__lastProtocol = t & CODE_DATA_MASK
-                
-                case self.codeType_t.ION_COUNT:
-                    if (t & CODE_DATA_MASK == CODE_DATA_MASK):
-                        u = self.getWord()
-                        if u == 0xffffffff:
-                            print("Unexpected synchronize; restarting.")
-                            resync(); continue # goto resync
-                        else:
-                            print("Unexpected partial resync; restarting.")
-                            self.synchronize(); resync; continue # goto retry
-                    
-                    u = self.getWord()
-                    self.getWord()
-                    self.getWord()
-                    self.__overload = 0
-                    if u & 0x00008000: self.__overload |= OVERLOAD
-                    if u & 0x80000000: self.__overload |= UNDERLOAD
-                
-                case _:
-                    print("Unhandled code word 0x{t:08x}")
-
-    def takeSweep(self, length, sweeps):
-        if (sweeps > CHUNK_SIZE) and (DITHER_LEN != 0):
-            return self.takeSweep_dither(length, sweeps)
-        
+            res = self.decoder.decode(length, out)
+            if res is not None:
+                self.__overload = self.decoder.overload
+                self.metrics.count("decode.spectra")
+                self.metrics.observe("decode.time", self.decoder.decodeTime - spent)
+                if self.__overload & OVERLOAD: self.metrics.count("decode.overload")
+                if self.__overload & UNDERLOAD: self.metrics.count("decode.underload")
+                return res
+            self.decoder.feed(self.readNext(), self.db.release)
+
+    def readNext(self):
+        # next SPECTRA_IN buffer (a ring slot view, or None on timeout) from
+        # the reader thread if one is running
+        if self.reader is not None and not self.reader.exhausted(): return self.reader.get()
+        return self.readBulk()
+
+    def prepareSweep(self, sweeps):
+        # Loads the chunk and remainder protocols for a sweep (see loadProtocol),
+        # keeps their slots in sweepSlots and selects the chunk slot. Returns
+        # the records in the final chunk, 0 if there is only one.
+        #
+        # The background reader stops once it has read every spectrum before
+        # the one preceding the remainder (readAheadLimit, in spectra, used by
+        # the next startAquisition); the rest are read as they are decoded, so
+        # the switch is made before that spectrum is requested.
         final = 0
-        stop = False
-        sweep = 0
-        buf2 = [0 for _ in range(len)]
-
-        if sweeps < CHUNK_SIZE:
-            self.settings.recordsPerSpectrum = sweeps
-            self.sendProtocol(self.settings, 0)
-            self.setProtocol(0)
-            self.startAquisition()
-            l1, buf = self.getSpectrum(length)
-            self.__rps = sweeps
-
+        if sweeps < self.chunkSize:
+            first = last = self.loadProtocol(self.settings.replace(recordsPerSpectrum=sweeps))
         else:
-            final = sweeps - (sweeps // CHUNK_SIZE)*CHUNK_SIZE
-            self.settings.recordsPerSpectrum = CHUNK_SIZE
-            self.sendProtocol(self.settings, 0)
-            if final != 0:
-                self.settings.recordsPerSpectrum = final
+            final = sweeps - (sweeps // self.chunkSize)*self.chunkSize
+            first = self.loadProtocol(self.settings.replace(recordsPerSpectrum=self.chunkSize))
+            if final == 0: final = self.chunkSize
+            last = self.loadProtocol(self.settings.replace(recordsPerSpectrum=final), (first,))
+            if final != self.chunkSize: self.readAheadLimit = max(0, (sweeps - final) // self.chunkSize - 1)
+        self.sweepSlots = (first, last)
+        self.setProtocol(first)
+        return final
+
+    def switchDue(self, taken, final, sweeps):
+        # the device is already acquiring the next chunk, so the switch to the
+        # remainder protocol has to happen one chunk early; the first chunk's
+        # slot was latched at arm, so with two chunks it happens before any arrive
+        return bool(final and sweeps - (taken + self.chunkSize) < self.chunkSize)
+
+    def chunkRecords(self, slot, final, sweeps):
+        if not final: return sweeps
+        return final if slot == self.sweepSlots[1] else self.chunkSize
+
+    def selectFinal(self):
+        # the remainder chunk is next (see switchDue)
+        if self.sweepSlots[1] != self.sweepSlots[0]: self.setProtocol(self.sweepSlots[1])
+
+    def iterSpectra(self, length, sweeps, beforeArm=None, out=None):
+        # Arms the device and yields every chunk spectrum as it is decoded.
+        # sweeps is the running total of records acquired so far, including
+        # this chunk. Closing the generator early stops the acquisition.
+        # beforeArm() runs once the protocols are loaded, just before arming.
+        # With out every chunk is decoded into it, replacing the last one.
+        final = self.prepareSweep(sweeps)
+        if beforeArm is not None: beforeArm()
+        self.startAquisition()
+
+        self.timing.reset()
+        try:
+            taken = 0
+            while taken < sweeps:
+                if self.switchDue(taken, final, sweeps): self.selectFinal()
+
+                index, data = self.getSpectrum(length, out)
+                slot = self.getLastProtocol()
+                records = self.chunkRecords(slot, final, sweeps)
+                taken += records
+                self.timing.add(self.decoder.timestamp, records)
+                yield spectrumChunk(index, data, slot, taken, self.decoder.spectrumNumber, self.decoder.sticks,
+                                    self.decoder.timestamp)
+
+            if taken != sweeps:
+                print(f"Accidentally took too many sweeps ({taken} > {sweeps})")
+                self.metrics.count("sweep.extraRecords", taken - sweeps)
+        finally:
+            self.recordTiming()
+            self.stopAquisition()
+
+    def recordTiming(self):
+        # trigger rate, gaps and duty cycle of the acquisition into the metrics
+        if len(self.timing) < 2: return
+        for k, v in self.timing.summary().items(): self.metrics.set("timing." + k, v)
+        for g in self.timing.gaps().tolist(): self.metrics.observe("timing.gap", g)
+
+    def takeSweep(self, length, sweeps, beforeArm=None):
+        # The returned array is the accumulator's storage and is overwritten by
+        # the next sweep; copy it to keep it.
+        if (sweeps > self.chunkSize) and (DITHER_LEN != 0):
+            return self.takeSweep_dither(length, sweeps, beforeArm)
+
+        if self.planner is not None:
+            # the planned chunk size holds for this sweep only
+            self.plan = self.planner.plan(length, sweeps, self.getTimePerPoint())
+            chunkSize = self.chunkSize
+            self.setChunkSize(self.plan.recordsPerSpectrum)
+            try:
+                return self.__takeSweep(length, sweeps, beforeArm)
+            finally:
+                self.chunkSize = chunkSize
+        return self.__takeSweep(length, sweeps, beforeArm)
+
+    def __takeSweep(self, length, sweeps, beforeArm):
+        sparse = self.decoder.sparse
+        if self.pool is not None and not sparse: return self.__poolSweep(length, sweeps, beforeArm)
+
+        l1 = None
+        self.acc.reset(length)
+        if sparse: self.sparseAcc.reset(length, self.acc.dtype)
+        if self.trackStats: self.stats.reset(length)
+        self.sticks.reset()
+        mark = (self.bytesRead, self.readTime, self.decoder.bytesDecoded, self.decoder.decodeTime)
+        chunkTimes = []
+        for c in self.iterSpectra(length, sweeps, beforeArm, self.getChunkBuffer(length)):
+            chunkTimes.append((time.perf_counter(), c.sweeps - self.acc.records))
+            if l1 is None:
+                l1 = c.index
+            elif c.index != l1:
+                print(f"Trace length mismatch: {c.index} != {l1}")
+                self.metrics.count("sweep.lengthMismatch")
+            if sparse:
+                self.sparseAcc.add(c.data)
             else:
-                final = CHUNK_SIZE
-            self.sendProtocol(self.settings, 1)
-            self.setProtocol(0)
-            self.startAquisition()
-            l1, buf = self.getSpectrum(length)
-            rep_count = 2 if self.settings.recordLength > 40000 else 1
-
-            self.__reps = CHUNK_SIZE
-            while self.__reps < sweeps and not stop:
-                if sweeps - (self.__rps + CHUNK_SIZE) < CHUNK_SIZE: self.setProtocol(1)
-
-                l2, buf2 = self.getSpectrum(length)
-                for i in range(length): buf[i] += buf2[i]
-
-                if self.__rps % rep_count == 0:
-                    print(f"Sweep {self.__rps}/{sweeps} ({self.getLastProtocol()})")
-                
-                if self.getLastProtocol == 1:
-                    if final == 0: print(f"Crazy; we found a protocol 1 spectrum before we were ready ({final})!")
-                    self.__rps += final
-                
-                else:
-                    self.__rps += CHUNK_SIZE
-                
-                if l2 != l1: print(f"Trace length mismatch: {l2} != {l1}")
-            
-        if self.__rps != sweeps: print(f"Accidentally took too many sweeps ({self.__rps} > {sweeps}) {"STOP" if stop else ""}")
-        self.stopAquisition()
+                self.acc.add(c.data)
+            if len(c.sticks):
+                self.acc.addSticks(c.sticks)
+                self.sticks.add(c.sticks)
+            if self.trackStats: self.stats.add(c.data.toDense() if sparse else c.data, c.sweeps - self.acc.records)
+            self.acc.records = c.sweeps
+            if sweeps >= self.chunkSize: print(f"Sweep {c.sweeps}/{sweeps} ({c.slot})")
+            self.__rps = c.sweeps
+
+        if self.planner is not None:
+            self.planner.observe(self.bytesRead - mark[0], self.readTime - mark[1],
+                                 self.decoder.bytesDecoded - mark[2], self.decoder.decodeTime - mark[3],
+                                 chunkTimes)
+        if sparse: return l1, self.sparseAcc.sum
+        buf = self.applyCalibration(self.acc.buf, length)
+        return l1, buf
 
-        buf = self.applyCalibration(buf, length)
+    def __poolSweep(self, length, sweeps, beforeArm):
+        # the chunks never reach this process, so there is nothing to keep
+        # bin statistics from
+        if self.trackStats: raise ValueError("Bin statistics are not kept with decode workers; use setBinStats(False) or setDecodeWorkers(0)")
+        mark = (self.bytesRead, self.readTime)
+        l1, buf = self.pool.sweep(self, length, sweeps, beforeArm)
+        if self.planner is not None:
+            # the workers decode side by side, so their rate adds up
+            bytesDecoded, decodeTime = self.pool.decoded
+            self.planner.observe(self.bytesRead - mark[0], self.readTime - mark[1],
+                                 bytesDecoded, decodeTime / len(self.pool), self.pool.chunkTimes)
         return l1, buf
 
-    def takeSweep_dither(self, length, sweeps):
+    def setAutoChunk(self, state, planner=None):
+        # when set, takeSweep picks its chunk size from an acquisitionPlanner
+        # that keeps learning the rates from every sweep
+        if state:
+            self.planner = planner or self.planner or acquisitionPlanner()
+        else:
+            self.planner = None
+
+    def planSweep(self, length, sweeps):
+        # dry run: the acquisitionPlan takeSweep would follow, without acquiring
+        planner = self.planner or acquisitionPlanner()
+        return planner.plan(length, sweeps, self.getTimePerPoint())
+
+    def takeInterleaved(self, protocols, sweeps, beforeArm=None):
+        # Sweeps several configurations (Protocol objects, one slot each) in
+        # one armed acquisition; returns [(index, sums)] in the same order.
+        # Sticks are folded into each configuration's sums and sparse chunks
+        # are summed dense; self.interleaved keeps the per-slot records.
+        self.interleaved = interleavedSweep(self, protocols, sweeps)
+        return self.interleaved.run(beforeArm)
+
+    def takeSweepUntil(self, length, criterion, maxSweeps, window=0.):
+        # Sweeps until criterion(self.stats) has held for window seconds, or
+        # maxSweeps records. See bin_stats.stderrBelow/snrAbove; the statistics
+        # are of the raw per-record counts, before background calibration, and
+        # need at least two chunks, so lower the chunk size for short runs.
+        # Returns (index, sums, records taken).
+        l1 = None
+        since = None
+        self.acc.reset(length)
+        self.stats.reset(length)
+        self.sticks.reset()
+        gen = self.iterSpectra(length, maxSweeps, out=self.getChunkBuffer(length))
+        try:
+            for c in gen:
+                if l1 is None:
+                    l1 = c.index
+                elif c.index != l1:
+                    print(f"Trace length mismatch: {c.index} != {l1}")
+                    self.metrics.count("sweep.lengthMismatch")
+                # the statistics are per bin, so sparse chunks are expanded
+                data = c.data.toDense() if self.decoder.sparse else c.data
+                self.acc.add(data)
+                if len(c.sticks):
+                    self.acc.addSticks(c.sticks)
+                    self.sticks.add(c.sticks)
+                self.stats.add(data, c.sweeps - self.acc.records)
+                self.acc.records = c.sweeps
+                if not criterion(self.stats):
+                    since = None
+                    continue
+                now = time.perf_counter()
+                if since is None: since = now
+                if now - since >= window: break
+        finally:
+            gen.close()
+
+        self.__rps = self.acc.records
+        buf = self.applyCalibration(self.acc.buf, length)
+        return l1, buf, self.acc.records
+
+    def takeSweep_dither(self, length, sweeps, beforeArm=None):
         final = 0
         stop = False
         sweep = 0
-        buf2 = [0 for _ in range(len)]
+        offset = 0
         oorigin = self.settings.voltageOffset
+        self.acc.reset(length)
 
-        if sweeps < CHUNK_SIZE:
-            self.settings.recordsPerSpectrum = sweeps
-            self.sendProtocol(self.settings, 0)
-            self.setProtocol(0)
+        if sweeps < self.chunkSize:
+            self.setProtocol(self.loadProtocol(self.settings.replace(recordsPerSpectrum=sweeps)))
+            if beforeArm is not None: beforeArm()
             self.startAquisition()
             l1, buf = self.getSpectrum(length)
+            self.acc.add(buf)
             self.__rps = sweeps
-            offset = 0
 
         else:
-            chunks = min(sweeps // CHUNK_SIZE, self.maxProtocol - 1)
-            final = sweeps - (sweeps // CHUNK_SIZE)*CHUNK_SIZE
+            chunks = min(sweeps // self.chunkSize, self.maxProtocol - 1)
+            final = sweeps - (sweeps // self.chunkSize)*self.chunkSize
             ostep = DITHER_LEN // chunks
-            self.settings.recordsPerSpectrum = CHUNK_SIZE
+            slots = []
             for i in range(chunks): 
-                self.settings.voltageOffset = oorigin + i*ostep
-                self.sendProtocol(self.settings, i)
-            if final != 0:
-                self.settings.recordsPerSpectrum = final
-            else:
-                final = CHUNK_SIZE
-
-            self.settings.voltageOffset = oorigin
-            self.sendProtocol(self.settings, self.maxProtocol - 1)
-            self.setProtocol(sweep % chunks); sweep+=1
+                slots.append(self.loadProtocol(self.settings.replace(recordsPerSpectrum=self.chunkSize, voltageOffset=oorigin + i*ostep), slots))
+            if final == 0: final = self.chunkSize
+            finalSlot = self.loadProtocol(self.settings.replace(recordsPerSpectrum=final), slots)
+            self.setProtocol(slots[sweep % chunks]); sweep+=1
+            if beforeArm is not None: beforeArm()
             self.startAquisition()
-            self.setProtocol(sweep % chunks); sweep+=1
+            self.setProtocol(slots[sweep % chunks]); sweep+=1
             l1, buf = self.getSpectrum(length)
+            self.acc.add(buf)
             rep_count = 2 if self.settings.recordLength > 40000 else 1
 
-            self.__reps = CHUNK_SIZE
-            while self.__reps < sweeps and not stop:
+            self.__rps = self.chunkSize
+            while self.__rps < sweeps and not stop:
                 print(f"Sweep {self.__rps}/{sweeps}\r", end="")
-                if sweeps - (self.__rps + CHUNK_SIZE) < CHUNK_SIZE: 
-                    self.setProtocol(self.maxProtocol - 1)
+                if sweeps - (self.__rps + self.chunkSize) < self.chunkSize: 
+                    self.setProtocol(finalSlot)
                 else:
-                    self.setProtocol(sweep % chunks); sweep+=1
+                    self.setProtocol(slots[sweep % chunks]); sweep+=1
 
                 l2, buf2 = self.getSpectrum(length)
-                for i in range(length): buf[i] += buf2[i]
+                self.acc.add(buf2)
 
-                if self.getLastProtocol() == self.maxProtocol - 1:
+                if self.getLastProtocol() == finalSlot:
                     if final == 0: print(f"Crazy; we found a protocol 1 spectrum before we were ready ({final})!")
                     self.__rps += final
                 else:
-                    self.__rps += CHUNK_SIZE
+                    self.__rps += self.chunkSize
 
                 if self.__rps % rep_count == 0: print(f"Sweep {self.__rps}/{sweeps} ({self.getLastProtocol()})")
                 if l2 != l1: 
                     print(f"Trace length mismatch: {l2} != {l1}")
                 else:
-                    if self.getLastProtocol() != self.maxProtocol - 1:
-                        o = 512 * ostep * self.getLastProtocol() * CHUNK_SIZE
+                    if self.getLastProtocol() != finalSlot:
+                        o = 512 * ostep * slots.index(self.getLastProtocol()) * self.chunkSize
                         offset += o
 
-        for i in range(length): buf[i] += offset
+        self.acc.addOffset(offset)
         if self.__rps != sweeps: 
-            print(f"Accidentally took too many sweeps ({self.__rps} > {sweeps}) {"STOP" if stop else ""}")
-            for i in range(length): buf[i] *= sweeps // self.__rps
+            print(f"Accidentally took too many sweeps ({self.__rps} > {sweeps}) {'STOP' if stop else ''}")
+            self.acc.scale(sweeps / self.__rps)
         self.stopAquisition()
 
-        buf = self.applyCalibration(buf, length)
+        buf = self.applyCalibration(self.acc.buf, length)
         return l1, buf
\ No newline at end of file
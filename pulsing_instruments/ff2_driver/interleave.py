@@ -0,0 +1,106 @@
+from FF2_parms import *
+from accumulator import sweepAccumulator
+import math
+
+class interleavedSweep:
+    # Acquires up to maxProtocol configurations in one armed run. Each
+    # Protocol gets its own slot and chunk size; the host keeps selecting the
+    # configuration furthest behind its share, and every spectrum is routed
+    # by its PROTOCOL code to that configuration's accumulator. Selection is
+    # one spectrum ahead of what arrives, as the device latches the slot for
+    # the next spectrum when the current one closes; when the host falls
+    # behind, spectra land in a different slot than planned and the choice
+    # corrects itself from what was actually received.
+    #
+    #   s = interleavedSweep(dev, [dev.settings.replace(voltageOffset=v) for v in offsets], 10000)
+    #   for index, sums in s.run(): ...
+    #
+    # sweeps (one for all, or one per configuration) is rounded up to whole
+    # chunks, spread evenly; records[i] holds what was summed.
+
+    def __init__(self, dev, protocols, sweeps):
+        if not 0 < len(protocols) <= dev.maxProtocol: raise ValueError(f"Between 1 and {dev.maxProtocol} configurations fit the device")
+        if isinstance(sweeps, int): sweeps = [sweeps] * len(protocols)
+        if len(sweeps) != len(protocols): raise ValueError("One sweep count per configuration")
+        self.dev = dev
+        self.chunks = [math.ceil(s / min(s, dev.chunkSize)) for s in sweeps]
+        self.rps = [math.ceil(s / c) for s, c in zip(sweeps, self.chunks)]
+        self.protocols = [p.replace(recordsPerSpectrum=r) for p, r in zip(protocols, self.rps)]
+        if len(set(self.protocols)) < len(self.protocols): raise ValueError("Configurations share a slot; make them differ")
+        self.points = [int(p.recordLength // p.time_per_point()) for p in self.protocols]
+        self.slots = []
+        self.accs = [sweepAccumulator() for _ in protocols]
+        self.records = [0] * len(protocols)
+        self.dropped = 0            # spectra of unknown slots or complete configurations
+
+    def load(self):
+        # configurations used before stay resident in the device slots
+        self.slots = []
+        for p in self.protocols: self.slots.append(self.dev.loadProtocol(p, self.slots))
+
+    def __behind(self, expected):
+        # configuration furthest behind its share, or None once all are covered
+        best = None
+        for i, (e, c) in enumerate(zip(expected, self.chunks)):
+            if e < c and (best is None or e / c < expected[best] / self.chunks[best]): best = i
+        return best
+
+    def run(self, beforeArm=None):
+        # Returns [(index, sums)] in configuration order; the sums are views
+        # of per-configuration storage, overwritten by the next run.
+        dev = self.dev
+        n = len(self.protocols)
+        self.load()
+        bySlot = {s: i for i, s in enumerate(self.slots)}
+        length = max(self.points)
+        for a, p in zip(self.accs, self.points): a.reset(p, dev.acc.dtype)
+        received = [0] * n
+        index = [None] * n
+        self.records = [0] * n
+
+        current = self.__behind(received)
+        dev.setProtocol(self.slots[current])
+        if beforeArm is not None: beforeArm()
+        out = dev.getChunkBuffer(length)
+        dev.startAquisition()
+        try:
+            # the spectrum after the first is chosen before anything arrives
+            expected = list(received)
+            expected[current] += 1
+            ahead = self.__behind(expected)
+            if ahead is not None:
+                dev.setProtocol(self.slots[ahead])
+            else:
+                ahead = current
+            while any(r < c for r, c in zip(received, self.chunks)):
+                idx, data = dev.getSpectrum(length, out)
+                i = bySlot.get(dev.getLastProtocol())
+                keep = i is not None and received[i] < self.chunks[i]
+                if keep: received[i] += 1
+
+                # ahead is being acquired now; pick the one after it
+                expected = list(received)
+                expected[ahead] += 1
+                nxt = self.__behind(expected)
+                if nxt is not None and nxt != ahead: dev.setProtocol(self.slots[nxt])
+                if nxt is not None: ahead = nxt
+
+                if not keep:
+                    self.dropped += 1
+                    continue
+                if hasattr(data, "toDense"): data = data.toDense()
+                p = self.points[i]
+                if index[i] is None:
+                    index[i] = idx
+                elif idx != index[i]:
+                    print(f"Trace length mismatch in slot {self.slots[i]}: {idx} != {index[i]}")
+                self.accs[i].add(data[:p])
+                sticks = dev.decoder.sticks
+                if len(sticks): self.accs[i].addSticks(sticks[sticks["time"] < p])
+                self.records[i] += self.rps[i]
+                self.accs[i].records = self.records[i]
+        finally:
+            dev.stopAquisition()
+
+        return [(index[i], dev.applyCalibration(a.buf, p, proto, a))
+                for i, (a, p, proto) in enumerate(zip(self.accs, self.points, self.protocols))]
@@ -28,9 +28,27 @@ def listDevices():
     for dev in devices:
         print(devToStr(dev), end="")
 
-def locateDevice(*args, **kwargs):
-    dev = usb.core.find(*args, backend=bknd, **kwargs)
-    if dev is None: raise ValueError("Device Not Found.")
+def serialOf(dev):
+    try:
+        return usb.util.get_string(dev, dev.iSerialNumber)
+    except (usb.core.USBError, ValueError):
+        return None
+
+def findDevices(*args, serial=None, **kwargs):
+    # every matching device, unopened; serial narrows the match
+    devices = list(usb.core.find(*args, find_all=True, backend=bknd, **kwargs))
+    if serial is not None: devices = [d for d in devices if serialOf(d) == serial]
+    return devices
+
+def openDevice(dev):
     dev.set_configuration()
     usb.util.claim_interface(dev, 0)
-    return dev
\ No newline at end of file
+    return dev
+
+def locateDevice(*args, serial=None, **kwargs):
+    if serial is None:
+        dev = usb.core.find(*args, backend=bknd, **kwargs)
+    else:
+        dev = next(iter(findDevices(*args, serial=serial, **kwargs)), None)
+    if dev is None: raise ValueError("Device Not Found." if serial is None else f"Device {serial} Not Found.")
+    return openDevice(dev)
@@ -0,0 +1,80 @@
+from FF2_parms import *
+import math
+
+def mergeCounters(into, counters):
+    for k, n in counters.items(): into[k] = into.get(k, 0) + n
+
+class latencyHistogram:
+    # Log2-bucketed histogram of durations in seconds; bucket i counts values
+    # up to METRIC_HIST_MIN * 2**i. Adding a value is a frexp and two adds.
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.buckets = [0] * METRIC_HIST_BUCKETS
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, value):
+        i = math.frexp(value / METRIC_HIST_MIN)[1] if value > METRIC_HIST_MIN else 0
+        self.buckets[i if i < METRIC_HIST_BUCKETS else -1] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max: self.max = value
+
+    def quantile(self, q):
+        # upper edge of the bucket holding the q-th quantile
+        if self.count == 0: return 0.
+        need = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= need: return min(METRIC_HIST_MIN * 2.**i, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {"count": self.count, "total": self.total, "max": self.max,
+                "mean": self.total / self.count if self.count else 0.,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99),
+                "buckets": list(self.buckets)}
+
+class driverMetrics:
+    # Counters and latency histograms for the acquisition hot path. Names are
+    # dotted, e.g. "read.retries", "resync.byteCount", "control.setMemory".
+    # Every counter is written by a single thread (the reader thread owns the
+    # "read." ones), so plain dict updates are enough.
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        # last value wins, e.g. a rate derived at the end of an acquisition
+        self.gauges[name] = value
+
+    def merge(self, counters):
+        # adds counters recorded elsewhere, e.g. by a decode worker process
+        mergeCounters(self.counters, counters)
+
+    def observe(self, name, seconds):
+        h = self.histograms.get(name)
+        if h is None: h = self.histograms[name] = latencyHistogram()
+        h.add(seconds)
+
+    def reset(self):
+        self.counters = {}
+        self.gauges = {}
+        for h in self.histograms.values(): h.reset()
+
+    def snapshot(self, reset=False):
+        # plain dict of everything recorded since the last reset
+        snap = {"counters": dict(self.counters), "gauges": dict(self.gauges),
+                "histograms": {k: h.snapshot() for k, h in self.histograms.items() if h.count}}
+        if reset: self.reset()
+        return snap
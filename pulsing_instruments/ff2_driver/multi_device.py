@@ -0,0 +1,157 @@
+from FF2_parms import *
+from lusb import findDevices, serialOf
+from fastflight2 import FastFlight2
+from collections import deque
+import threading
+import queue
+
+def listSerials():
+    # serial numbers of every connected FastFlight 2; a unit whose serial
+    # cannot be read cannot be opened by it and is left out
+    serials = []
+    for d in findDevices(idVendor=FF2_VID, idProduct=FF2_PID):
+        s = serialOf(d)
+        if s is None:
+            print(f"Skipping FastFlight 2 at bus {d.bus} address {d.address}; its serial number cannot be read")
+        else:
+            serials.append(s)
+    return serials
+
+class deviceGroup:
+    # Several FastFlight 2 units triggered together. Each unit gets its own I/O
+    # thread that arms it and pulls its spectra; the threads meet at a barrier
+    # once their protocols are loaded so that all units are armed before the
+    # first shared trigger. iterSpectra() lines the chunks up by spectrum number.
+    #
+    #   g = deviceGroup.open()                  # every connected unit
+    #   for number, chunks in g.iterSpectra(length, sweeps): ...
+
+    def __init__(self, devices):
+        self.devices = list(devices)
+        self.serials = [d.getSerialNumber() for d in self.devices]
+        if None in self.serials or len(set(self.serials)) < len(self.serials):
+            raise ValueError(f"Every unit of a group needs its own serial number, got {self.serials}")
+        self.__stop = threading.Event()
+        self.missing = 0            # spectra some unit never delivered
+
+    @classmethod
+    def open(cls, serials=None):
+        if serials is None: serials = listSerials()
+        if not serials: raise ValueError("No FastFlight 2 Found.")
+        if None in serials: raise ValueError("Units are opened by serial number; None would open any unit")
+        return cls([FastFlight2(serial=s) for s in serials])
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __getitem__(self, serial):
+        return self.devices[self.serials.index(serial)]
+
+    def forEach(self, fn):
+        # calls fn(dev) for every unit in parallel and returns the results in
+        # device order; the first exception is re-raised
+        out = [None] * len(self.devices)
+        errors = []
+        def run(i, dev):
+            try:
+                out[i] = fn(dev)
+            except BaseException as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(i, d), name=f"FF2 {self.serials[i]}", daemon=True)
+                   for i, d in enumerate(self.devices)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        if errors: raise errors[0]
+        return out
+
+    def __worker(self, dev, out, length, sweeps, barrier):
+        def resyncs(): return sum(n for k, n in dev.metrics.counters.items() if k.startswith("resync."))
+        armed = []
+        def beforeArm():
+            armed.append(resyncs())
+            barrier.wait()
+            armed.append(True)
+        try:
+            gen = dev.iterSpectra(length, sweeps, beforeArm)
+            try:
+                first = True
+                for c in gen:
+                    if first:
+                        # spectrum numbers only line units up from a first
+                        # spectrum that every unit received
+                        first = False
+                        if resyncs() > armed[0]: raise RuntimeError(f"FastFlight 2 {dev.getSerialNumber()} lost data before its first spectrum; its spectra cannot be lined up with the other units")
+                    out.put(c)
+                    if self.__stop.is_set(): break
+            finally:
+                gen.close()
+            out.put(None)
+        except BaseException as e:
+            # once past the barrier every unit has been let through; aborting
+            # it then would fail units still on their way out of wait()
+            if len(armed) < 2: barrier.abort()
+            out.put(e)
+
+    def iterSpectra(self, length, sweeps):
+        # Yields (number, chunks) with one spectrumChunk per unit, in device
+        # order, for each spectrum number counted from each unit's first
+        # spectrum. A unit that dropped a later spectrum (e.g. on a corrupt
+        # transfer) has None in its place; one that lost data before its first
+        # spectrum cannot be lined up and raises RuntimeError.
+        self.__stop.clear()
+        barrier = threading.Barrier(len(self.devices))
+        queues = [queue.Queue(maxsize=READER_DEPTH) for _ in self.devices]
+        threads = [threading.Thread(target=self.__worker, args=(d, q, length, sweeps, barrier),
+                                    name=f"FF2 {s}", daemon=True)
+                   for d, q, s in zip(self.devices, queues, self.serials)]
+        for t in threads: t.start()
+
+        heads = [deque() for _ in self.devices]
+        base = [None] * len(self.devices)
+        done = [False] * len(self.devices)
+        try:
+            while True:
+                for i, q in enumerate(queues):
+                    # block only on the units we have nothing buffered from
+                    while not heads[i] and not done[i]:
+                        c = q.get()
+                        if isinstance(c, BaseException): raise c
+                        if c is None:
+                            done[i] = True
+                            break
+                        if base[i] is None: base[i] = c.spectrumNumber
+                        heads[i].append(((c.spectrumNumber - base[i]) & CODE_DATA_MASK, c))
+                if not any(heads): return
+                number = min(h[0][0] for h in heads if h)
+                chunks = [h.popleft()[1] if h and h[0][0] == number else None for h in heads]
+                self.missing += chunks.count(None)
+                yield number, chunks
+        finally:
+            self.__stop.set()
+            for t, q in zip(threads, queues):
+                # unblock workers and drop whatever they still hand over
+                while t.is_alive():
+                    try:
+                        q.get(timeout=READER_POLL)
+                    except queue.Empty:
+                        pass
+
+    def takeSweep(self, length, sweeps):
+        # Runs takeSweep on every unit at once, arming them together; returns
+        # {serial: (index, data)} with copies of each unit's sums
+        barrier = threading.Barrier(len(self.devices))
+        def sweep(dev):
+            passed = []
+            def beforeArm():
+                barrier.wait()
+                passed.append(True)
+            try:
+                index, data = dev.takeSweep(length, sweeps, beforeArm)
+            except BaseException:
+                if not passed: barrier.abort()
+                raise
+            return index, data.copy()
+        return dict(zip(self.serials, self.forEach(sweep)))
+
+    def close(self):
+        for d in self.devices: d.stopAquisition()
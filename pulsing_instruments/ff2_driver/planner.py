@@ -0,0 +1,80 @@
+from FF2_parms import *
+from collections import namedtuple
+import math
+
+# recordsPerSpectrum of every chunk but the last, which takes `final`; slots
+# lists (protocol, records) as loaded by prepareSweep, 0 the chunk and 1 the
+# remainder (the device slots they land in come from FastFlight2.slots)
+acquisitionPlan = namedtuple("acquisitionPlan", ["recordsPerSpectrum", "chunks", "final", "slots",
+                                                 "bytesPerChunk", "chunkTime", "latency", "totalTime",
+                                                 "limitedBy"])
+
+class acquisitionPlanner:
+    # Picks recordsPerSpectrum for a sweep from measured rates. A chunk costs
+    # acquisition time (records / trigger rate) on the device and transfer +
+    # decode time plus a fixed turnaround on the host; the two overlap, since
+    # the device acquires the next chunk while the last is read out. Larger
+    # chunks amortize the turnaround but delay the first data, so the chunk is
+    # the one with the least total time whose first result arrives within
+    # maxLatency and whose transfer fits in maxMemory.
+
+    def __init__(self, maxLatency=PLAN_MAX_LATENCY, maxMemory=PLAN_MAX_MEMORY):
+        self.maxLatency = maxLatency
+        self.maxMemory = maxMemory
+        self.transferRate = PLAN_TRANSFER_RATE      # bytes/s over SPECTRA_IN
+        self.decodeRate = PLAN_DECODE_RATE          # bytes/s through the decoder
+        self.triggerRate = PLAN_TRIGGER_RATE        # records/s
+        self.overhead = PLAN_CHUNK_OVERHEAD         # s of host turnaround per chunk
+        self.observed = 0
+
+    def __blend(self, old, new):
+        if new is None or new <= 0 or not math.isfinite(new): return old
+        return new if self.observed == 0 else old + PLAN_SMOOTHING * (new - old)
+
+    def observe(self, bytesRead=0, readTime=0., bytesDecoded=0, decodeTime=0., chunkTimes=()):
+        # Updates the rates from one sweep. chunkTimes is [(arrival time,
+        # records)] per chunk; the first chunk includes arming and is skipped
+        # for the record rate.
+        self.transferRate = self.__blend(self.transferRate, bytesRead / readTime if readTime else None)
+        self.decodeRate = self.__blend(self.decodeRate, bytesDecoded / decodeTime if decodeTime else None)
+        if len(chunkTimes) > 1:
+            span = chunkTimes[-1][0] - chunkTimes[0][0]
+            records = sum(r for _, r in chunkTimes[1:])
+            # a lower bound on the trigger rate when the host kept up
+            self.triggerRate = self.__blend(self.triggerRate, records / span if span > 0 else None)
+        self.observed += 1
+
+    def chunkBytes(self, length, records):
+        # 16-bit groups only while the sums stay below 0xff00
+        g = 2 if records * 255 < 0xff00 else 3
+        return 9 + 4*(length // 4 * g + 16)
+
+    def hostTime(self, length, records):
+        b = self.chunkBytes(length, records)
+        return b / self.transferRate + b / self.decodeRate + self.overhead
+
+    def plan(self, length, sweeps, tpp=TPP):
+        # tpp in ns; a record cannot be triggered faster than it is long
+        trig = min(self.triggerRate, 1e9 / (length * tpp)) if length else self.triggerRate
+        limit = max(1, min(0xffff, sweeps))
+        best = None
+        for k in range(17):
+            target = min(limit, 1 << k)
+            chunks = math.ceil(sweeps / target)
+            rps = math.ceil(sweeps / chunks)            # spread evenly over the chunks
+            b = self.chunkBytes(length, rps)
+            host = self.hostTime(length, rps)
+            acquire = rps / trig
+            latency = acquire + host
+            period = max(acquire, host)
+            total = (chunks - 1) * period + latency
+            ok = (latency <= self.maxLatency or rps == 1) and (b <= self.maxMemory or rps == 1)
+            key = (not ok, total if ok else latency)
+            if best is None or key < best[0]:
+                final = sweeps - (chunks - 1) * rps
+                slots = [(0, rps)] if final == rps else [(0, rps), (1, final)]
+                limitedBy = "trigger" if acquire >= host else \
+                            ("transfer" if self.transferRate <= self.decodeRate else "decode")
+                best = (key, acquisitionPlan(rps, chunks, final, slots, b, period, latency, total, limitedBy))
+            if target == limit: break
+        return best[1]
@@ -0,0 +1,53 @@
+from FF2_parms import *
+from collections import deque
+import array
+import threading
+
+class ringBuffer:
+    # Fixed set of bulk transfer buffers that are reused for the lifetime of the
+    # driver, so memory use never grows with the length of an acquisition.
+    # A slot is handed out by acquire() and given back with release(), either by
+    # index or with any view of it, once its contents have been consumed. Filling
+    # and releasing may happen on different threads and in any order.
+
+    def __init__(self, slots=RING_SLOTS, size=MAX_BULK_SIZE):
+        self.size = size
+        # pyusb only reads in place into array objects
+        self.slots = [array.array('B', bytes(size)) for _ in range(slots)]
+        self.views = [memoryview(s) for s in self.slots]
+        self.__slotOf = {id(s): i for i, s in enumerate(self.slots)}
+        self.__cond = threading.Condition()
+        self.reset()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def reset(self):
+        with self.__cond:
+            self.__free = deque(range(len(self.slots)))
+            self.__cond.notify_all()
+
+    def busy(self):
+        return len(self.slots) - len(self.__free)
+
+    def waitFree(self, timeout=None):
+        with self.__cond:
+            return self.__cond.wait_for(lambda: self.__free, timeout)
+
+    def acquire(self, timeout=0):
+        # timeout=0 fails immediately on overrun, None waits for a free slot
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: self.__free, timeout):
+                raise BufferError("Ring buffer overrun; every slot is still waiting to be decoded")
+            return self.__free.popleft()
+
+    def slotOf(self, buf):
+        if isinstance(buf, int): return buf
+        return self.__slotOf[id(buf.obj)]
+
+    def release(self, buf):
+        i = self.slotOf(buf)
+        with self.__cond:
+            if i in self.__free: raise BufferError(f"Ring buffer slot {i} released twice")
+            self.__free.append(i)
+            self.__cond.notify()
@@ -0,0 +1,296 @@
+from FF2_parms import *
+from spectrum_decoder import codeType_t
+import usb.core
+import array
+import threading
+import time
+import numpy as np
+
+SIM_BASELINE = 12.          # Mean 8-bit level of a record away from its peaks
+SIM_PEAK_ONLY, SIM_LOSSLESS, SIM_STICK = 0x0, 0x1, 0x2    # Protocol.Compression
+
+def simCode(codeType, data):
+    return CODE_MASK | (int(codeType) << CODE_TYPE_SHIFT) | (int(data) & CODE_DATA_MASK)
+
+def encodeSpectrum(samples, number, slot=0, records=1, timestamp=0, ninth=False, bits=None,
+                   groups=None, sticks=None):
+    # One spectrum as the device sends it on SPECTRA_IN. samples must be a
+    # multiple of 4 long; bits picks the data encoding, by default 16-bit
+    # while no leading byte plane can look like a code word. groups lists
+    # the 4-sample groups to send (all by default); runs of them are jump
+    # coded, as in PEAK_ONLY mode. sticks, (times, values), replaces the
+    # samples with DATA_STICK pairs as in STICK mode.
+    head = [simCode(codeType_t.PROTOCOL, slot),
+            simCode(codeType_t.TIME_LOW, timestamp), simCode(codeType_t.TIME_HIGH, timestamp >> TIME_LOW_BITS),
+            simCode(codeType_t.ION_COUNT, records), 0, 0, 0]
+
+    if sticks is not None:
+        times, values = sticks
+        body = np.empty((len(times), 2), dtype='<u4')
+        body[:, 0] = [simCode(codeType_t.DATA_STICK, t) for t in times]
+        body[:, 1] = values
+        body = body.ravel()
+    else:
+        if bits is None: bits = 16 if samples.max() < 0xff00 else 24
+        g, ct = (2, codeType_t.DATA_16BIT) if bits == 16 else (3, codeType_t.DATA_24BIT)
+        n = len(samples) // 4
+        planes = np.empty((n, g, 4), dtype=np.uint8)
+        s = samples.reshape(n, 4)
+        for j in range(g):
+            planes[:, j, ::-1] = (s >> (8 * (g - 1 - j))) & 0xff
+        words = planes.view('<u4').reshape(n, g)
+        if groups is None: groups = np.arange(n)
+        groups = np.asarray(groups)
+        starts = np.flatnonzero(np.diff(groups, prepend=-2) != 1)
+        parts = []
+        for a, b in zip(starts, list(starts[1:]) + [len(groups)]):
+            parts.append(np.array([simCode(ct, 4 * groups[a])], dtype='<u4'))
+            parts.append(words[groups[a]:groups[b - 1] + 1].ravel())
+        body = np.concatenate(parts) if parts else np.zeros(0, dtype='<u4')
+
+    total = 2 + 2 + len(head) + len(body) + 1
+    words = np.array([simCode(codeType_t.SPECTRUM_BEGIN, number),
+                      simCode(codeType_t.SPECTRUM_BEGIN, total)] + head, dtype='<u4')
+    # the device sometimes sends a ninth 0xff; always do so when the
+    # spectrum number would otherwise run into the sync marker
+    sync = b"\xff" * (9 if ninth or number & 0xff == 0xff else 8)
+    return (sync + words.tobytes() + body.astype('<u4').tobytes()
+            + np.array([simCode(codeType_t.SPECTRUM_END, total)], dtype='<u4').tobytes())
+
+class simulatedFF2:
+    # Stands in for the pyusb device under usbInterface, so FastFlight2 can be
+    # driven without hardware: FastFlight2(dev=simulatedFF2()). It answers the
+    # parameter, memory and firmware commands the driver sends, keeps the 16
+    # protocol slots in its memory map and, while RUN is set, produces one
+    # spectrum per SPECTRA_IN read once the last one has been drained, encoded
+    # the way the decoder expects.
+    #
+    # rate limits the SPECTRA_IN byte rate (bytes/s, None for unlimited),
+    # triggerRate the records per second (None for instant spectra) and
+    # corruption is the probability that a spectrum has one byte overwritten.
+    # The transfer engine needs a real libusb handle; leave inflight at 0.
+
+    idVendor = FF2_VID
+    idProduct = FF2_PID
+    iManufacturer, iProduct, iSerialNumber = 1, 2, 3
+    simulated = True        # lets FastFlight2 send settings not yet verified on hardware
+
+    def __init__(self, serial="SIM00001", rate=None, triggerRate=None, corruption=0.,
+                 peaks=8, noise=2., seed=None, loaded=True):
+        self.serial = serial
+        self.rate = rate
+        self.triggerRate = triggerRate
+        self.corruption = corruption
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.peaks = peaks
+
+        self.mem = bytearray(0x10000)
+        self.params = {}
+        self.loaded = loaded
+        self.__lock = threading.Lock()
+        self.__acks = bytearray()
+        self.__dance = [-m for m in STRANGE_DANCE if m < 0]
+        self.__danceStep = 0
+        self.__templates = {}
+
+        self.spectrumNumber = 0
+        self.requests = 0
+        self.bytesSent = 0
+        self.corrupted = 0
+        self.__stopRun()
+        self.__resetTimer()
+
+    def getString(self, index):
+        return {self.iManufacturer: "ORTEC", self.iProduct: "FastFlight-2 (simulated)",
+                self.iSerialNumber: self.serial}[index]
+
+    def set_configuration(self): pass
+    def clear_halt(self, ep): pass
+
+    # Control endpoint
+
+    def write(self, endpoint, data, timeout=None):
+        data = bytes(data)
+        with self.__lock:
+            if endpoint == SPECTRA_OUT:
+                self.requests += 1
+            elif endpoint == CONTROL_OUT:
+                self.__acks.append(self.__command(data))
+            else:
+                raise usb.core.USBError(f"Simulated device has no OUT endpoint 0x{endpoint:02x}")
+        return len(data)
+
+    def __command(self, data):
+        c = data[0]
+        if c == SET_CMD and len(data) == 3:
+            self.params[data[1]] = data[2]
+            return 1
+        if c == GET_CMD and len(data) == 2:
+            if data[1] == 0x10 and self.__danceStep < len(self.__dance):
+                # readback of the configuration shift register during the dance
+                v = self.__dance[self.__danceStep]
+                self.__danceStep += 1
+                return v & 0xff
+            return self.params.get(data[1], 0)
+        if c == 0x0f: return 1 if self.loaded else 0
+        if c == 0x12:
+            self.__pending = bytearray()
+            return 1
+        if c == 0x0e and len(data) == 2:
+            if data[1] == 0x00:
+                self.loaded = True
+                self.__danceStep = 0
+            return 0
+        return 0        # chip select or firmware hunk
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        with self.__lock:
+            if bRequest == 0xa2 and wValue == 0xfff0:
+                return array.array('B', [0x42] + [0xff]*7)[:data_or_wLength]
+            if bRequest != MEMORY_SET_REQUEST:
+                raise usb.core.USBError(f"Simulated device does not handle request 0x{bRequest:02x}")
+            if isinstance(data_or_wLength, int):
+                return array.array('B', self.mem[wValue:wValue + data_or_wLength])
+            data = bytes(data_or_wLength)
+            self.mem[wValue:wValue + len(data)] = data
+            if wValue <= MISC_CNTRL_PTR < wValue + len(data): self.__control(data[MISC_CNTRL_PTR - wValue])
+            return len(data)
+
+    def __control(self, v):
+        if v & TIMER_RESET_MASK: self.__resetTimer()
+        if v & RUN_MASK and not self.running:
+            self.running = True
+            self.__runStart = time.perf_counter()
+            self.__records = 0
+            self.__sendStart = self.__runStart
+            self.__sent = 0
+            self.__latched = self.mem[PROTOCOL_SET_PTR] % 16
+        elif not v & RUN_MASK:
+            self.running = False
+
+    def __stopRun(self):
+        self.running = False
+        self.__pending = bytearray()
+        self.__sendStart = time.perf_counter()
+        self.__sent = 0
+
+    def __resetTimer(self):
+        self.__timerStart = time.perf_counter()
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        if endpoint == CONTROL_IN:
+            with self.__lock:
+                n = size_or_buffer if isinstance(size_or_buffer, int) else len(size_or_buffer)
+                if not self.__acks: raise usb.core.USBTimeoutError("Simulated device has no response pending", 0, 110)
+                out, self.__acks = self.__acks[:n], self.__acks[n:]
+            return self.__deliver(out, size_or_buffer)
+        if endpoint != SPECTRA_IN:
+            raise usb.core.USBError(f"Simulated device has no IN endpoint 0x{endpoint:02x}")
+
+        size = size_or_buffer if isinstance(size_or_buffer, int) else len(size_or_buffer)
+        deadline = time.perf_counter() + (timeout or 1000) / 1000.
+        with self.__lock:
+            if not self.__pending and self.running:
+                ready = self.__spectrumDue()
+                if ready > deadline:
+                    # the real device holds the transfer until it times out
+                    wait = deadline
+                else:
+                    wait = ready
+                    self.__pending = self.__spectrum()
+            else:
+                wait = 0
+            out = bytes(self.__pending[:size])
+            del self.__pending[:size]
+            self.__sent += len(out)
+            self.bytesSent += len(out)
+            if out and self.rate: wait = max(wait, self.__sendStart + self.__sent / self.rate)
+
+        delay = wait - time.perf_counter()
+        if delay > 0: time.sleep(delay)
+        if not out: raise usb.core.USBTimeoutError("Simulated SPECTRA_IN read timed out", 0, 110)
+        return self.__deliver(out, size_or_buffer)
+
+    def __deliver(self, out, size_or_buffer):
+        if isinstance(size_or_buffer, int): return array.array('B', out)
+        memoryview(size_or_buffer).cast('B')[:len(out)] = out
+        return len(out)
+
+    # Spectrum generation
+
+    def slotSettings(self, slot):
+        # (points, recordsPerSpectrum, compression) as encoded by encodeProtocol
+        base = PROTOCOL_BASE + slot*PROTOCOL_STEP
+        b1 = self.mem[base:base + PROTOCOL_B2_OFFSET]
+        b2 = self.mem[base + PROTOCOL_B2_OFFSET:base + PROTOCOL_STEP]
+        points = (b2[9] | b2[0xa] << 8 | (b2[0xb] & 0x1f) << 16) + 2
+        rps = b1[5] | b1[6] << 8
+        return max(points, 8), max(rps, 1), b2[0] & 0x0f
+
+    def __spectrumDue(self):
+        if not self.triggerRate: return 0
+        _, rps, _ = self.slotSettings(self.__latched)
+        return self.__runStart + (self.__records + rps) / self.triggerRate
+
+    def __template(self, points):
+        # mean 8-bit level of one record: a baseline with a few gaussian peaks
+        t = self.__templates.get(points)
+        if t is None:
+            x = np.arange(points)
+            t = np.full(points, SIM_BASELINE)
+            for c, h, w in zip(self.rng.uniform(0, points, self.peaks),
+                               self.rng.uniform(20, 200, self.peaks),
+                               self.rng.uniform(2, 40, self.peaks)):
+                t += h * np.exp(-0.5 * ((x - c) / w)**2)
+            self.__templates[points] = t
+        return t
+
+    def __samples(self, points, rps):
+        s = self.__template(points) * rps
+        s += self.rng.standard_normal(points) * (self.noise * np.sqrt(rps))
+        return np.clip(np.rint(s), 0, 255 * rps).astype(np.uint32)
+
+    def __peaks(self, slot, points):
+        # points where the mean record rises more than minimumThreshold above
+        # the baseline, the device's idea of a peak here
+        threshold = self.mem[PROTOCOL_BASE + slot*PROTOCOL_STEP + PROTOCOL_B2_OFFSET + 0x0c]
+        return self.__template(points) - SIM_BASELINE > threshold
+
+    def __sticks(self, samples, above, rps):
+        # one (centroid, area above baseline) per run of peak points
+        edges = np.flatnonzero(np.diff(above.astype(np.int8), prepend=0, append=0))
+        starts, ends = edges[0::2], edges[1::2]
+        if len(starts) == 0: return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint32)
+        excess = np.clip(samples - SIM_BASELINE * rps, 0, None)
+        cs = np.concatenate(([0.], np.cumsum(excess)))
+        cm = np.concatenate(([0.], np.cumsum(excess * np.arange(len(excess)))))
+        area, moment = cs[ends] - cs[starts], cm[ends] - cm[starts]
+        centre = np.where(area > 0, moment / np.maximum(area, 1), (starts + ends - 1) / 2)
+        return np.rint(centre).astype(np.uint32), np.rint(area).astype(np.uint32)
+
+    def __spectrum(self):
+        slot = self.__latched
+        points, rps, compression = self.slotSettings(slot)
+        points -= points % 4
+        samples = self.__samples(points, rps)
+        # stamped when the last record came in, not when the host reads it
+        closed = self.__spectrumDue() if self.triggerRate else time.perf_counter()
+        t = int((closed - self.__timerStart) / TIME_TICK)
+        num = self.spectrumNumber & CODE_DATA_MASK
+        kw = {}
+        if compression == SIM_PEAK_ONLY:
+            kw["groups"] = np.flatnonzero(self.__peaks(slot, points).reshape(-1, 4).any(axis=1))
+        elif compression == SIM_STICK:
+            kw["sticks"] = self.__sticks(samples, self.__peaks(slot, points), rps)
+        out = bytearray(encodeSpectrum(samples, num, slot, rps, t, ninth=self.rng.random() < 0.5, **kw))
+
+        if self.corruption and self.rng.random() < self.corruption:
+            out[int(self.rng.integers(9, len(out)))] = int(self.rng.integers(0, 256))
+            self.corrupted += 1
+
+        self.spectrumNumber += 1
+        self.__records += rps
+        # the next spectrum is already being acquired with the slot selected now
+        self.__latched = self.mem[PROTOCOL_SET_PTR] % 16
+        return out
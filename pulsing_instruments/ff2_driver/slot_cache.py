@@ -0,0 +1,59 @@
+from FF2_parms import *
+from collections import OrderedDict
+
+class protocolSlots:
+    # Which Protocol each device slot holds. Protocols hash by their quantized
+    # values, so equal settings find the slot they already sit in and
+    # selecting them again is a single setProtocol write. A new Protocol takes
+    # an empty slot, else the least recently used one not in keep (the slots
+    # the acquisition being set up already relies on). contents[slot] is what
+    # was last written there, which sendProtocol diffs against.
+
+    def __init__(self, size):
+        self.size = size
+        self.forget()
+
+    def forget(self):
+        # slot contents are unknown again (reset, firmware load)
+        self.contents = [None] * self.size
+        self.__lru = OrderedDict()      # Protocol -> slot, least recently used first
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.__lru)
+
+    def __contains__(self, p):
+        return p in self.__lru
+
+    def lookup(self, p):
+        # slot holding p (now the most recently used), or None
+        slot = self.__lru.get(p)
+        if slot is not None: self.__lru.move_to_end(p)
+        return slot
+
+    def store(self, p, slot):
+        # records that slot now holds p
+        old = self.contents[slot]
+        if old is not None and self.__lru.get(old) == slot: del self.__lru[old]
+        self.contents[slot] = p
+        self.__lru[p] = slot
+        self.__lru.move_to_end(p)
+
+    def victim(self, keep=()):
+        # slot for a Protocol that is not resident
+        keep = set(keep)
+        for slot, p in enumerate(self.contents):
+            # empty, or a second copy of a Protocol resident elsewhere
+            if slot not in keep and (p is None or self.__lru.get(p) != slot): return slot
+        for slot in self.__lru.values():
+            if slot not in keep: return slot
+        raise ValueError(f"All {self.size} protocol slots are in use")
+
+    def assign(self, p, keep=()):
+        # (slot, resident): the slot for p and whether it already holds it
+        slot = self.lookup(p)
+        if slot is not None:
+            self.hits += 1
+            return slot, True
+        self.misses += 1
+        return self.victim(keep), False
@@ -0,0 +1,138 @@
+import numpy as np
+
+def runUnion(starts, lengths):
+    # Ascending, merged runs covering every point of the given (possibly
+    # overlapping or touching) runs; returns (starts, lengths).
+    starts = np.asarray(starts, dtype=np.int64)
+    if len(starts) == 0: return starts, np.zeros(0, dtype=np.int64)
+    order = np.argsort(starts, kind="stable")
+    s = starts[order]
+    reach = np.maximum.accumulate(s + np.asarray(lengths, dtype=np.int64)[order])
+    first = np.flatnonzero(np.concatenate(([True], s[1:] > reach[:-1])))
+    last = np.append(first[1:], len(s)) - 1
+    return s[first], reach[last] - s[first]
+
+class sparseSpectrum:
+    # A spectrum of `length` points stored as runs of samples, the way
+    # zero-suppressed (jump coded) data arrives: run i covers points
+    # starts[i] .. starts[i] + lengths[i] - 1 and its samples are
+    # values[offsets[i]:offsets[i] + lengths[i]]. Every other point is zero.
+
+    def __init__(self, length, starts, lengths, values):
+        starts = np.asarray(starts, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        keep = lengths > 0
+        if not keep.all():
+            # drop empty runs along with their (empty) share of values
+            starts, lengths = starts[keep], lengths[keep]
+        self.length = length
+        self.starts = starts
+        self.lengths = lengths
+        self.offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        self.values = values
+
+    @classmethod
+    def fromDense(cls, data):
+        nz = np.flatnonzero(data)
+        if len(nz) == 0: return cls(len(data), [], [], data[:0].copy())
+        breaks = np.flatnonzero(np.diff(nz) != 1)
+        starts = nz[np.concatenate(([0], breaks + 1))]
+        ends = nz[np.append(breaks, len(nz) - 1)] + 1
+        return cls(len(data), starts, ends - starts, data[nz].copy())
+
+    def __len__(self):
+        return self.length
+
+    def stored(self):
+        # samples actually held
+        return len(self.values)
+
+    def runs(self):
+        return [(int(s), self.values[o:o + n]) for s, o, n in zip(self.starts, self.offsets, self.lengths)]
+
+    def sameRuns(self, other):
+        return np.array_equal(self.starts, other.starts) and np.array_equal(self.lengths, other.lengths)
+
+    def indices(self):
+        # point index of every stored sample
+        return np.repeat(self.starts - self.offsets, self.lengths) + np.arange(len(self.values))
+
+    def placement(self, starts, offsets):
+        # index of every stored sample within a layout whose runs cover ours
+        u = np.searchsorted(starts, self.starts, side="right") - 1
+        shift = offsets[u] + (self.starts - starts[u]) - self.offsets
+        return np.repeat(shift, self.lengths) + np.arange(len(self.values))
+
+    def relayout(self, starts, lengths, dtype=None):
+        # the same spectrum stored in the given (covering) runs
+        out = sparseSpectrum(self.length, starts, lengths, None)
+        out.values = np.zeros(int(out.lengths.sum()), dtype=dtype or self.values.dtype)
+        if len(self.values): out.values[self.placement(out.starts, out.offsets)] = self.values
+        return out
+
+    def normalized(self):
+        # runs sorted and merged; later runs win where runs overlap, as a
+        # jump backwards overwrites in the dense decoder
+        if len(self.starts) < 2 or (np.all(self.starts[1:] > self.starts[:-1] + self.lengths[:-1])):
+            return self
+        return self.relayout(*runUnion(self.starts, self.lengths))
+
+    def toDense(self, out=None, dtype=None):
+        if out is None:
+            out = np.zeros(self.length, dtype=dtype or self.values.dtype)
+        else:
+            out = out[:self.length]
+            out[:] = 0
+        if len(self.values): out[self.indices()] = self.values
+        return out
+
+    def copy(self):
+        return sparseSpectrum(self.length, self.starts.copy(), self.lengths.copy(), self.values.copy())
+
+    def scale(self, f):
+        # in place; integer samples become float64 for a fractional factor
+        if self.values.dtype.kind != 'f' and f != int(f): self.values = self.values.astype(np.float64)
+        self.values *= f if self.values.dtype.kind == 'f' else int(f)
+        return self
+
+    def __add__(self, other):
+        acc = sparseAccumulator()
+        acc.reset(max(self.length, other.length))
+        acc.add(self)
+        acc.add(other)
+        return acc.sum
+
+class sparseAccumulator:
+    # Running sum of sparseSpectrum chunks. While the chunks keep the same
+    # runs (the usual case: the same peaks every chunk) adding one is a
+    # single vector add over the stored samples; a chunk with new runs
+    # widens the layout to the union of both. Records are kept by the caller.
+
+    def __init__(self, dtype=np.int64):
+        self.dtype = np.dtype(dtype)
+        self.reset(0)
+
+    def reset(self, length, dtype=None):
+        if dtype is not None: self.dtype = np.dtype(dtype)
+        self.length = length
+        self.sum = sparseSpectrum(length, [], [], np.zeros(0, dtype=self.dtype))
+        self.count = 0
+        self.records = 0
+
+    def add(self, spec):
+        if spec.length > self.length: raise IndexError(f"Chunk of {spec.length} points does not fit accumulator of {self.length}")
+        spec = spec.normalized()
+        s = self.sum
+        dtype = np.result_type(s.values.dtype, spec.values.dtype)
+        if dtype != s.values.dtype: s.values = s.values.astype(dtype)
+        if spec.sameRuns(s):
+            s.values += spec.values
+        else:
+            starts, lengths = runUnion(np.concatenate((s.starts, spec.starts)), np.concatenate((s.lengths, spec.lengths)))
+            if not (np.array_equal(starts, s.starts) and np.array_equal(lengths, s.lengths)):
+                s = self.sum = s.relayout(starts, lengths)
+            s.values[spec.placement(s.starts, s.offsets)] += spec.values
+        self.count += 1
+
+    def toDense(self, out=None):
+        return self.sum.toDense(out)
@@ -0,0 +1,454 @@
+from FF2_parms import *
+from sparse import sparseSpectrum
+from collections import deque
+from bisect import bisect_left
+from enum import IntEnum
+import numpy as np
+import struct
+import time
+
+class codeType_t(IntEnum):
+    DATA_16BIT = 0x00
+    DATA_24BIT = 0x01
+    DATA_STICK = 0x02
+    SPECTRUM_BEGIN = 0x03
+    SPECTRUM_END = 0x03
+    TIME_LOW = 0x04
+    TIME_HIGH = 0x05
+    PROTOCOL = 0x06
+    ION_COUNT = 0x07
+    SYNC = 0x07
+    NOT_CODE = 0xFF
+
+def codeTypeOf(word):
+    if (word & CODE_MASK) != CODE_MASK: return codeType_t.NOT_CODE
+    return codeType_t((word & CODE_TYPE_MASK) >> CODE_TYPE_SHIFT)
+
+# Words per group of 4 samples following a data code word
+GROUP_WORDS = {codeType_t.DATA_16BIT: 2, codeType_t.DATA_24BIT: 3}
+
+class _code:
+    # codeType_t values as plain ints; enum member lookups dominate the
+    # per-code cost of short spectra
+    DATA_16BIT, DATA_24BIT, DATA_STICK = 0x00, 0x01, 0x02
+    SPECTRUM_END, TIME_LOW, TIME_HIGH, PROTOCOL, ION_COUNT = 0x03, 0x04, 0x05, 0x06, 0x07
+
+# Groups up to which a data run is unpacked in Python rather than numpy
+SMALL_RUN = 4
+
+# Bytes borrowed from the next buffer to finish a record straddling two buffers
+SPLICE_LEN = 64
+
+SYNC_MARKER = b"\xff" * 8
+SYNC_WINDOW = 4096          # Bytes searched at a time for a lost sync marker
+
+# One peak of a STICK mode spectrum: its time index and integrated value
+STICK_DTYPE = np.dtype([("time", "<u4"), ("value", "<u4")])
+NO_STICKS = np.zeros(0, dtype=STICK_DTYPE)
+STICK_CODE = CODE_MASK | (codeType_t.DATA_STICK << CODE_TYPE_SHIFT)
+
+# Element types a spectrum may be decoded into
+SPECTRUM_DTYPES = (np.dtype(np.uint16), np.dtype(np.uint32), np.dtype(np.int64), np.dtype(np.float64))
+
+class spectrumDecoder:
+    # Decodes the SPECTRA_IN byte stream block-wise. Bulk buffers are viewed as
+    # little-endian uint32 words; only code words are visited in Python, data
+    # runs between them are expanded with numpy.
+
+    SYNC, HEADER, BODY = range(3)
+
+    def __init__(self, metrics=None, dtype=np.uint32):
+        # metrics, a driverMetrics, counts resyncs by cause and data jumps;
+        # dtype is that of spectra decode() allocates itself
+        self.metrics = metrics
+        self.setDtype(dtype)
+        self.sparse = False
+        self.bytesDecoded = 0
+        self.decodeTime = 0.
+        self.__inputs = deque()
+        self.reset()
+
+    def reset(self):
+        while self.__inputs:
+            _, buf, done = self.__inputs.popleft()
+            if done is not None: done(buf)
+        self.__pos = 0
+        self.__carry = b""
+        self.__cache = None
+
+        self.__state = self.SYNC
+        self.__ffRun = 0
+        self.__ninthPending = False
+
+        self.__data = None
+        self.__runs = None
+        self.__fill = 0
+        self.__out = None
+        self.__length = 0
+        self.__index = 0
+        self.__words = 0
+        self.__lastCodeType = codeType_t.SPECTRUM_BEGIN
+
+        self.spectrumNumber = -1
+        self.spectrumLength = 0
+        self.lastProtocol = 0
+        self.overload = 0
+        self.sticks = NO_STICKS         # of the last spectrum returned
+        self.timestamp = -1             # device time of the last spectrum, in TIME_TICK, -1 if not sent
+        self.__timeLow = self.__timeHigh = -1
+        self.__sticks = []
+
+    def feed(self, buf, done=None):
+        # buf is decoded in place, without copying; done(buf) is called once the
+        # decoder no longer needs it so the caller may reuse the memory.
+        if buf is None: return
+        if len(buf) == 0:
+            if done is not None: done(buf)
+            return
+        self.__inputs.append((np.frombuffer(buf, dtype=np.uint8), buf, done))
+
+    def setDtype(self, dtype):
+        dtype = np.dtype(dtype)
+        if dtype not in SPECTRUM_DTYPES: raise TypeError(f"Spectra decode to one of {[d.name for d in SPECTRUM_DTYPES]}, not {dtype.name}")
+        self.dtype = dtype
+
+    def setSparse(self, state):
+        # When set, decode() returns a sparseSpectrum holding only the runs
+        # of samples the device sent, built from the jump codes; the samples
+        # go into out (or a new array) back to back instead of at their
+        # point index.
+        self.sparse = state
+
+    def pending(self):
+        return sum(len(b) for b, _, _ in self.__inputs) - self.__pos + len(self.__carry)
+
+    def throughput(self):
+        # MB/s over everything decoded since construction
+        if self.decodeTime == 0: return 0.
+        return self.bytesDecoded / self.decodeTime / 1e6
+
+    def decode(self, length, out=None):
+        # Returns (index, data) for the next complete spectrum, or None once the
+        # fed buffers are exhausted. With out (an array of one of
+        # SPECTRUM_DTYPES, at least length long) data is out[:length],
+        # overwritten by the next spectrum; pass the same out until a spectrum
+        # is returned. Otherwise every spectrum gets a new array of self.dtype.
+        if out is not None:
+            if out.dtype not in SPECTRUM_DTYPES: raise TypeError(f"Cannot decode into a {out.dtype.name} array")
+            if len(out) < length: raise ValueError(f"Output of {len(out)} samples is shorter than the spectrum ({length})")
+        self.__out = out
+        t0 = time.perf_counter()
+        try:
+            while self.__inputs:
+                b = self.__inputs[0][0]
+                if self.__carry:
+                    res = self.__splice(b, length)
+                    if res is not None: return res
+                    continue
+
+                start = self.__pos
+                pos, res = self.__run(b, start, length)
+                self.bytesDecoded += pos - start
+                if res is not None:
+                    self.__pos = pos
+                    return res
+                self.__carry = bytes(b[pos:])
+                self.__nextInput()
+            return None
+        finally:
+            self.decodeTime += time.perf_counter() - t0
+
+    def __nextInput(self):
+        _, buf, done = self.__inputs.popleft()
+        if done is not None: done(buf)
+        self.__pos = 0
+        self.__cache = None
+
+    def __splice(self, b, length):
+        # Finish the record left over from the previous buffer using a small
+        # copy of the head of this one; everything after it is decoded in place.
+        carry = self.__carry
+        scratch = np.frombuffer(carry + bytes(b[self.__pos:self.__pos + SPLICE_LEN]), dtype=np.uint8)
+        pos, res = self.__run(scratch, 0, length)
+        self.__cache = None
+        if pos >= len(carry):
+            self.bytesDecoded += pos - len(carry)
+            self.__pos += pos - len(carry)
+            self.__carry = b""
+            if self.__pos >= len(b) and res is None: self.__nextInput()
+        elif res is not None:
+            self.__carry = carry[pos:]
+        else:
+            self.__carry = bytes(scratch[pos:])
+            self.__nextInput()
+        return res
+
+    def __run(self, b, pos, length):
+        end = len(b)
+        while True:
+            if self.__state == self.SYNC:
+                pos = self.__synchronize(b, pos, end)
+                if self.__state == self.SYNC: return pos, None
+            elif self.__state == self.HEADER:
+                if end - pos < 8: return pos, None
+                pos = self.__header(b, pos, length)
+            else:
+                pos, res, more = self.__body(b, pos, end)
+                if res is not None or more: return pos, res
+
+    def __count(self, name):
+        if self.metrics is not None: self.metrics.count(name)
+
+    def __resync(self):
+        self.__state = self.SYNC
+        self.__ffRun = 0
+        self.__ninthPending = False
+
+    def __synchronize(self, b, pos, end):
+        # look for spectrum sync marker (8 bytes of 0xff); it normally follows
+        # the last spectrum directly, so only a miss scans ahead, a window at
+        # a time so the scan never reaches further than the marker
+        skipped = False
+        while not self.__ninthPending:
+            need = 8 - self.__ffRun
+            if end - pos >= need and b[pos:pos + need].tobytes() == SYNC_MARKER[:need]:
+                pos += need
+                self.__ffRun = 0
+                self.__ninthPending = True
+                break
+            if pos >= end: break
+            seg = b[pos:min(end, pos + SYNC_WINDOW)]
+            nz = np.flatnonzero(seg != 0xff)
+            bounds = np.concatenate(([-1 - self.__ffRun], nz, [len(seg)]))
+            gaps = np.diff(bounds) - 1
+            found = np.flatnonzero(gaps >= 8)
+            if len(found) == 0:
+                skipped = skipped or len(nz) > 0
+                self.__ffRun = min(int(gaps[-1]), 7)
+                pos += len(seg)
+                continue
+            skipped = skipped or found[0] > 0
+            pos += int(bounds[found[0]]) + 9
+            self.__ffRun = 0
+            self.__ninthPending = True
+        # bytes that were not part of any spectrum, e.g. a corrupted marker
+        if skipped: self.__count("resync.skipped")
+
+        if not self.__ninthPending or pos >= end: return pos
+        # we may have been mislead by the final 0xff from an old command
+        if b[pos] == 0xff: pos += 1
+        self.__ninthPending = False
+        self.__state = self.HEADER
+        return pos
+
+    def __header(self, b, pos, length):
+        t, u = struct.unpack_from('<II', b, pos)
+        for w in (t, u):
+            pos += 4
+            if codeTypeOf(w) != codeType_t.SPECTRUM_BEGIN:
+                print(f"Corrupt spectrum on spectrum length; got 0x{w:08x}, codetype 0x{codeTypeOf(w):x}")
+                self.__count("resync.header")
+                self.__resync()
+                return pos
+
+        self.spectrumNumber = t & CODE_DATA_MASK
+        self.spectrumLength = u & CODE_DATA_MASK
+        self.__length = length
+        if self.sparse:
+            # every 16-bit data word carries two samples, so the header's
+            # word count bounds what can arrive
+            cap = min(length, 2*self.spectrumLength)
+            self.__data = self.__out[:cap] if self.__out is not None else np.empty(cap, dtype=self.dtype)
+            self.__runs = []
+            self.__fill = 0
+        elif self.__out is not None:
+            self.__data = self.__out[:length]
+            self.__data[:] = 0
+            self.__runs = None
+        else:
+            self.__data = np.zeros(length, dtype=self.dtype)
+            self.__runs = None
+        self.__index = 0
+        self.__words = 2
+        self.__sticks = []
+        self.__timeLow = self.__timeHigh = -1
+        self.__lastCodeType = codeType_t.SPECTRUM_BEGIN
+        self.__state = self.BODY
+        return pos
+
+    def __wordsAt(self, b, pos, end):
+        # Word view of b in the current alignment, plus the positions of every
+        # word whose top byte marks it as a candidate code word. Cached per buffer
+        # so that many short spectra in one transfer are not rescanned.
+        # The candidates and their words are kept as lists, as they are
+        # visited one at a time.
+        c = self.__cache
+        if c is not None and c[0] is b and (pos - c[1]) % 4 == 0 and pos >= c[1]:
+            return c[1:]
+        n = (end - pos) // 4
+        w = b[pos:pos + 4*n].view('<u4')
+        cand = np.flatnonzero((w & CODE_MASK) == CODE_MASK)
+        self.__cache = (b, pos, w, cand.tolist(), w[cand].tolist())
+        return self.__cache[1:]
+
+    def __body(self, b, pos, end):
+        # Returns (pos, result, needMoreData)
+        base, w, cand, codes = self.__wordsAt(b, pos, end)
+        nw = len(w)
+        nc = len(cand)
+        k = (pos - base) // 4
+        j = bisect_left(cand, k)
+
+        while True:
+            g = GROUP_WORDS.get(self.__lastCodeType, 1)
+            while j < nc and (cand[j] < k or (cand[j] - k) % g): j += 1
+            c = cand[j] if j < nc else nw
+            n = (c - k) // g
+
+            if n > 0:
+                if g == 1:
+                    print(f"Unknown data type following code 0x{self.__lastCodeType:x}")
+                    self.__count("decode.unknownData")
+                else:
+                    room = max(0, self.__length - self.__index) // 4
+                    if self.__runs is not None: room = min(room, (len(self.__data) - self.__fill) // 4)
+                    if n > room:
+                        print(f"Too many data bytes; {self.__index + 4*(room + 1)}>{self.__length}. Retrying")
+                        self.__count("resync.overflow")
+                        self.__resync()
+                        return base + 4*(k + room*g + 1), None, False
+                    self.__expand(w[k:k + n*g], g, n)
+                k += n*g
+                self.__words += n*g
+
+            if c == nw: return base + 4*k, None, True
+
+            t = codes[j]
+            codeType = (t & CODE_TYPE_MASK) >> CODE_TYPE_SHIFT
+            d = t & CODE_DATA_MASK
+            extra = 0
+            if codeType == _code.ION_COUNT: extra = 1 if d == CODE_DATA_MASK else 3
+            elif codeType == _code.DATA_STICK: extra = 1
+            if c + extra >= nw: return base + 4*c, None, True
+            k = c + 1 + extra
+            self.__words += 1 + extra
+
+            match codeType:
+                case _code.DATA_16BIT | _code.DATA_24BIT:
+                    self.__lastCodeType = codeType
+                    if self.__index != d:
+                        # zero suppression: the device skipped to point d
+                        self.__count("decode.jumps")
+                        self.__index = d
+                        if self.__index > self.__length:
+                            print(f"Illegal jump to {d}; resyncing!")
+                            self.__count("resync.illegalJump")
+                            self.__resync()
+                            return base + 4*k, None, False
+                        if self.__runs is not None: self.__runs.append((d, self.__fill))
+                    elif self.__runs is not None and not self.__runs:
+                        self.__runs.append((d, self.__fill))
+
+                case _code.SPECTRUM_END:
+                    if d != self.spectrumLength:
+                        print(f"Byte count mismatch; retrying (0x{self.spectrumLength:06x} != 0x{d:06x})")
+                        self.__count("resync.byteCount")
+                        self.__resync()
+                        return base + 4*k, None, False
+                    if d*4 != 8 + 4*self.__words:
+                        print(f"Read {8 + 4*self.__words} bytes, expected {d*4}. Retrying")
+                        self.__count("resync.wordCount")
+                        self.__resync()
+                        return base + 4*k, None, False
+                    self.__resync()
+                    self.sticks = self.__stickArray()
+                    self.timestamp = -1 if self.__timeLow < 0 else (max(self.__timeHigh, 0) << TIME_LOW_BITS) | self.__timeLow
+                    if self.__runs is not None: return base + 4*k, (self.__index, self.__sparseResult()), False
+                    return base + 4*k, (self.__index, self.__data), False
+
+                case _code.DATA_STICK:
+                    # Each stick is its code word (time index in the data
+                    # bits) and one value word; take the whole run of them
+                    # that is in view at once.
+                    self.__lastCodeType = codeType
+                    pairs = w[c:c + 2*((nw - c) // 2)].reshape(-1, 2)
+                    isStick = (pairs[:, 0] & (CODE_MASK | CODE_TYPE_MASK)) == STICK_CODE
+                    m = len(isStick) if isStick.all() else int(np.argmin(isStick))
+                    run = pairs[:m]
+                    if int((run[:, 0] & CODE_DATA_MASK).max()) >= self.__length:
+                        print("Illegal stick time; resyncing!")
+                        self.__count("resync.illegalStick")
+                        self.__resync()
+                        return base + 4*k, None, False
+                    self.__sticks.append(run.copy())
+                    k = c + 2*m
+                    self.__words += 2*(m - 1)
+
+                case _code.TIME_LOW: self.__timeLow = d
+                case _code.TIME_HIGH: self.__timeHigh = d
+
+                case _code.PROTOCOL: self.lastProtocol = d
+
+                case _code.ION_COUNT:
+                    u = int(w[c + 1])
+                    if d == CODE_DATA_MASK:
+                        if u == 0xffffffff:
+                            print("Unexpected synchronize; restarting.")
+                            self.__count("resync.sync")
+                            self.__state = self.HEADER
+                        else:
+                            print("Unexpected partial resync; restarting.")
+                            self.__count("resync.partialSync")
+                            self.__resync()
+                        return base + 4*k, None, False
+
+                    self.overload = 0
+                    if u & 0x00008000: self.overload |= OVERLOAD
+                    if u & 0x80000000: self.overload |= UNDERLOAD
+
+    def __sparseResult(self):
+        starts = np.fromiter((s for s, _ in self.__runs), dtype=np.int64, count=len(self.__runs))
+        fills = np.fromiter((f for _, f in self.__runs), dtype=np.int64, count=len(self.__runs))
+        lengths = np.diff(np.append(fills, self.__fill))
+        return sparseSpectrum(self.__length, starts, lengths, self.__data[:self.__fill])
+
+    def __stickArray(self):
+        if not self.__sticks: return NO_STICKS
+        raw = np.concatenate(self.__sticks) if len(self.__sticks) > 1 else self.__sticks[0]
+        self.__sticks = []
+        s = np.empty(len(raw), dtype=STICK_DTYPE)
+        s["time"] = raw[:, 0] & CODE_DATA_MASK
+        s["value"] = raw[:, 1]
+        return s
+
+    def __expand(self, words, g, n):
+        # Each group carries one byte plane per word, most significant plane
+        # first; byte k of every plane (counting from the MSB) belongs to sample k.
+        if g == 3 and self.__data.dtype.itemsize < 4:
+            # The spectrum is given up. If it lies whole in the current buffer
+            # the next decode (with a wider out) starts over at its sync
+            # marker; if part of it was in an earlier buffer it is lost.
+            self.__resync()
+            raise OverflowError("24-bit samples do not fit a uint16 spectrum; decode into a wider type")
+        if n <= SMALL_RUN:
+            samples = []
+            for i in range(0, n*g, g):
+                hi, mid = int(words[i]), int(words[i + 1])
+                if g == 2:
+                    samples += [(hi >> s & 0xff) << 8 | mid >> s & 0xff for s in (24, 16, 8, 0)]
+                else:
+                    lo = int(words[i + 2])
+                    samples += [(hi >> s & 0xff) << 16 | (mid >> s & 0xff) << 8 | lo >> s & 0xff for s in (24, 16, 8, 0)]
+        else:
+            planes = words.view(np.uint8).reshape(n, g, 4)[:, :, ::-1].astype(np.uint32)
+            if g == 2:
+                samples = (planes[:, 0] << 8) | planes[:, 1]
+            else:
+                samples = (planes[:, 0] << 16) | (planes[:, 1] << 8) | planes[:, 2]
+            samples = samples.ravel()
+        if self.__runs is not None:
+            self.__data[self.__fill:self.__fill + 4*n] = samples
+            self.__fill += 4*n
+        else:
+            self.__data[self.__index:self.__index + 4*n] = samples
+        self.__index += 4*n
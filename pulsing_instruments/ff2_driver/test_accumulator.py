@@ -0,0 +1,55 @@
+from accumulator import sweepAccumulator, INT64_MAX
+import numpy as np
+import pytest
+
+# sweepAccumulator dtype promotion and overflow checks; run with pytest from
+# this directory.
+
+def test_integerSums():
+    acc = sweepAccumulator(8)
+    for k in range(3): acc.add(np.arange(8, dtype=np.uint32) * (k + 1))
+    assert acc.buf.dtype == np.int64
+    assert np.array_equal(acc.buf, np.arange(8) * 6)
+    # a chunk shorter than the accumulator adds into its start
+    acc.add(np.ones(4, dtype=np.uint16))
+    assert np.array_equal(acc.buf, np.arange(8) * 6 + (np.arange(8) < 4))
+
+def test_promotesToFloat():
+    acc = sweepAccumulator(4)
+    acc.add(np.array([1, 2, 3, 4], dtype=np.uint32))
+    acc.addOffset(2)
+    assert acc.buf.dtype == np.int64
+    acc.scale(0.5)
+    assert acc.buf.dtype == np.float64
+    assert np.array_equal(acc.buf, [1.5, 2., 2.5, 3.])
+    acc.add(np.array([0.25] * 4))
+    assert np.array_equal(acc.buf, [1.75, 2.25, 2.75, 3.25])
+    # fractional offsets and float subtraction promote as well
+    acc.reset(4, np.int64)
+    acc.addOffset(0.5)
+    assert acc.buf.dtype == np.float64 and np.array_equal(acc.buf, [0.5] * 4)
+    acc.reset(4, np.int64)
+    acc.subtract(np.full(4, 0.5))
+    assert acc.buf.dtype == np.float64 and np.array_equal(acc.buf, [-0.5] * 4)
+
+def test_storageReused():
+    acc = sweepAccumulator(16)
+    first = acc.buf
+    acc.toFloat()
+    acc.reset(8, np.int64)
+    assert np.shares_memory(acc.buf, first)
+    assert not acc.buf.any()
+
+def test_overflowRaises():
+    acc = sweepAccumulator(2)
+    big = np.array([INT64_MAX // 2, 0], dtype=np.int64)
+    acc.add(big)
+    acc.add(big)
+    with pytest.raises(OverflowError):
+        acc.add(np.array([2, 0], dtype=np.int64))
+    with pytest.raises(OverflowError):
+        acc.scale(2)
+    # the float path has the range
+    acc.reset(2, np.float64)
+    for _ in range(3): acc.add(big)
+    assert acc.buf[0] == pytest.approx(1.5 * INT64_MAX)
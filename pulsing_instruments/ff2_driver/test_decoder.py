@@ -0,0 +1,100 @@
+from FF2_parms import *
+from spectrum_decoder import spectrumDecoder, codeType_t
+from sim_device import encodeSpectrum
+import contextlib
+import io
+import numpy as np
+import pytest
+
+# spectrumDecoder against a word-at-a-time reference; run with pytest from
+# this directory.
+
+def referenceDecode(stream, length):
+    # [(index, samples)] of every spectrum in stream, one word at a time
+    out = []
+    b = bytes(stream)
+    pos = 0
+    while True:
+        pos = b.find(b"\xff" * 8, pos)
+        if pos < 0 or pos + 8 > len(b): return out
+        pos += 8
+        if b[pos] == 0xff: pos += 1
+        words = np.frombuffer(b[pos:pos + 4*((len(b) - pos) // 4)], dtype='<u4').tolist()
+        data = np.zeros(length, dtype=np.int64)
+        index, g, k = 0, 1, 2
+        while k < len(words):
+            w = words[k]
+            if w & CODE_MASK != CODE_MASK:
+                group = words[k:k + g]
+                shifts = [8 * (g - 1 - j) for j in range(g)]
+                for i, s in enumerate((24, 16, 8, 0)):
+                    data[index + i] = sum((x >> s & 0xff) << sh for x, sh in zip(group, shifts))
+                index += 4
+                k += g
+                continue
+            t, d = (w & CODE_TYPE_MASK) >> CODE_TYPE_SHIFT, w & CODE_DATA_MASK
+            k += 1
+            if t in (codeType_t.DATA_16BIT, codeType_t.DATA_24BIT):
+                g = 2 if t == codeType_t.DATA_16BIT else 3
+                index = d
+            elif t == codeType_t.ION_COUNT:
+                k += 3
+            elif t == codeType_t.SPECTRUM_END:
+                out.append((index, data))
+                pos += 4*k
+                break
+
+def randomStream(rng, length, count):
+    parts = []
+    for i in range(count):
+        bits = 24 if rng.random() < 0.3 else 16
+        top = 0xfeffff if bits == 24 else 0xfeff
+        samples = rng.integers(0, top, size=length, dtype=np.uint32)
+        groups = None
+        if rng.random() < 0.5:
+            groups = np.flatnonzero(rng.random(length // 4) < 0.3)
+            if len(groups) == 0: groups = None
+        parts.append(encodeSpectrum(samples, i, ninth=rng.random() < 0.5, bits=bits, groups=groups))
+        if rng.random() < 0.2:
+            # stray bytes between spectra, e.g. the tail of an old transfer
+            parts.append(rng.integers(0, 0xff, size=int(rng.integers(1, 40)), dtype=np.uint8).tobytes())
+    return b"".join(parts)
+
+def decodeAll(stream, length, cuts):
+    dec = spectrumDecoder(dtype=np.int64)
+    edges = [0] + sorted(cuts) + [len(stream)]
+    for a, b in zip(edges, edges[1:]): dec.feed(stream[a:b])
+    out = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        while (res := dec.decode(length)) is not None: out.append((res[0], res[1].copy()))
+    return out
+
+@pytest.mark.parametrize("length", [4, 16, 256, 4096])
+def test_matchesReference(length):
+    rng = np.random.default_rng(length)
+    stream = randomStream(rng, length, max(4, 8000 // length))
+    ref = referenceDecode(stream, length)
+    for trial in range(5):
+        cuts = rng.integers(0, len(stream), size=int(rng.integers(0, 40))).tolist()
+        got = decodeAll(stream, length, cuts)
+        assert len(got) == len(ref)
+        for (i, a), (j, b) in zip(got, ref):
+            assert i == j
+            assert np.array_equal(a, b)
+
+def test_manyShortSpectraInOneBuffer():
+    # the sync check must not rescan the rest of the buffer per spectrum
+    rng = np.random.default_rng(0)
+    stream = randomStream(rng, 16, 2000)
+    assert len(decodeAll(stream, 16, [])) == len(referenceDecode(stream, 16))
+
+def test_24BitIntoUint16():
+    # a whole spectrum in the buffer is decoded again with a wider out
+    samples = np.arange(16, dtype=np.uint32) + 0x10000
+    dec = spectrumDecoder()
+    dec.feed(encodeSpectrum(samples, 1, bits=24))
+    with pytest.raises(OverflowError):
+        dec.decode(16, np.zeros(16, dtype=np.uint16))
+    with contextlib.redirect_stdout(io.StringIO()):
+        index, data = dec.decode(16, np.zeros(16, dtype=np.uint32))
+    assert np.array_equal(data, samples)
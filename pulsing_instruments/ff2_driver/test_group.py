@@ -0,0 +1,42 @@
+from FF2_parms import *
+from fastflight2 import FastFlight2
+from multi_device import deviceGroup
+from sim_device import simulatedFF2
+import contextlib
+import io
+import pytest
+
+# deviceGroup on simulated units; run with pytest from this directory.
+
+class firstSpectrumCorrupt(simulatedFF2):
+    # garbles the sync marker of the first spectrum it sends
+    def _simulatedFF2__spectrum(self):
+        out = super()._simulatedFF2__spectrum()
+        if not getattr(self, "garbled", False):
+            self.garbled = True
+            out[3] = 0
+        return out
+
+def group(*sims):
+    with contextlib.redirect_stdout(io.StringIO()):
+        units = [FastFlight2(dev=s) for s in sims]
+    for u in units:
+        u.setLength(2000)
+        u.setChunkSize(100)
+    return deviceGroup(units)
+
+def test_spectraLineUp():
+    g = group(simulatedFF2("SIM00001", seed=1), simulatedFF2("SIM00002", seed=2))
+    with contextlib.redirect_stdout(io.StringIO()):
+        numbers = [n for n, chunks in g.iterSpectra(2000, 500) if None not in chunks]
+    assert numbers == [0, 1, 2, 3, 4]
+
+def test_lostFirstSpectrumRaises():
+    g = group(simulatedFF2("SIM00001", seed=1), firstSpectrumCorrupt("SIM00002", seed=2))
+    with pytest.raises(RuntimeError, match="lined up"):
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in g.iterSpectra(2000, 500): pass
+
+def test_sameUnitTwice():
+    with pytest.raises(ValueError):
+        group(simulatedFF2("SIM00001", seed=1), simulatedFF2("SIM00001", seed=2))
@@ -0,0 +1,121 @@
+from FF2_parms import *
+from fastflight2 import FastFlight2, encodeProtocol, changedRanges
+from sim_device import simulatedFF2
+import contextlib
+import io
+import numpy as np
+
+# Protocol encoding against the original field-by-field stuff(); run with
+# pytest from this directory.
+
+Protocol = FastFlight2.Protocol
+
+def referenceStuff(s):
+    # (b1, b2) as Protocol.stuff() built them before encodings were cached
+    b1 = bytearray(0x0d)
+    b2 = bytearray(0x12)
+    tp = {0x10: 0.25, 0x20: 0.5, 0x40: 1.0, 0x80: 2.0}[s["tpp"]]
+    points = int(round(s["recordLength"] / tp))
+    points = max(16, min(1500000, points))
+
+    divider = int(0x10 * 0.5 / tp)
+    b1[0] = (points // divider) & 0xff
+    b1[1] = (points // (divider * 0x100)) & 0xff
+    toi = max(1, min(0xffff, int(s["timeOffset"] / 16.0)))
+    b1[3] = toi & 0xff
+    b1[4] = (toi // 0x100) & 0xff
+    b1[5] = s["recordsPerSpectrum"] & 0xff
+    b1[6] = (s["recordsPerSpectrum"] // 0x100) & 0xff
+    i = max(0, min(0xffff, int(round(((s["voltageOffset"] + 0.25) / 0.5) * 65535.))))
+    b1[8] = i & 0x00ff
+    b1[9] = (i & 0xff00) // 0x100
+    b1[0xb] = {0x10: 0, 0x20: 1, 0x40: 2, 0x80: 3}[s["tpp"]]
+    b1[0xc] = 1 if s["precisionEnhancer"] else 0
+
+    b2[0] = s["compression"] | s["tpp"]
+    b2[1] = s["ringingProtection"] * 0x10 | s["sensitivity"]
+    b2[2] = 0x0a
+    b2[4] = 0x30
+    b2[5] = (s["backgroundInterval"] // 4) & 0xff
+    b2[6] = (s["adjacentBackground"] & 0x7f) | (0x80 if s["correlatedSubtraction"] else 0)
+    points = (points // 8) * 8 - 2
+    b2[7] = 0x64
+    b2[8] = 0x04
+    b2[9] = points & 0xff
+    b2[0xa] = (points // 0x100) & 0xff
+    b2[0xb] = (points // 0x10000) & 0x1f
+    b2[0x10] = s["recordsPerSpectrum"] & 0xff
+    b2[0x11] = (s["recordsPerSpectrum"] // 0x100) & 0xff
+    return bytes(b1), bytes(b2)
+
+def randomSettings(rng):
+    return {"recordLength": float(rng.uniform(0, 1e6)),
+            "voltageOffset": float(rng.uniform(-0.3, 0.3)),
+            "timeOffset": float(rng.uniform(0, 2e6)),
+            "recordsPerSpectrum": int(rng.integers(1, 0x10000)),
+            "precisionEnhancer": bool(rng.integers(2)),
+            "tpp": int(rng.choice([0x10, 0x20, 0x40, 0x80])),
+            "compression": int(rng.integers(3)),
+            "ringingProtection": int(rng.integers(4)),
+            "sensitivity": int(rng.integers(3)),
+            "minimumThreshold": int(rng.integers(0, 0x100)),
+            "backgroundInterval": int(rng.integers(0, 0x400)),
+            "adjacentBackground": int(rng.integers(0, 0x100)),
+            "correlatedSubtraction": bool(rng.integers(2)),
+            "minimumPeak": int(rng.integers(0, 0x100)),
+            "maximumPeak": int(rng.integers(0, 0x400)),
+            "singleIonLength": float(rng.uniform(0, 500)),
+            "singleIonStart": float(rng.uniform(0, 500))}
+
+def test_encodingMatchesReference():
+    rng = np.random.default_rng(7)
+    # drawn from a smaller pool so that equal settings come round again
+    pool = [randomSettings(rng) for _ in range(500)]
+    encodeProtocol.cache_clear()
+    for k in rng.integers(0, len(pool), size=2000):
+        s = pool[k]
+        p = Protocol(**s)
+        b1, b2 = referenceStuff(s)
+        assert p.b1 == b1
+        if s["compression"] == Protocol.Compression.LOSSLESS:
+            assert p.b2 == b2
+        else:
+            # the peak detection bytes are only set for PEAK_ONLY and STICK
+            assert p.b2[:0x0c] + p.b2[0x10:] == b2[:0x0c] + b2[0x10:]
+        # quantizing is idempotent, so the copy shares the cached encoding
+        assert Protocol(**dict(zip(Protocol.FIELDS, p.key))) == p
+    assert encodeProtocol.cache_info().hits > 0
+
+def test_changedRanges():
+    old = bytes(16)
+    assert changedRanges(None, old) == [[0, 16]]
+    assert changedRanges(old, old) == []
+    new = bytearray(old)
+    new[2] = new[2 + PROTOCOL_MERGE_GAP - 1] = new[12] = 1
+    # close differences share a transfer, distant ones get their own
+    assert changedRanges(old, bytes(new)) == [[2, 2 + PROTOCOL_MERGE_GAP], [12, 13]]
+
+def test_sendProtocolDiffs():
+    with contextlib.redirect_stdout(io.StringIO()):
+        ff = FastFlight2(dev=simulatedFF2(seed=1))
+    slot = 5
+    base = PROTOCOL_BASE + slot*PROTOCOL_STEP
+    def resident(p):
+        return (bytes(ff.dev.mem[base:base + len(p.b1)]) == p.b1 and
+                bytes(ff.dev.mem[base + PROTOCOL_B2_OFFSET:base + PROTOCOL_B2_OFFSET + len(p.b2)]) == p.b2)
+    def writes(p):
+        ff.metrics.reset()
+        ff.sendProtocol(p, slot)
+        assert resident(p)
+        return ff.metrics.counters.get("control.protocolWrites", 0)
+
+    p = ff.settings
+    assert writes(p) == 2                   # b1 and b2 in full
+    assert writes(p) == 0                   # already there
+    # recordsPerSpectrum sits in b1[5:7] and b2[0x10:0x12]
+    assert writes(p.replace(recordsPerSpectrum=p.recordsPerSpectrum + 1)) == 2
+    assert writes(p) == 2
+    # precisionEnhancer only changes b1[0xc]
+    assert writes(p.replace(precisionEnhancer=not p.precisionEnhancer)) == 1
+    ff.forgetProtocols()
+    assert writes(p) == 2
@@ -0,0 +1,51 @@
+from FF2_parms import *
+from bulk_reader import bulkReader, spectrumCounter
+from ring_buffer import ringBuffer
+from sim_device import encodeSpectrum
+import numpy as np
+
+# bulkReader and spectrumCounter; run with pytest from this directory.
+
+def stream(lengths, seed=0):
+    rng = np.random.default_rng(seed)
+    return b"".join(encodeSpectrum(rng.integers(0, 0xfeff, size=n, dtype=np.uint32), i, ninth=bool(i & 1))
+                    for i, n in enumerate(lengths))
+
+def test_counterAcrossTransfers():
+    # long spectra span many transfers, short ones share them
+    for lengths, size in (([40000] * 3, 4096), ([16] * 50, 1000), ([16, 40000, 8, 2000] * 4, 333)):
+        s = stream(lengths)
+        c = spectrumCounter()
+        counts = []
+        for i in range(0, len(s), size):
+            c.add(s[i:i + size])
+            counts.append(c.count)
+        assert c.count == len(lengths)
+        ends = np.cumsum([len(stream([n])) for n in lengths])
+        # a spectrum counts once its last byte has been seen
+        assert counts == [int(np.searchsorted(ends, min(i + size, len(s)), side="right")) for i in range(0, len(s), size)]
+
+def test_readerStopsAtLimit():
+    s = stream([4000] * 10)
+    size = 1000
+    ring = ringBuffer(8)
+    chunks = [s[i:i + size] for i in range(0, len(s), size)]
+    taken = []
+    def read():
+        if len(taken) == len(chunks): return None
+        c = chunks[len(taken)]
+        taken.append(c)
+        slot = ring.acquire()
+        ring.views[slot][:len(c)] = c
+        return ring.views[slot][:len(c)]
+    r = bulkReader(read, ring, depth=4, limit=3)
+    r.start()
+    got = b""
+    while not r.exhausted():
+        buf = r.get()
+        got += bytes(buf)
+        ring.release(buf)
+    r.stop()
+    assert got == s[:len(got)]
+    # the transfer holding the end of the third spectrum is the last one read
+    assert len(got) == -(-3 * len(stream([4000])) // size) * size
@@ -0,0 +1,53 @@
+from FF2_parms import *
+from fastflight2 import FastFlight2
+from ring_buffer import ringBuffer
+from sim_device import simulatedFF2
+import contextlib
+import io
+import threading
+import pytest
+
+# ringBuffer and the zero-copy bulk reads into it; run with pytest from this
+# directory.
+
+def test_overrunAndRelease():
+    ring = ringBuffer(3, 64)
+    slots = [ring.acquire() for _ in range(3)]
+    assert sorted(slots) == [0, 1, 2] and ring.busy() == 3
+    with pytest.raises(BufferError):
+        ring.acquire()
+    # by index or by any view of the slot
+    ring.release(slots[0])
+    ring.release(ring.views[slots[1]][10:20])
+    assert ring.busy() == 1
+    with pytest.raises(BufferError):
+        ring.release(slots[0])
+
+def test_acquireWaitsForRelease():
+    ring = ringBuffer(1, 64)
+    slot = ring.acquire()
+    t = threading.Timer(0.05, ring.release, (slot,))
+    t.start()
+    assert ring.acquire(timeout=None) == slot
+    t.join()
+
+def test_readsLandInRingSlots():
+    with contextlib.redirect_stdout(io.StringIO()):
+        ff = FastFlight2(dev=simulatedFF2(seed=1))
+    ff.setLength(2000)
+    ff.setChunkSize(100)
+    ff.prepareSweep(2000)
+    ff.startAquisition()
+    try:
+        slots = set()
+        for _ in range(50):
+            buf = ff.readBulk()
+            if buf is None: continue
+            # a view of the slot the device wrote into, not a copy
+            assert any(buf.obj is s for s in ff.db.slots)
+            slots.add(ff.db.slotOf(buf))
+            ff.db.release(buf)
+        assert ff.db.busy() == 0
+        assert len(slots) <= len(ff.db)
+    finally:
+        ff.stopAquisition()
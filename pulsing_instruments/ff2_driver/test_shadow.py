@@ -0,0 +1,59 @@
+from FF2_parms import *
+from fastflight2 import FastFlight2
+from sim_device import simulatedFF2
+import contextlib
+import io
+import usb.core
+
+# Shadowed control registers; run with pytest from this directory.
+
+class flakyWrites(simulatedFF2):
+    # memory writes fail while failing is set
+    failing = False
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        if self.failing and not isinstance(data_or_wLength, int):
+            raise usb.core.USBError("Simulated write failure")
+        return super().ctrl_transfer(bmRequestType, bRequest, wValue, wIndex, data_or_wLength, timeout)
+
+def sim(cls=simulatedFF2):
+    with contextlib.redirect_stdout(io.StringIO()):
+        ff = FastFlight2(dev=cls(seed=1))
+    ff.metrics.reset()
+    return ff
+
+def reads(ff):
+    c = ff.metrics.counters
+    return c.get("control.getMemory", 0) + c.get("control.getParameter", 0)
+
+def test_readModifyWriteFromShadow():
+    ff = sim()
+    ff.setExternalTrigger(False)
+    ff.setExternalTrigger(True)
+    ff.setRapidProtocolSelection(True)
+    ff.resetTimer()
+    ff.setTriggerRising(False)
+    ff.setTriggerEnableHigh(True)
+    assert reads(ff) == 0
+    # what the shadow holds is what the device has
+    assert ff.getMemory() == ff.getMemory(cached=False) == ff.dev.mem[MISC_CNTRL_PTR]
+    assert ff.getParameter(TRIGGER_PARAMETER) == ff.getParameter(TRIGGER_PARAMETER, cached=False)
+
+def test_invalidate():
+    ff = sim()
+    ff.dev.mem[MISC_CNTRL_PTR] ^= EXT_TRIGGER_MASK      # changed behind the driver's back
+    assert ff.getMemory() != ff.dev.mem[MISC_CNTRL_PTR]
+    ff.invalidateShadow()
+    assert ff.getMemory() == ff.dev.mem[MISC_CNTRL_PTR]
+    assert reads(ff) == 1
+
+def test_failedWriteForgetsShadow():
+    ff = sim(flakyWrites)
+    before = ff.getMemory()
+    ff.dev.failing = True
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert not ff.setMemory(MISC_CNTRL_PTR, before ^ EXT_TRIGGER_MASK)
+    ff.dev.failing = False
+    # the device state is unknown after the failure, so it is read again
+    assert ff.getMemory() == before
+    assert reads(ff) == 1
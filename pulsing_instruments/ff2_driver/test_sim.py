@@ -0,0 +1,197 @@
+from FF2_parms import *
+from fastflight2 import FastFlight2
+from sim_device import simulatedFF2
+import contextlib
+import io
+import numpy as np
+import pytest
+
+# Acquisition checks against simulatedFF2; run with pytest from this directory.
+
+def simFF2(length=2000, chunk=100, **simArgs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        ff = FastFlight2(dev=simulatedFF2(seed=1, **simArgs))
+    ff.setLength(length)
+    ff.setChunkSize(chunk)
+    return ff
+
+def quietly(fn, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args, **kwargs)
+
+def perRecord(ff, buf):
+    return float(buf.mean()) / ff.acc.records
+
+def test_reusedSlotIsLatched():
+    # the second chunk size lands in a slot other than 0, which arming must keep
+    ff = simFF2()
+    _, buf = quietly(ff.takeSweep, 2000, 1000)
+    ref = perRecord(ff, buf)
+    ff.setChunkSize(200)
+    _, buf = quietly(ff.takeSweep, 2000, 1000)
+    assert ff.sweepSlots[0] != 0
+    assert ff.getLastProtocol() == ff.sweepSlots[0]
+    assert ff.acc.records == 1000
+    assert abs(perRecord(ff, buf) / ref - 1) < 0.05
+
+def test_reusedSlotOtherLength():
+    ff = simFF2()
+    quietly(ff.takeSweep, 2000, 1000)
+    ff.setLength(1000)
+    idx, buf = quietly(ff.takeSweep, 1000, 700)
+    assert ff.sweepSlots[0] != 0
+    assert len(buf) == 1000 and ff.acc.records == 700
+
+def test_interleavedSlotsNotZero():
+    ff = simFF2()
+    for v in (-0.2, -0.15, -0.1): ff.loadProtocol(ff.settings.replace(voltageOffset=v))
+    ps = [ff.settings.replace(voltageOffset=v) for v in (-0.05, 0.)]
+    quietly(ff.takeInterleaved, ps, 300)
+    assert ff.interleaved.slots == [3, 4]
+    assert ff.interleaved.records == [300, 300]
+    assert ff.interleaved.dropped == 0
+
+def test_poolScaleMatchesSerial():
+    serial, pool = simFF2(), simFF2()
+    pool.setDecodeWorkers(2)
+    try:
+        _, a = quietly(serial.takeSweep, 2000, 1250)
+        _, b = quietly(pool.takeSweep, 2000, 1250)
+        assert pool.acc.records == serial.acc.records == 1250
+        assert pool.getScale() == serial.getScale()
+        assert np.array_equal(pool.toVolts(b), serial.toVolts(a))
+    finally:
+        pool.setDecodeWorkers(0)
+
+def test_twoChunkSweep():
+    # chunkSize <= sweeps < 2*chunkSize: the remainder is the second spectrum
+    for workers in (0, 2):
+        ff = simFF2()
+        ff.setDecodeWorkers(workers)
+        try:
+            for sweeps in (100, 150, 199):
+                _, buf = quietly(ff.takeSweep, 2000, sweeps)
+                assert ff.acc.records == sweeps
+        finally:
+            ff.setDecodeWorkers(0)
+
+def test_backgroundReadRecords():
+    # the reader must not read past the remainder switch
+    ff = simFF2()
+    ff.setBackgroundRead(True)
+    for sweeps in (1250, 150, 1000, 60):
+        _, buf = quietly(ff.takeSweep, 2000, sweeps)
+        assert ff.acc.records == sweeps
+
+def test_autoChunkKeepsChunkSize():
+    ff = simFF2(chunk=100)
+    ff.setAutoChunk(True)
+    quietly(ff.takeSweep, 2000, 5000)
+    assert ff.plan.recordsPerSpectrum != 100
+    assert ff.chunkSize == 100 and ff.acc.records == 5000
+    ff.setAutoChunk(False)
+    quietly(ff.takeSweep, 2000, 1000)
+    assert ff.slots.contents[ff.sweepSlots[0]].recordsPerSpectrum == 100
+
+def test_backgroundReadLongRecords():
+    # spectra of several transfers each still stop the reader at the right one
+    ff = simFF2(length=40000)
+    ff.setBackgroundRead(True)
+    _, buf = quietly(ff.takeSweep, 40000, 450)
+    assert ff.acc.records == 450
+    # five chunks: the reader takes the first three, two transfers each
+    assert ff.readerStats["reads"] >= 6
+
+def test_ditherRunsBeforeArm(monkeypatch):
+    import fastflight2
+    monkeypatch.setattr(fastflight2, "DITHER_LEN", 1e-3)
+    ff = simFF2()
+    calls = []
+    quietly(ff.takeSweep, 2000, 350, lambda: calls.append(ff.getMemory() & RUN_MASK))
+    assert calls == [0]
+
+def test_poolCountersReachMetrics():
+    # decoder counters of the pool workers end up in sweepMetrics
+    serial, pool = simFF2(), simFF2()
+    pool.setDecodeWorkers(2)
+    try:
+        quietly(serial.takeSweep, 2000, 2000)
+        quietly(pool.takeSweep, 2000, 2000)
+    finally:
+        pool.setDecodeWorkers(0)
+    assert pool.sweepMetrics["counters"]["decode.spectra"] == serial.sweepMetrics["counters"]["decode.spectra"] == 20
+
+def test_protocolWritesCounted():
+    ff = simFF2()
+    ff.getMetrics()
+    ff.metrics.reset()
+    ff.loadProtocol(ff.settings.replace(voltageOffset=-0.1))
+    counters = ff.getMetrics()["counters"]
+    assert counters["control.protocolWrites"] > 0
+    assert counters["control.protocolBytes"] > 0
+
+def test_poolTimingAndPlanner():
+    ff = simFF2(triggerRate=20000.)
+    ff.setDecodeWorkers(2)
+    ff.setAutoChunk(True)
+    try:
+        quietly(ff.takeSweep, 2000, 2000)
+        assert ff.planner.observed == 1
+        assert ff.sweepMetrics["gauges"]["timing.chunks"] == len(ff.pool.chunkTimes) > 1
+        ff.setBinStats(True)
+        with pytest.raises(ValueError):
+            quietly(ff.takeSweep, 2000, 2000)
+    finally:
+        ff.setDecodeWorkers(0)
+
+class strayBytes(simulatedFF2):
+    # every spectrum is preceded by more than a transfer of bytes that are not
+    # part of one; every other marker straddles the end of a transfer
+    def _simulatedFF2__spectrum(self):
+        n = MAX_BULK_SIZE - 4 if self.spectrumNumber % 2 else MAX_BULK_SIZE + 4000
+        out = super()._simulatedFF2__spectrum()
+        return bytearray(b"\x01\xff\xff\x02" * (n // 4)) + out
+
+def test_poolResyncsAcrossSlots():
+    # the stray bytes span transfers; the pool must find each marker after them
+    with contextlib.redirect_stdout(io.StringIO()):
+        serial, pool = FastFlight2(dev=strayBytes(seed=1)), FastFlight2(dev=strayBytes(seed=1))
+    for ff in (serial, pool):
+        ff.setLength(2000)
+        ff.setChunkSize(100)
+    pool.setDecodeWorkers(2)
+    try:
+        _, a = quietly(serial.takeSweep, 2000, 1000)
+        _, b = quietly(pool.takeSweep, 2000, 1000)
+        assert pool.acc.records == serial.acc.records == 1000
+        assert np.array_equal(a, b)
+    finally:
+        pool.setDecodeWorkers(0)
+
+def test_firmwareStamp(tmp_path, monkeypatch):
+    import fastflight2
+    monkeypatch.setattr(fastflight2, "STATE_DIR", str(tmp_path))
+    monkeypatch.setattr(fastflight2, "FPGA_DIR", str(tmp_path / "missing"))
+    fastflight2.readFirmwareImage.cache_clear()
+    ff = simFF2()
+    assert ff.firmwareStampPath().startswith(str(tmp_path))
+    # no stamp: loaded by something else and left alone
+    assert not ff.needsFirmware()
+    # a stamp to compare with, but no images to hash
+    with open(ff.firmwareStampPath(), "w") as f: f.write("0" * 64 + "\n")
+    with pytest.raises(OSError):
+        ff.needsFirmware()
+    fastflight2.readFirmwareImage.cache_clear()
+
+class hardwareLike(simulatedFF2):
+    # answers like the simulator but is treated as a real unit
+    simulated = False
+
+def test_unverifiedCompressionOnHardware():
+    with contextlib.redirect_stdout(io.StringIO()):
+        ff = FastFlight2(dev=hardwareLike(seed=1))
+    with pytest.raises(NotImplementedError):
+        ff.setCompression(ff.Protocol.Compression.PEAK_ONLY)
+    with pytest.raises(NotImplementedError):
+        ff.loadProtocol(ff.settings.replace(compression=ff.Protocol.Compression.STICK))
+    ff.setCompression(ff.Protocol.Compression.LOSSLESS)
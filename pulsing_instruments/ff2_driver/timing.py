@@ -0,0 +1,59 @@
+from FF2_parms import *
+import numpy as np
+
+class acquisitionTiming:
+    # Device timestamps of the chunk spectra of one acquisition. A timestamp
+    # marks the end of its spectrum, so the interval to the previous one is
+    # that chunk's acquisition plus any dead time before it. The trigger
+    # period is taken from the fastest chunk (records / interval), i.e.
+    # assuming the device kept up at least once; the rest of every interval
+    # is a gap during which triggers were lost.
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.timestamps = []
+        self.records = []
+
+    def add(self, timestamp, records):
+        if timestamp < 0: return
+        self.timestamps.append(timestamp)
+        self.records.append(records)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def intervals(self):
+        # seconds between consecutive chunks
+        return np.diff(np.asarray(self.timestamps, dtype=np.float64)) * TIME_TICK
+
+    def recordRate(self):
+        # records per second over the acquisition, gaps included
+        t = self.intervals()
+        if len(t) == 0 or t.sum() <= 0: return 0.
+        return float(np.sum(self.records[1:]) / t.sum())
+
+    def recordPeriod(self):
+        t = self.intervals()
+        r = np.asarray(self.records[1:], dtype=np.float64)
+        ok = (t > 0) & (r > 0)
+        if not ok.any(): return 0.
+        return float(np.min(t[ok] / r[ok]))
+
+    def gaps(self):
+        # seconds lost before each chunk but the first
+        t = self.intervals()
+        return np.maximum(t - np.asarray(self.records[1:], dtype=np.float64) * self.recordPeriod(), 0.)
+
+    def dutyCycle(self):
+        # fraction of the time the device was acquiring
+        t = self.intervals()
+        if len(t) == 0 or t.sum() <= 0: return 1.
+        return float(1. - self.gaps().sum() / t.sum())
+
+    def summary(self):
+        g = self.gaps()
+        return {"chunks": len(self.timestamps), "recordRate": self.recordRate(),
+                "recordPeriod": self.recordPeriod(), "dutyCycle": self.dutyCycle(),
+                "meanGap": float(g.mean()) if len(g) else 0., "maxGap": float(g.max()) if len(g) else 0.}
@@ -0,0 +1,135 @@
+from FF2_parms import *
+from lusb import bknd
+from collections import deque
+from ctypes import addressof
+import usb.core
+import usb.backend.libusb1 as libusb1
+import array
+
+REQUEST = bytes([0xff, 0x03])   # asks the device for the next block of SPECTRA_IN
+
+class transferEngine:
+    # Keeps several request/read pairs queued in libusb at once, so the bus is
+    # never idle waiting for the host to turn around between chunks. Each read
+    # lands in its own ring slot; completed buffers are handed back strictly in
+    # submission order.
+
+    class transfer:
+        def __init__(self, engine, endpoint, address, length):
+            self.ptr = engine.lib.libusb_alloc_transfer(0)
+            if not self.ptr: raise MemoryError("libusb_alloc_transfer failed")
+            t = self.ptr.contents
+            t.dev_handle = engine.handle
+            t.endpoint = endpoint
+            t.type = libusb1._LIBUSB_TRANSFER_TYPE_BULK
+            t.timeout = engine.timeout
+            t.length = length
+            t.buffer = address
+            t.callback = engine.callback
+            t.num_iso_packets = 0
+            self.busy = False
+            self.slot = None
+
+        def status(self):
+            return self.ptr.contents.status, self.ptr.contents.actual_length
+
+    def __init__(self, iface, ring, inflight=INFLIGHT_TRANSFERS, timeout=1000):
+        if bknd is None: raise RuntimeError("Asynchronous transfers need the libusb-1.0 backend")
+        if not hasattr(iface.dev, "_ctx"): raise RuntimeError("Asynchronous transfers need a libusb device")
+        if len(ring) < inflight + 2: raise ValueError(f"Ring of {len(ring)} slots is too small for {inflight} transfers in flight")
+        self.lib = bknd.lib
+        self.lib.libusb_cancel_transfer.argtypes = [libusb1._libusb_transfer_p]
+        self.ctx = bknd.ctx
+        iface.dev._ctx.managed_open()
+        self.handle = iface.dev._ctx.handle.handle
+        self.ring = ring
+        self.inflight = inflight
+        self.timeout = timeout
+        self.callback = libusb1._libusb_transfer_cb_fn_p(self.__complete)
+
+        self.__request = array.array('B', REQUEST)
+        reqAddress = self.__request.buffer_info()[0]
+        self.__requests = [self.transfer(self, SPECTRA_OUT, reqAddress, len(REQUEST)) for _ in range(inflight)]
+        self.__reads = [self.transfer(self, SPECTRA_IN, 0, 0) for _ in range(inflight)]
+        self.__byAddress = {addressof(x.ptr.contents): x for x in self.__requests + self.__reads}
+        self.__idle = deque(range(inflight))
+        self.__queued = deque()     # indices of submitted reads, oldest first
+
+        self.timeouts = 0
+
+    def __complete(self, ptr):
+        self.__byAddress[addressof(ptr.contents)].busy = False
+
+    def __submit(self, x):
+        x.busy = True
+        try:
+            libusb1._check(self.lib.libusb_submit_transfer(x.ptr))
+        except usb.core.USBError:
+            x.busy = False
+            raise
+
+    def __wait(self, x):
+        while x.busy: libusb1._check(self.lib.libusb_handle_events(self.ctx))
+
+    def __post(self, i, request=True):
+        x = self.__reads[i]
+        if request:
+            req = self.__requests[i]
+            self.__wait(req)
+            self.__submit(req)
+        self.__submit(x)
+        self.__queued.append(i)
+
+    def __fill(self):
+        # top up to `inflight` outstanding reads while ring slots are free
+        while self.__idle:
+            try:
+                slot = self.ring.acquire()
+            except BufferError:
+                return
+            i = self.__idle.popleft()
+            x = self.__reads[i]
+            x.slot = slot
+            t = x.ptr.contents
+            t.buffer = self.ring.slots[slot].buffer_info()[0]
+            t.length = self.ring.size
+            self.__post(i)
+
+    def next(self):
+        # Oldest completed read as a view of its ring slot, or None on timeout.
+        # The caller releases the slot back to the ring once it is consumed.
+        self.__fill()
+        if not self.__queued: raise BufferError("No ring slot free to read into; release consumed buffers first")
+        i = self.__queued[0]
+        x = self.__reads[i]
+        self.__wait(x)
+        self.__queued.popleft()
+        status, n = x.status()
+
+        if status == libusb1.LIBUSB_TRANSFER_TIMED_OUT and n == 0:
+            # nothing to send yet; the request is still pending on the device
+            self.timeouts += 1
+            self.__post(i, request=False)
+            return None
+        if status not in (libusb1.LIBUSB_TRANSFER_COMPLETED, libusb1.LIBUSB_TRANSFER_TIMED_OUT):
+            self.ring.release(x.slot)
+            self.__idle.append(i)
+            raise usb.core.USBError(libusb1._str_transfer_error[status], status, libusb1._transfer_errno[status])
+
+        slot = x.slot
+        self.__idle.append(i)
+        self.__fill()
+        return self.ring.views[slot][:n]
+
+    def close(self):
+        # cancel everything still queued and wait for libusb to hand it back
+        for x in self.__requests + self.__reads:
+            if x.busy: self.lib.libusb_cancel_transfer(x.ptr)
+        for x in self.__requests + self.__reads:
+            self.__wait(x)
+        for i in self.__queued: self.ring.release(self.__reads[i].slot)
+        self.__queued.clear()
+        for x in self.__requests + self.__reads:
+            self.lib.libusb_free_transfer(x.ptr)
+        self.__requests = self.__reads = []
+        self.__byAddress = {}
@@ -4,13 +4,15 @@ import string
 
 class usbInterface:
 
-    def __init__(self, vendorID, productID, defaultBufferLen=1024, defaultTimeout=None):
+    def __init__(self, vendorID, productID, defaultBufferLen=1024, defaultTimeout=None, dev=None, serial=None):
         self.vendorID = vendorID
         self.productID = productID
         self.defaultBufferLen = defaultBufferLen
         self.defaultTimeout = defaultTimeout
         
-        self.dev = locateDevice(idVendor=vendorID, idProduct=productID)
+        # dev overrides the device lookup, e.g. with a simulated device; serial
+        # picks one unit when several are connected
+        self.dev = dev if dev is not None else locateDevice(idVendor=vendorID, idProduct=productID, serial=serial)
 
     def __str__(self):
         return devToStr(self.dev)
@@ -18,9 +20,13 @@ class usbInterface:
     def __repr__(self):
         return f"<usbInterface-VID0x{self.vendorID:04x}-PID0x{self.productID:04x}>"
 
-    def getManufacturerName(self): return usb.util.get_string(self.dev, self.dev.iManufacturer)
-    def getProductName(self): return usb.util.get_string(self.dev, self.dev.iProduct)
-    def getSerialNumber(self): return usb.util.get_string(self.dev, self.dev.iSerialNumber)
+    def getString(self, index):
+        if hasattr(self.dev, "getString"): return self.dev.getString(index)
+        return usb.util.get_string(self.dev, index)
+
+    def getManufacturerName(self): return self.getString(self.dev.iManufacturer)
+    def getProductName(self): return self.getString(self.dev.iProduct)
+    def getSerialNumber(self): return self.getString(self.dev.iSerialNumber)
 
     def Write(self, endpoint, data, timeout=None):
         if timeout is None: timeout = self.defaultTimeout